@@ -0,0 +1,378 @@
+# app/bench/broadcast.py
+"""
+Офлайн-бенчмарк рассылки: `python -m app.bench.broadcast --users 5000`.
+
+Поднимает локальный фейковый Bot API (aiohttp) с задержкой, случайными 429
+и заблокированными пользователями, засевает N пользователей во временную
+SQLite и прогоняет настоящий раннер рассылки (лимитер, доставки, прогресс).
+Ничего не уходит в Telegram — можно крутить BATCH/WORKERS/лимиты.
+
+Отчёт: сообщений/сек, задержки отправки (p50/p95/p99, включая ожидание
+в лимитере и повторы), вызовы по методам/кодам, «лишние» вызовы (429 и
+повторные отправки одному пользователю) и задержка интерактивных
+сообщений, отправленных во время рассылки.
+
+`--pause-after S`: через S секунд рассылка ставится на паузу; раннер
+обязан вернуться (строки pending остаются). Затем пачки запускаются
+прямо по стоящей на паузе задаче с pending — как если пауза пришла сразу
+после проверки статуса в начале раннера: они тоже обязаны вернуться
+(захват pending не должен крутиться по кругу). После этого задача
+продолжается до конца. Не вернулся за PAUSE_GRACE — ошибка (код выхода 1).
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+FAKE_TOKEN = "123456:BENCHMARK-fake-token"
+ADMIN_CHAT = 777
+# id «интерактивных» чатов и засеянных пользователей не пересекаются
+PROBE_BASE = 500_000
+USER_BASE = 1_000_000
+_SEND_METHODS = ("sendmessage", "sendphoto", "copymessage")
+# сколько ждать остановки раннера после паузы, с
+PAUSE_GRACE = 10.0
+
+
+# ==== Фейковый Bot API ====
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        latency_ms: float,
+        jitter_ms: float,
+        retry_rate: float,
+        retry_after: int,
+        forbidden_rate: float,
+        server_limit: float,
+        seed: int,
+    ):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.forbidden_rate = forbidden_rate
+        self.server_limit = server_limit
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        self.calls: Counter[tuple[str, int]] = Counter()
+        self.delivered: Counter[int] = Counter()
+        self._window: deque[float] = deque()
+        self._flood_until = 0.0
+        self._message_id = 0
+
+    def is_blocked(self, chat_id: int) -> bool:
+        # детерминированно по id: один и тот же пользователь всегда «заблокировал» бота
+        return chat_id >= USER_BASE and random.Random(chat_id * 7919 + self.seed).random() < self.forbidden_rate
+
+    def _over_limit(self, now: float) -> bool:
+        if not self.server_limit:
+            return False
+        if now < self._flood_until:
+            return True
+        while self._window and now - self._window[0] > 1.0:
+            self._window.popleft()
+        if len(self._window) >= self.server_limit:
+            self._flood_until = now + self.retry_after
+            return True
+        self._window.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        chat_id = int(data.get("chat_id") or 0)
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+
+        if method.startswith(("send", "copy", "edit")):
+            if self.rng.random() < self.retry_rate or self._over_limit(time.monotonic()):
+                self.calls[(method, 429)] += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                })
+            if method in _SEND_METHODS and self.is_blocked(chat_id):
+                self.calls[(method, 403)] += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 403,
+                    "description": "Forbidden: bot was blocked by the user",
+                })
+
+        self.calls[(method, 200)] += 1
+        if method in _SEND_METHODS and chat_id >= USER_BASE:
+            self.delivered[chat_id] += 1
+        self._message_id += 1
+        if method == "copymessage":
+            result: object = {"message_id": self._message_id}
+        elif method.startswith(("send", "edit")):
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "bench",
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> tuple[web.AppRunner, int]:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, port
+
+
+# ==== Замер задержек на стороне клиента ====
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _fmt_lat(values: list[float]) -> str:
+    ms = [v * 1000 for v in values]
+    return (
+        f"p50 {_pct(ms, 0.50):.0f} ms, p95 {_pct(ms, 0.95):.0f} ms, "
+        f"p99 {_pct(ms, 0.99):.0f} ms, max {max(ms, default=0):.0f} ms (n={len(ms)})"
+    )
+
+
+def _timing_middleware(bulk_lat: list[float], probe_lat: list[float]):
+    from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+    class Timing(BaseRequestMiddleware):
+        # регистрируется первым — значит, внешний: меряет и лимитер, и повторы
+        async def __call__(self, make_request, bot, method):
+            if not type(method).__name__.startswith(("Send", "Copy")):
+                return await make_request(bot, method)
+            t0 = time.monotonic()
+            try:
+                return await make_request(bot, method)
+            finally:
+                chat_id = getattr(method, "chat_id", None)
+                target = bulk_lat if isinstance(chat_id, int) and chat_id >= USER_BASE else probe_lat
+                target.append(time.monotonic() - t0)
+
+    return Timing()
+
+
+# ==== Прогон ====
+
+async def _seed(n: int, seed: int) -> None:
+    from sqlalchemy import insert
+
+    from app.db.session import async_session
+    from app.models.user import User
+
+    rng = random.Random(seed)
+    langs = ("en", "ru", "hi", "ar", "es", "fr", "ro")
+    rows = [
+        {
+            "id": USER_BASE + i,
+            "lang": rng.choice(langs),
+            "is_registered": rng.random() < 0.4,
+            "is_subscribed": rng.random() < 0.6,
+        }
+        for i in range(n)
+    ]
+    async with async_session() as session:
+        for i in range(0, n, 5000):
+            await session.execute(insert(User), rows[i:i + 5000])
+        await session.commit()
+
+
+async def _count_pending(job_id: int) -> int:
+    from sqlalchemy import func, select
+
+    from app.db.session import async_session
+    from app.models.broadcast import BroadcastDelivery
+
+    async with async_session() as session:
+        return (await session.execute(
+            select(func.count()).select_from(BroadcastDelivery)
+            .where(BroadcastDelivery.job_id == job_id, BroadcastDelivery.status == "pending")
+        )).scalar_one()
+
+
+async def _probe(bot, interval: float, stop: asyncio.Event) -> None:
+    # «интерактивный» трафик во время рассылки: не в bulk-контексте,
+    # каждый раз новый чат — как разные пользователи, жмущие кнопки
+    n = 0
+    while not stop.is_set():
+        n += 1
+        try:
+            await bot.send_message(PROBE_BASE + n, "probe")
+        except Exception:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args: argparse.Namespace) -> None:
+    # app.* импортируем после того, как DATABASE_URL указывает на временную БД
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    from app.db.schema import ensure_schema
+    from app.db.session import engine
+    from app.services import broadcast as bc_service
+    from app.services import ratelimit
+    from app.services.segments import Segment
+
+    api = FakeBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        retry_rate=args.retry_rate,
+        retry_after=args.retry_after,
+        forbidden_rate=args.forbidden_rate,
+        server_limit=args.server_limit,
+        seed=args.seed,
+    )
+    runner, port = await api.start()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(ensure_schema)
+    t_seed = time.monotonic()
+    await _seed(args.users, args.seed)
+    print(f"seeded {args.users} users in {time.monotonic() - t_seed:.1f}s")
+
+    bulk_lat: list[float] = []
+    probe_lat: list[float] = []
+    bot = Bot(
+        token=FAKE_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    bot.session.middleware(_timing_middleware(bulk_lat, probe_lat))
+    ratelimit.install(bot, global_rate=args.rate)
+
+    bc_service.BATCH = args.batch
+    bc_service.WORKERS = args.workers
+
+    job_id = await bc_service.create_job(
+        admin_id=ADMIN_CHAT,
+        admin_chat_id=ADMIN_CHAT,
+        seg=Segment(),
+        text="<b>Benchmark</b> broadcast",
+        media=None,
+        btn_text="Open",
+        btn_url="https://example.com",
+        total=args.users,
+    )
+    if args.mode == "copy":
+        await bc_service.stage_job(bot, job_id, ADMIN_CHAT)
+    await bc_service.set_progress_message(job_id, 1)
+    api.calls.clear()
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(_probe(bot, args.probe_interval, stop)) if args.probe_interval > 0 else None
+    t0 = time.monotonic()
+    pause_note = ""
+    if args.pause_after > 0:
+        run_task = asyncio.create_task(bc_service._run_job(bot, job_id))
+        await asyncio.sleep(args.pause_after)
+        await bc_service.pause_job(job_id)
+        t_pause = time.monotonic()
+        try:
+            await asyncio.wait_for(run_task, PAUSE_GRACE)
+            pending = await _count_pending(job_id)
+            t_paused = time.monotonic()
+            await asyncio.wait_for(bc_service._run_batches(bot, await bc_service.get_job(job_id), None), PAUSE_GRACE)
+        except asyncio.TimeoutError:
+            stop.set()
+            if probe:
+                await probe
+            await bot.session.close()
+            await runner.cleanup()
+            raise SystemExit(f"runner did not stop within {PAUSE_GRACE:.0f}s after pause")
+        pause_note = (
+            f"paused after {args.pause_after:.1f}s: runner stopped in {t_paused - t_pause:.2f}s, {pending} pending; "
+            f"batches on the paused job returned in {time.monotonic() - t_paused:.2f}s"
+        )
+        await bc_service._set_status(job_id, "running", ("paused",))
+    await bc_service._run_job(bot, job_id)
+    elapsed = time.monotonic() - t0
+    stop.set()
+    if probe:
+        await probe
+
+    job = await bc_service.get_job(job_id)
+    await bot.session.close()
+    await runner.cleanup()
+
+    calls_429 = sum(n for (_, code), n in api.calls.items() if code == 429)
+    dup_sends = sum(n - 1 for n in api.delivered.values() if n > 1)
+    edits = sum(n for (m, _), n in api.calls.items() if m.startswith("edit"))
+    send_calls = sum(n for (m, _), n in api.calls.items() if m in _SEND_METHODS)
+
+    print()
+    print(f"mode={args.mode} batch={args.batch} workers={args.workers} rate={args.rate}/s "
+          f"latency={args.latency_ms}±{args.jitter_ms} ms retry_rate={args.retry_rate} "
+          f"forbidden_rate={args.forbidden_rate} server_limit={args.server_limit}/s")
+    if pause_note:
+        print(pause_note)
+    print(f"job #{job_id}: {job.status}, ok {job.sent_ok}, failed {job.sent_fail}, total {job.total}")
+    print(f"elapsed {elapsed:.2f}s, throughput {(job.sent_ok + job.sent_fail) / elapsed:.1f} msg/s "
+          f"(delivered {job.sent_ok / elapsed:.1f} msg/s)")
+    print(f"send latency:  {_fmt_lat(bulk_lat)}")
+    if probe_lat:
+        print(f"probe latency: {_fmt_lat(probe_lat)}")
+    print(f"calls: {send_calls} sends, {edits} progress edits")
+    for (method, code), n in sorted(api.calls.items()):
+        print(f"  {method:<16} {code}  {n}")
+    print(f"wasted calls: {calls_429 + dup_sends} ({calls_429} × 429, {dup_sends} duplicate sends)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline broadcast benchmark against a fake Bot API")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--mode", choices=("copy", "direct"), default="copy")
+    parser.add_argument("--batch", type=int, default=25, help="broadcast.BATCH")
+    parser.add_argument("--workers", type=int, default=2, help="broadcast.WORKERS")
+    parser.add_argument("--rate", type=float, default=30.0, help="client global rate, msg/s")
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--retry-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--forbidden-rate", type=float, default=0.05, help="share of users who blocked the bot")
+    parser.add_argument("--server-limit", type=float, default=30.0, help="fake server flood limit, msg/s (0 = off)")
+    parser.add_argument("--probe-interval", type=float, default=0.5, help="interactive probe every N s (0 = off)")
+    parser.add_argument("--pause-after", type=float, default=0.0,
+                        help="pause the job after N s, check the runner stops, then resume (0 = off)")
+    parser.add_argument("--db", default=None, help="new SQLite file to create (default: temporary)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # бенчмарк засевает и гоняет свою базу: чужой файл (data.db) не трогаем
+    if args.db and any(os.path.exists(args.db + suffix) for suffix in ("", "-wal", "-shm")):
+        parser.error(f"--db {args.db} already exists; pass a new path or omit --db")
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="bc-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+    # на случай, если в .env прописаны воркеры — бенчмарк гоняет раннер в этом процессе
+    os.environ["BROADCAST_WORKER_PROCESSES"] = "0"
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
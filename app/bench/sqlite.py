@@ -0,0 +1,200 @@
+# app/bench/sqlite.py
+"""
+Бенчмарк профиля SQLite: `python -m app.bench.sqlite --seconds 10`.
+
+Засевает две одинаковые временные БД (users + postbacks) и гоняет на
+каждой одну и ту же смешанную нагрузку: писатели — транзакции как у
+apply_postback (вставка постбэка + апдейт пользователя, со всеми
+after_flush-слушателями), читатели — запросы админки (страница
+пользователей, лента постбэков трейдера, агрегат по событиям).
+Первая БД — умолчания SQLite (rollback-журнал, synchronous=FULL),
+вторая — профиль из app/db/sqlite.py, третья — тот же профиль, но записи
+идут через единого писателя (app/db/writer.py): очередь и один коммит на
+пачку. Разница видна при большом числе писателей: `--writers 32`.
+
+Отчёт: операций/сек, задержки (p50/p95/p99) и ошибки «database is locked»
+для чтений и записей в обоих режимах.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+
+@dataclass
+class _Stats:
+    lat: List[float] = field(default_factory=list)
+    errors: int = 0
+
+
+def _fmt_lat(lat: List[float]) -> str:
+    if not lat:
+        return "-"
+    s = sorted(lat)
+
+    def pct(p: float) -> float:
+        return s[min(len(s) - 1, int(len(s) * p))] * 1000
+
+    return f"p50 {pct(0.50):.1f} ms, p95 {pct(0.95):.1f} ms, p99 {pct(0.99):.1f} ms"
+
+
+async def _seed(engine, users: int, postbacks: int, seed: int) -> None:
+    from sqlalchemy import insert
+
+    from app.db.schema import ensure_schema
+    from app.models.postback import Postback
+    from app.models.user import User
+
+    rnd = random.Random(seed)
+    async with engine.begin() as conn:
+        await conn.run_sync(ensure_schema)
+        for start in range(0, users, 5000):
+            await conn.execute(insert(User), [
+                {"id": i, "lang": "en", "is_registered": i % 3 == 0, "partner_trader_id": f"t{i}"}
+                for i in range(start + 1, min(start + 5000, users) + 1)
+            ])
+        for start in range(0, postbacks, 5000):
+            await conn.execute(insert(Postback), [
+                {
+                    "event": rnd.choice(("registration", "deposit_first", "deposit_repeat")),
+                    "tg_id": (uid := rnd.randint(1, users)),
+                    "trader_id": f"t{uid}",
+                    "amount_usd": rnd.random() * 300,
+                    "ts": 1_700_000_000 + start + k,
+                }
+                for k in range(min(5000, postbacks - start))
+            ])
+
+
+async def _writer(sessions, single, users: int, rnd: random.Random, stop: asyncio.Event, st: _Stats) -> None:
+    from sqlalchemy.exc import OperationalError
+
+    from app.models.postback import Postback
+    from app.models.user import User
+
+    async def apply(session, uid: int) -> None:
+        session.add(Postback(
+            event="deposit_repeat", tg_id=uid, trader_id=f"t{uid}",
+            amount_usd=rnd.random() * 100, ts=int(time.time()), raw_text="bench",
+        ))
+        u = await session.get(User, uid)
+        u.deposit_total_usd = (u.deposit_total_usd or 0) + 10
+
+    while not stop.is_set():
+        uid = rnd.randint(1, users)
+        t0 = time.perf_counter()
+        try:
+            if single is not None:
+                await single.submit(lambda session: apply(session, uid))
+            else:
+                async with sessions() as session:
+                    await apply(session, uid)
+                    await session.commit()
+            st.lat.append(time.perf_counter() - t0)
+        except OperationalError:
+            st.errors += 1
+
+
+async def _reader(sessions, users: int, rnd: random.Random, stop: asyncio.Event, st: _Stats) -> None:
+    from sqlalchemy import desc, func, select
+    from sqlalchemy.exc import OperationalError
+
+    from app.models.postback import Postback
+    from app.models.user import User
+
+    queries = (
+        lambda: select(User).order_by(desc(User.created_at), desc(User.id)).limit(11),
+        lambda: select(Postback).where(Postback.trader_id == f"t{rnd.randint(1, users)}")
+        .order_by(desc(Postback.id)).limit(8),
+        lambda: select(Postback.event, func.count(), func.sum(Postback.amount_usd))
+        .where(Postback.ts >= int(time.time()) - 3600).group_by(Postback.event),
+    )
+    while not stop.is_set():
+        q = rnd.choice(queries)()
+        t0 = time.perf_counter()
+        try:
+            async with sessions() as session:
+                (await session.execute(q)).all()
+            st.lat.append(time.perf_counter() - t0)
+        except OperationalError:
+            st.errors += 1
+
+
+async def _run_profile(name: str, tuned: bool, single_writer: bool, args: argparse.Namespace, workdir: str) -> None:
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+    from app.db.sqlite import install_sqlite_tuning, sqlite_pragmas
+    from app.db.writer import Writer
+
+    path = os.path.join(workdir, f"{name}.db")
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}",
+        # умолчание sqlite3.connect — ждать блокировку 5 с; «до» без ожидания,
+        # как в SQLite без busy_timeout
+        connect_args={} if tuned else {"timeout": 0},
+        pool_size=args.readers + args.writers,
+    )
+    if tuned:
+        install_sqlite_tuning(engine)
+    sessions = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    await _seed(engine, args.users, args.postbacks, args.seed)
+    single = Writer(sessions, batch_max=args.batch_max, coalesce_ms=args.coalesce_ms) if single_writer else None
+
+    writes, reads = _Stats(), _Stats()
+    stop = asyncio.Event()
+    tasks = [
+        asyncio.create_task(_writer(sessions, single, args.users, random.Random(args.seed + i), stop, writes))
+        for i in range(args.writers)
+    ] + [
+        asyncio.create_task(_reader(sessions, args.users, random.Random(args.seed + 100 + i), stop, reads))
+        for i in range(args.readers)
+    ]
+    await asyncio.sleep(args.seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    if single is not None:
+        await single.stop()
+    await engine.dispose()
+
+    print()
+    print(f"[{name}] " + ("; ".join(p.replace("PRAGMA ", "") for p in sqlite_pragmas()) if tuned else "SQLite defaults"))
+    print(f"  writes: {len(writes.lat) / args.seconds:8.1f}/s  {_fmt_lat(writes.lat)}  locked errors: {writes.errors}")
+    print(f"  reads:  {len(reads.lat) / args.seconds:8.1f}/s  {_fmt_lat(reads.lat)}  locked errors: {reads.errors}")
+    if single is not None:
+        print(f"  single writer: {single.batches} commits, {single.intents / max(1, single.batches):.1f} writes per commit")
+
+
+async def run(args: argparse.Namespace) -> None:
+    workdir = tempfile.mkdtemp(prefix="sqlite-bench-")
+    print(f"users={args.users} postbacks={args.postbacks} writers={args.writers} "
+          f"readers={args.readers} seconds={args.seconds} dir={workdir}")
+    await _run_profile("before", False, False, args, workdir)
+    await _run_profile("after", True, False, args, workdir)
+    await _run_profile("writer", True, True, args, workdir)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="SQLite defaults vs tuned profile vs single writer under a mixed bot workload"
+    )
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--postbacks", type=int, default=100000)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=6)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch-max", type=int, default=200, help="single writer: writes per commit")
+    parser.add_argument("--coalesce-ms", type=float, default=2.0, help="single writer: batching window")
+    args = parser.parse_args()
+
+    # главный движок приложения не нужен, но app.db.session создаётся при импорте
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
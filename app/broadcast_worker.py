@@ -0,0 +1,133 @@
+# app/broadcast_worker.py
+"""
+Процесс-воркер рассылок: `python -m app.broadcast_worker --index 0 --count 2`.
+
+Бот при BROADCAST_WORKER_PROCESSES > 0 сам запускает воркеры (supervise)
+и только принимает апдейты. Воркеры без polling'а: находят в БД задачи
+'running' и ведут их общим раннером; получателей делят через БД
+(см. «Раннер» в app/services/broadcast.py). Пауза/отмена из админки
+видны воркерам через статус задачи.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+
+from app.config import settings
+from app.db.writer import stop_writer
+from app.services import broadcast as bc_service
+from app.services import ratelimit
+
+log = logging.getLogger(__name__)
+
+RESTART_DELAY = 5.0
+# сколько ждать воркер после SIGTERM, прежде чем убить
+STOP_TIMEOUT = 10.0
+
+
+def worker_name(index: int, pid: int) -> str:
+    return f"w{index}-{pid}"
+
+
+def worker_rate(count: int) -> float:
+    return (settings.TG_GLOBAL_RATE - settings.BROADCAST_INTERACTIVE_RATE) / max(1, count)
+
+
+# ==== Супервизор (процесс бота) ====
+
+async def _keep_worker(index: int, count: int) -> None:
+    while True:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "app.broadcast_worker", "--index", str(index), "--count", str(count),
+            "--parent", str(os.getpid()),
+        )
+        log.info("Broadcast worker %s started (pid %s)", index, proc.pid)
+        try:
+            code = await proc.wait()
+        except asyncio.CancelledError:
+            # бот останавливается — воркер не должен слать без него
+            await _stop_process(proc)
+            await bc_service.fail_claims(worker_name(index, proc.pid))
+            raise
+        # пачки, которые воркер не успел дописать, — как после рестарта бота
+        failed = await bc_service.fail_claims(worker_name(index, proc.pid))
+        log.warning("Broadcast worker %s exited with %s, %s in-flight deliveries failed", index, code, failed)
+        await asyncio.sleep(RESTART_DELAY)
+
+
+async def _stop_process(proc: asyncio.subprocess.Process) -> None:
+    try:
+        proc.terminate()
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(proc.wait(), STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("Broadcast worker pid %s ignored SIGTERM, killing", proc.pid)
+        proc.kill()
+        await proc.wait()
+
+
+async def supervise(count: int) -> None:
+    """Держит воркеры запущенными; отмена задачи останавливает их все."""
+    await asyncio.gather(*[_keep_worker(i, count) for i in range(count)])
+
+
+# ==== Воркер ====
+
+async def run_worker(index: int, count: int, parent: Optional[int] = None) -> None:
+    # прогресс рисует один воркер: счётчики задачи общие, правки экрана — нет
+    bc_service.configure_worker(worker_name(index, os.getpid()), report_progress=(index == 0))
+
+    bot = Bot(
+        token=settings.BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    ratelimit.install(bot, global_rate=worker_rate(count), reserve=0)
+
+    # SIGTERM от супервизора — штатная остановка: раннеры закрывают свои пачки
+    if os.name != "nt":
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    # pid бота берём из аргументов: к этой строке бот мог уже умереть
+    # (импорт aiogram небыстрый), и getppid() вернул бы нового родителя
+    if parent is None:
+        parent = os.getppid()
+
+    try:
+        while True:
+            # бот убит без остановки воркеров (SIGKILL, OOM) — без него не шлём
+            if os.getppid() != parent:
+                log.warning("Bot process %s is gone, stopping", parent)
+                return
+            for job_id in await bc_service.running_job_ids():
+                bc_service.start_job(bot, job_id)
+            await asyncio.sleep(settings.BROADCAST_WORKER_POLL)
+    finally:
+        await bc_service.stop_runners()
+        await stop_writer()
+        await bot.session.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", type=int, required=True)
+    parser.add_argument("--count", type=int, required=True)
+    parser.add_argument("--parent", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=f"[bc-{args.index}] %(levelname)s:%(name)s:%(message)s")
+    try:
+        asyncio.run(run_worker(args.index, args.count, args.parent))
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import logging
+
+from sqlalchemy import BigInteger, Integer, inspect, text
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from app.models.base import Base
+from app.models import broadcast, metrics, postback, setting, ui_state, user  # noqa: F401 — регистрируем таблицы в metadata
+
+log = logging.getLogger(__name__)
+
+
+async def ensure_database(url: str) -> None:
+    """
+    SQLite создаёт файл БД сам при первом подключении, PostgreSQL — нет.
+    Для PostgreSQL создаём базу из DATABASE_URL, если её ещё нет
+    (подключаясь к служебной базе postgres). Нужны права CREATEDB;
+    без них — только предупреждение, ошибку даст первое подключение.
+    """
+    u = make_url(url)
+    if u.get_backend_name() != "postgresql" or not u.database:
+        return
+    admin = create_async_engine(u.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    try:
+        async with admin.connect() as conn:
+            exists = (await conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": u.database}
+            )).scalar()
+            if not exists:
+                quoted = conn.dialect.identifier_preparer.quote(u.database)
+                await conn.execute(text(f"CREATE DATABASE {quoted}"))
+                log.info("Created database %s", u.database)
+    except Exception as e:
+        log.warning("Could not ensure database %s exists: %s", u.database, e)
+    finally:
+        await admin.dispose()
+
+
+def _widen_integer_columns(conn: Connection, insp) -> None:
+    # Базы PostgreSQL, созданные до перехода users.id на BIGINT: расширяем
+    # INTEGER-колонки, которые в моделях стали BigInteger
+    for table in Base.metadata.sorted_tables:
+        reflected = {c["name"]: c["type"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            old = reflected.get(col.name)
+            if (
+                isinstance(col.type, BigInteger)
+                and isinstance(old, Integer)
+                and not isinstance(old, BigInteger)
+            ):
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ALTER COLUMN {col.name} TYPE BIGINT")
+                log.info("Widened %s.%s to BIGINT", table.name, col.name)
+
+
+def ensure_schema(conn: Connection) -> None:
+    """
+    create_all + лёгкая «миграция» для уже существующих таблиц:
+    добавляет недостающие колонки и индексы. Колонки, которые появляются
+    в существующих таблицах, должны быть nullable или иметь server_default.
+    """
+    Base.metadata.create_all(conn)
+
+    insp = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name in existing:
+                continue
+            ddl = CreateColumn(col).compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+        # IF NOT EXISTS, а не checkfirst: индексы по выражениям
+        # (lower(username)) SQLAlchemy не отражает и создавал бы повторно
+        for idx in table.indexes:
+            conn.execute(CreateIndex(idx, if_not_exists=True))
+
+    if conn.dialect.name == "postgresql":
+        _widen_integer_columns(conn, inspect(conn))
@@ -1,18 +1,44 @@
+import os
+from typing import Any, Dict, Optional
+
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
     create_async_engine,
     async_sessionmaker,
 )
-from sqlalchemy.pool import StaticPool
 from app.config import settings
+from app.db.sqlite import install_sqlite_tuning, wal_enabled
 
-# Для SQLite в dev: echo=False, future=True. StaticPool полезен для in-memory,
-# но для файла нам не нужен. Оставим дефолт.
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=False,
-    future=True,
-)
+
+def engine_kwargs(url: str) -> Dict[str, Any]:
+    """Параметры пула и драйвера из настроек — общие для бота и воркеров рассылки."""
+    kwargs: Dict[str, Any] = {"echo": False}
+    u = make_url(url)
+    if u.get_backend_name() == "sqlite":
+        # in-memory SQLite живёт в одном соединении — пул по умолчанию
+        if u.database in (None, "", ":memory:"):
+            return kwargs
+        # файл на локальном диске: ping и recycle не нужны
+        kwargs.update(pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW,
+                      pool_timeout=settings.DB_POOL_TIMEOUT)
+        return kwargs
+
+    kwargs.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+    if u.get_driver_name() == "asyncpg":
+        kwargs["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    return kwargs
+
+
+engine = create_async_engine(settings.DATABASE_URL, **engine_kwargs(settings.DATABASE_URL))
+# WAL, synchronous, busy_timeout, mmap, кеш — на каждом соединении (app/db/sqlite.py)
+install_sqlite_tuning(engine)
 
 # Фабрика сессий
 async_session: async_sessionmaker[AsyncSession] = async_sessionmaker(
@@ -21,6 +47,43 @@ async_session: async_sessionmaker[AsyncSession] = async_sessionmaker(
     expire_on_commit=False,
 )
 
+
+def read_url() -> Optional[str]:
+    """
+    URL читающего движка:
+      - DATABASE_READ_URL (реплика PostgreSQL и т.п.), если задан;
+      - для файла SQLite в WAL — тот же файл только на чтение (mode=ro):
+        в WAL читатели не ждут писателя, а отдельный пул не отнимает
+        соединения у записи постбэков;
+      - иначе None — читаем через основной движок.
+    """
+    if settings.DATABASE_READ_URL:
+        return settings.DATABASE_READ_URL
+    u = make_url(settings.DATABASE_URL)
+    if not settings.DB_READ_ENGINE or u.get_backend_name() != "sqlite" or not wal_enabled():
+        return None
+    if u.database in (None, "", ":memory:") or u.database.startswith("file:"):
+        return None
+    path = os.path.abspath(u.database)
+    return u.set(database=f"file:{path}", query={"mode": "ro", "uri": "true"}).render_as_string(hide_password=False)
+
+
+_read_url = read_url()
+if _read_url:
+    read_engine = create_async_engine(_read_url, **engine_kwargs(_read_url))
+    install_sqlite_tuning(read_engine, read_only=True)
+else:
+    read_engine = engine
+
+# Сессии для тяжёлых чтений админки и аналитики (списки, поиск, статистика,
+# выгрузки, счёт аудитории). Только чтение: реплика может слегка отставать,
+# поэтому то, что читается сразу после своей же записи, идёт через async_session
+async_read_session: async_sessionmaker[AsyncSession] = async_sessionmaker(
+    bind=read_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
 # Удобный dependency-генератор (если понадобится в сервисах/роутерах)
 async def get_session() -> AsyncSession:
     async with async_session() as session:
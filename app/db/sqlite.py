@@ -0,0 +1,111 @@
+# app/db/sqlite.py
+"""
+Профиль производительности SQLite: PRAGMA на каждом новом соединении
+(connect-событие движка) и периодическое обслуживание WAL.
+
+По умолчанию SQLite работает в rollback-журнале с synchronous=FULL и без
+busy_timeout: каждая запись постбэка блокирует читателей, а параллельный
+писатель сразу получает «database is locked». В WAL читатели не ждут
+писателя, synchronous=NORMAL убирает fsync на каждый коммит (в WAL это
+безопасно для целостности, теряются максимум последние транзакции при
+отключении питания), busy_timeout превращает конфликт писателей в ожидание.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import List
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+_MAINTENANCE_KEY = "sqlite:maintenance"
+
+
+def is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def sqlite_pragmas(read_only: bool = False) -> List[str]:
+    """
+    PRAGMA из настроек, в порядке применения. Пустые значения пропускаются.
+    read_only — для соединений читающего движка: журнал задаёт пишущий,
+    а query_only страхует от случайной записи.
+    """
+    pragmas = []
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    else:
+        if settings.SQLITE_JOURNAL_MODE:
+            pragmas.append(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        if settings.SQLITE_SYNCHRONOUS:
+            pragmas.append(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    pragmas.append(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+    pragmas.append(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    # отрицательное значение — размер в КиБ, а не в страницах
+    pragmas.append(f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}")
+    if settings.SQLITE_TEMP_STORE:
+        pragmas.append(f"PRAGMA temp_store={settings.SQLITE_TEMP_STORE}")
+    return pragmas
+
+
+def _apply(dbapi_conn, pragmas: List[str]) -> None:
+    cur = dbapi_conn.cursor()
+    try:
+        for pragma in pragmas:
+            cur.execute(pragma)
+    finally:
+        cur.close()
+
+
+def wal_enabled() -> bool:
+    return settings.SQLITE_TUNING and (settings.SQLITE_JOURNAL_MODE or "").upper() == "WAL"
+
+
+def install_sqlite_tuning(engine: AsyncEngine, read_only: bool = False) -> None:
+    """Вешает PRAGMA на connect. Для не-SQLite движков и при SQLITE_TUNING=false — ничего."""
+    if not is_sqlite(str(engine.url)) or not settings.SQLITE_TUNING:
+        return
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_conn, _record) -> None:
+        # journal_mode нельзя менять внутри транзакции: драйвер её ещё не открыл
+        _apply(dbapi_conn, pragmas)
+
+
+async def run_sqlite_maintenance(engine: AsyncEngine) -> None:
+    """
+    wal_checkpoint(TRUNCATE) — переносит WAL в основной файл и обрезает его,
+    иначе при постоянных читателях WAL растёт; PRAGMA optimize — обновляет
+    статистику планировщика по таблицам, где она устарела.
+    """
+    if not is_sqlite(str(engine.url)):
+        return
+    async with engine.connect() as conn:
+        busy, wal_pages, moved = (await conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))).one()
+        await conn.execute(text("PRAGMA optimize"))
+    if busy:
+        log.info("SQLite checkpoint incomplete: %s/%s WAL pages moved", moved, wal_pages)
+
+
+def schedule_sqlite_maintenance(engine: AsyncEngine) -> None:
+    from app.services.scheduler import scheduler
+
+    if not is_sqlite(str(engine.url)) or settings.SQLITE_MAINTENANCE_INTERVAL <= 0:
+        return
+
+    async def _run_and_reschedule() -> None:
+        try:
+            await run_sqlite_maintenance(engine)
+        except Exception:
+            log.exception("SQLite maintenance failed")
+        finally:
+            schedule_sqlite_maintenance(engine)
+
+    scheduler.add(_MAINTENANCE_KEY, time.time() + settings.SQLITE_MAINTENANCE_INTERVAL, _run_and_reschedule)
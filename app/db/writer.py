@@ -0,0 +1,225 @@
+# app/db/writer.py
+"""
+Единственный писатель для SQLite: все короткие записи бота (постбэки,
+last_bot_message_id, подписка, статусы рассылки и захват её пачек,
+профили, состояние экранов) идут через одну корутину.
+
+SQLite допускает одного писателя на файл. Когда коммитят десятки корутин
+сразу, они соревнуются за блокировку: каждая ждёт busy_timeout, а под
+нагрузкой часть всё равно получает «database is locked». Здесь записи —
+«намерения» (async-функции от сессии) — встают в очередь, писатель
+забирает всё, что накопилось, и проводит одной транзакцией: один flush
+(INSERT-ы пачки уходят executemany) и один COMMIT с fsync на пачку.
+Вызывающий ждёт future своего намерения и получает его результат или
+исключение.
+
+Ошибка одного намерения откатывает пачку, после чего каждое намерение
+переигрывается в своей транзакции: упавшее получает своё исключение,
+остальные пишутся. SAVEPOINT на каждое намерение дал бы ту же изоляцию,
+но это два лишних запроса на запись — в частом случае (ошибок нет) дороже.
+
+Намерение:
+  - только пишет через переданную сессию и возвращает результат;
+    commit/rollback не вызывает — транзакцией управляет писатель.
+    flush — только если нужен id или rowcount до коммита;
+  - не ждёт другие write() (писатель один — будет взаимная блокировка);
+  - может выполниться повторно, поэтому побочные эффекты (сброс кешей,
+    сообщения) — у вызывающего, после await write(...).
+
+Для PostgreSQL очередь не нужна (там построчные блокировки): write()
+просто открывает свою транзакцию. DB_SINGLE_WRITER включает/выключает
+очередь явно. Процессы рассылки (app/broadcast_worker.py) держат по
+своему писателю; между процессами запись по-прежнему разводит busy_timeout.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, List, Optional, TypeVar
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.config import settings
+from app.db.session import async_session
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+Intent = Callable[[AsyncSession], Awaitable[T]]
+
+
+@dataclass
+class _Pending:
+    fn: Intent
+    fut: asyncio.Future
+
+
+async def _run_alone(sessions: async_sessionmaker[AsyncSession], fn: Intent[T]) -> T:
+    async with sessions() as session:
+        async with session.begin():
+            return await fn(session)
+
+
+class Writer:
+    """
+    Очередь намерений и корутина, которая их пишет. Запускается лениво при
+    первом submit() в текущем цикле событий.
+    """
+
+    def __init__(
+        self,
+        sessions: async_sessionmaker[AsyncSession],
+        batch_max: int = 200,
+        coalesce_ms: float = 2.0,
+        queue_max: int = 10_000,
+    ):
+        self._sessions = sessions
+        self.batch_max = max(1, batch_max)
+        self.coalesce = max(0.0, coalesce_ms) / 1000
+        self.queue_max = queue_max
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # для отчёта бенчмарка и логов
+        self.batches = 0
+        self.intents = 0
+
+    def _ensure_started(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            if self._loop is not loop:
+                self._queue = asyncio.Queue(maxsize=self.queue_max)
+            self._loop = loop
+            self._task = loop.create_task(self._run(), name="db-writer")
+        return self._queue
+
+    async def submit(self, fn: Intent[T]) -> T:
+        queue = self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        # полная очередь — естественное backpressure: ждём места
+        await queue.put(_Pending(fn, fut))
+        return await fut
+
+    async def stop(self) -> None:
+        """Дописывает всё, что уже в очереди, и останавливает корутину."""
+        if self._task is None or self._task.done() or self._loop is not asyncio.get_running_loop():
+            return
+        await self._queue.put(None)
+        await self._task
+
+    # ===== корутина писателя =====
+
+    async def _collect(self, first: _Pending) -> tuple[List[_Pending], bool]:
+        """Пачка: всё, что уже ждёт, плюс пришедшее за окно coalesce. True — пришёл стоп."""
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.coalesce
+        while len(batch) < self.batch_max:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self) -> None:
+        queue = self._queue
+        stopping = False
+        try:
+            while not stopping:
+                first = await queue.get()
+                if first is None:
+                    break
+                batch, stopping = await self._collect(first)
+                await self._write_batch(batch)
+            # стоп: дописываем то, что успели поставить до него
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    await self._write_batch([item])
+        finally:
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None and not item.fut.done():
+                    item.fut.set_exception(RuntimeError("db writer stopped"))
+
+    async def _write_batch(self, batch: List[_Pending]) -> None:
+        # вызывающий уже не ждёт (отмена) — не пишем
+        batch = [item for item in batch if not item.fut.done()]
+        if not batch:
+            return
+        if len(batch) == 1:
+            await self._write_alone(batch[0])
+            return
+
+        results: List[Any] = []
+        try:
+            async with self._sessions() as session:
+                async with session.begin():
+                    for item in batch:
+                        results.append(await item.fn(session))
+        except Exception as e:
+            # исключение целиком получит вызывающий упавшего намерения
+            log.warning("db writer: batch of %d failed (%s), retrying one by one", len(batch), type(e).__name__)
+            for item in batch:
+                await self._write_alone(item)
+            return
+
+        self.batches += 1
+        self.intents += len(batch)
+        for item, res in zip(batch, results):
+            if not item.fut.done():
+                item.fut.set_result(res)
+
+    async def _write_alone(self, item: _Pending) -> None:
+        if item.fut.done():
+            return
+        try:
+            res = await _run_alone(self._sessions, item.fn)
+        except Exception as e:
+            if not item.fut.done():
+                item.fut.set_exception(e)
+            return
+        self.batches += 1
+        self.intents += 1
+        if not item.fut.done():
+            item.fut.set_result(res)
+
+
+def single_writer_enabled() -> bool:
+    """DB_SINGLE_WRITER; не задан — включён только для SQLite."""
+    if settings.DB_SINGLE_WRITER is not None:
+        return settings.DB_SINGLE_WRITER
+    return make_url(settings.DATABASE_URL).get_backend_name() == "sqlite"
+
+
+writer = Writer(
+    async_session,
+    batch_max=settings.DB_WRITER_BATCH_MAX,
+    coalesce_ms=settings.DB_WRITER_COALESCE_MS,
+    queue_max=settings.DB_WRITER_QUEUE_MAX,
+)
+
+
+async def write(fn: Intent[T]) -> T:
+    """
+    Выполняет намерение fn(session) в транзакции и возвращает его результат.
+    При включённом едином писателе — через очередь, иначе — в своей сессии.
+    """
+    if single_writer_enabled():
+        return await writer.submit(fn)
+    return await _run_alone(async_session, fn)
+
+
+async def stop_writer() -> None:
+    await writer.stop()
@@ -20,12 +20,34 @@ from aiogram.client.default import DefaultBotProperties
 
 from app.config import settings
 from app.db.session import async_session, engine
-from app.models.base import Base
+from app.db.schema import ensure_database, ensure_schema
+from app.db.sqlite import schedule_sqlite_maintenance
+from app.db.writer import stop_writer
 from app.models.user import User
 from app.services.i18n import load_lang
-from app.services.users import decide_next_step, mark_regular_once_shown, mark_vip_once_shown
+from app.services.users import (
+    decide_next_step,
+    get_or_create_user,
+    mark_once,
+    mark_regular_once_shown,
+    mark_vip_once_shown,
+    set_last_bot_message_id,
+)
 from app.services.subscriptions import verify_and_cache
 from app.services.postbacks import recompute_user_from_postbacks
+from app.services.broadcast import load_schedule, resume_jobs, stop_runners
+from app.services.scheduler import scheduler
+from app.services.stats import (
+    ensure_postback_daily,
+    reconcile_counters,
+    schedule_reconcile,
+    schedule_stats_refresh,
+)
+from app.services.delivery import mark_alive
+from app.services.profiles import ProfileMiddleware, flush_profiles, schedule_profile_flush
+from app.services.ui_state import load_ui_state, schedule_ui_state_purge
+from app.services import ratelimit
+from app import broadcast_worker
 
 # Routers
 from app.routers import common, menu, checks, postbacks
@@ -125,40 +147,13 @@ def t(lang: str, key: str) -> str:
 
 # ==== DB helpers ====
 async def ensure_db():
+    # PostgreSQL: базу создаём сами (SQLite создаёт файл при подключении)
+    await ensure_database(settings.DATABASE_URL)
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-
-async def get_or_create_user(tg_id: int, lang: Optional[str] = None, ref_code: Optional[str] = None) -> User:
-    async with async_session() as session:
-        user = await session.get(User, tg_id)
-        if not user:
-            user = User(id=tg_id)
-            if lang:
-                user.lang = lang
-            if ref_code:
-                user.ref_code = ref_code
-            session.add(user)
-            await session.commit()
-            await session.refresh(user)
-        else:
-            updated = False
-            if lang and user.lang != lang:
-                user.lang = lang
-                updated = True
-            if ref_code and not user.ref_code:
-                user.ref_code = ref_code
-                updated = True
-            if updated:
-                await session.commit()
-        return user
+        await conn.run_sync(ensure_schema)
 
 async def update_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        user = await session.get(User, tg_id)
-        if not user:
-            return
-        user.last_bot_message_id = message_id
-        await session.commit()
+    await set_last_bot_message_id(tg_id, message_id)
 
 # ==== Keyboards ====
 def kb_language() -> InlineKeyboardMarkup:
@@ -216,6 +211,8 @@ async def cmd_start(message: Message):
             ref_code = parts[1].strip() or None
 
     user = await get_or_create_user(message.from_user.id, ref_code=ref_code)
+    # /start после блокировки — чат снова доступен для рассылок
+    await mark_alive(message.from_user.id)
 
     if user.lang:
         await menu.render_main_menu(message, user.lang, vip=user.has_vip)
@@ -261,66 +258,59 @@ async def on_language_pick(call: CallbackQuery):
 @router.callback_query(F.data == "menu:get")
 async def menu_get(call: CallbackQuery):
     from app.routers import checks  # локальный импорт
-    async with async_session() as session:
-        user: User = await session.get(User, call.from_user.id)
-        if not user:
-            user = User(id=call.from_user.id)
-            session.add(user)
-            await session.commit()
-            await session.refresh(user)
-
-        if settings.REQUIRE_SUBSCRIPTION:
-            channel_id = settings.sub_channel_id()
-            try:
-                await verify_and_cache(call.message.bot, call.from_user.id, channel_id)
-            except Exception:
-                pass
+    await get_or_create_user(call.from_user.id)
 
+    if settings.REQUIRE_SUBSCRIPTION:
+        channel_id = settings.sub_channel_id()
         try:
-            await recompute_user_from_postbacks(call.from_user.id)
+            await verify_and_cache(call.message.bot, call.from_user.id, channel_id)
         except Exception:
             pass
 
-        await session.flush()
+    try:
+        await recompute_user_from_postbacks(call.from_user.id)
+    except Exception:
+        pass
+
+    # подписка и пересчёт писали через единого писателя — читаем итог
+    async with async_session() as session:
         user = await session.get(User, call.from_user.id)
 
-        decision = decide_next_step(user)
-        lang = user.lang if user.lang in SUPPORTED_LANGS else "en"
+    decision = decide_next_step(user)
+    lang = user.lang if user.lang in SUPPORTED_LANGS else "en"
 
-        if decision.step == "subscription":
-            await call.answer()
-            await checks.show_subscription(call)
-            return
-        if decision.step == "registration":
-            await call.answer()
-            await checks.show_registration(call)
-            return
-        if decision.step == "deposit":
-            await call.answer()
-            await checks.show_deposit(call)
-            return
-        if decision.step == "vip_once":
-            mark_vip_once_shown(user)
-            await session.commit()
-            await call.answer()
-            await checks.show_vip_access(call)
-            return
-        if decision.step == "access_ok_once":
-            mark_regular_once_shown(user)
-            await session.commit()
-            await call.answer()
-            await checks.show_access_ok(call)
-            return
+    if decision.step == "subscription":
+        await call.answer()
+        await checks.show_subscription(call)
+        return
+    if decision.step == "registration":
+        await call.answer()
+        await checks.show_registration(call)
+        return
+    if decision.step == "deposit":
+        await call.answer()
+        await checks.show_deposit(call)
+        return
+    if decision.step == "vip_once":
+        await mark_once(call.from_user.id, mark_vip_once_shown)
+        await call.answer()
+        await checks.show_vip_access(call)
+        return
+    if decision.step == "access_ok_once":
+        await mark_once(call.from_user.id, mark_regular_once_shown)
+        await call.answer()
+        await checks.show_access_ok(call)
+        return
 
-        # === ВАЖНО: вместо отправки второго меню — рисуем сразу красивое главное меню ===
-        if decision.step in ("open_vip", "open_regular"):
-            await call.answer()
-            await menu.render_main_menu(
-                call.message,
-                lang,
-                vip=(decision.step == "open_vip")
-            )
-            return
+    # === ВАЖНО: вместо отправки второго меню — рисуем сразу красивое главное меню ===
+    if decision.step in ("open_vip", "open_regular"):
+        await call.answer()
+        await menu.render_main_menu(
+            call.message,
+            lang,
+            vip=(decision.step == "open_vip")
+        )
+        return
 
     await call.answer("Попробуйте ещё раз.", show_alert=False)
 
@@ -328,11 +318,21 @@ async def menu_get(call: CallbackQuery):
 async def main():
     logging.basicConfig(level=logging.INFO)
     await ensure_db()
+    # срез постбэков по дням: разовое заполнение из истории
+    await ensure_postback_daily()
+    # фильтры/курсоры/ожидание ввода в админке — с прошлого запуска
+    await load_ui_state()
 
     bot = Bot(
         token=settings.BOT_TOKEN,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
+    # Все исходящие сообщения идут через общий лимитер; если рассылки ведут
+    # отдельные процессы, боту остаётся только интерактивная доля бюджета
+    if settings.BROADCAST_WORKER_PROCESSES > 0:
+        ratelimit.install(bot, global_rate=settings.BROADCAST_INTERACTIVE_RATE)
+    else:
+        ratelimit.install(bot)
     dp = Dispatcher(storage=MemoryStorage())
 
     from aiogram import types
@@ -342,8 +342,29 @@ async def main():
             logging.info("MSG: %r", event.text)
         return await handler(event, data)
 
+    # username / имя / last_seen_at — в память, в БД пачками по расписанию
+    dp.update.outer_middleware(ProfileMiddleware())
+
     asyncio.create_task(start_postback_server(bot))
 
+    # Незавершённые рассылки продолжаем с последней отметки
+    await resume_jobs(bot)
+    workers: Optional[asyncio.Task] = None
+    if settings.BROADCAST_WORKER_PROCESSES > 0:
+        workers = asyncio.create_task(broadcast_worker.supervise(settings.BROADCAST_WORKER_PROCESSES))
+
+    # Отложенные рассылки
+    asyncio.create_task(scheduler.run())
+    await load_schedule(bot)
+
+    # Счётчики админки: сверка на старте и затем по расписанию
+    await reconcile_counters()
+    schedule_reconcile()
+    schedule_stats_refresh()
+    schedule_profile_flush()
+    schedule_ui_state_purge()
+    schedule_sqlite_maintenance(engine)
+
     dp.include_router(router)
     dp.include_router(common.router)
     dp.include_router(menu.router)
@@ -351,7 +372,18 @@ async def main():
     dp.include_router(admin_main.router)
     dp.include_router(postbacks.router)
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # воркеры рассылок живут, пока жив бот
+        if workers is not None:
+            workers.cancel()
+            await asyncio.gather(workers, return_exceptions=True)
+        # раннеры этого процесса закрывают пачки через писателя — до его остановки
+        await stop_runners()
+        await flush_profiles()
+        # дописать всё, что стоит в очереди единого писателя
+        await stop_writer()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, String, UniqueConstraint, false
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class BroadcastJob(Base):
+    """
+    Рассылка как долговременная задача: сегмент, контент и прогресс живут в БД,
+    поэтому после рестарта раннер продолжает с того же места.
+    """
+    __tablename__ = "broadcast_jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+
+    # 'scheduled' | 'running' | 'paused' | 'cancelled' | 'done'
+    status: Mapped[str] = mapped_column(String(16), default="running")
+
+    # Кто запустил и где рисовать прогресс
+    created_by: Mapped[int] = mapped_column(BigInteger)
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # Сегмент (JSON, см. Segment.to_json)
+    segment: Mapped[str] = mapped_column(String, default="{}")
+
+    # Контент
+    text: Mapped[str] = mapped_column(String)
+    media: Mapped[Optional[str]] = mapped_column(String(256), nullable=True)
+    btn_text: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    btn_url: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+
+    # 'copy' — сообщение один раз публикуется в служебный чат и раздаётся copy_message;
+    # 'direct' — send_message/send_photo каждому (file_id картинки переиспользуется)
+    mode: Mapped[str] = mapped_column(String(8), default="direct", server_default="direct")
+    source_chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    source_message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # Счётчики
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent_ok: Mapped[int] = mapped_column(Integer, default=0)
+    sent_fail: Mapped[int] = mapped_column(Integer, default=0)
+
+    # Аудитория материализуется в доставки постепенно, по возрастанию users.id:
+    # cursor — последний добавленный id, done — сегмент пройден до конца
+    audience_cursor: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    audience_done: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+
+    # Отложенный запуск (UTC) и повтор: после запуска создаётся следующая задача
+    scheduled_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    repeat_every_sec: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+
+class BroadcastDelivery(Base):
+    """
+    Статус доставки одному получателю. Одна строка на (job, user) —
+    повторный запуск не может отправить одному и тому же пользователю дважды.
+    """
+    __tablename__ = "broadcast_deliveries"
+    __table_args__ = (UniqueConstraint("job_id", "user_id", name="uq_broadcast_deliveries_job_user"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    job_id: Mapped[int] = mapped_column(ForeignKey("broadcast_jobs.id", ondelete="CASCADE"))
+    user_id: Mapped[int] = mapped_column(BigInteger)
+
+    # 'pending' | 'sending' | 'sent' | 'failed'
+    status: Mapped[str] = mapped_column(String(16), default="pending")
+    error: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # Метка захвата "<процесс>:<пачка>" — какой процесс сейчас шлёт эту строку
+    claim: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# Раннер выбирает «следующую пачку pending» по (job_id, status, id)
+Index("ix_broadcast_deliveries_job_status", BroadcastDelivery.job_id, BroadcastDelivery.status, BroadcastDelivery.id)
+Index("ix_broadcast_deliveries_claim", BroadcastDelivery.claim)
+Index("ix_broadcast_jobs_status", BroadcastJob.status)
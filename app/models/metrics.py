@@ -0,0 +1,19 @@
+from datetime import datetime
+
+from sqlalchemy import DateTime, Float, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class MetricCounter(Base):
+    """
+    Готовые значения метрик для админки (всего, рег, доступ, VIP, ...).
+    Меняются инкрементально вместе с пользователями, периодически
+    сверяются с таблицей users (см. app/services/stats.py).
+    """
+    __tablename__ = "metrics_counters"
+
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)
+    value: Mapped[float] = mapped_column(Float, default=0.0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -1,6 +1,7 @@
+from datetime import date
 from typing import Optional
 
-from sqlalchemy import BigInteger, Float, Index, String
+from sqlalchemy import BigInteger, Date, Float, Index, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column
 
 from .base import Base
@@ -17,6 +18,10 @@ class Postback(Base):
     # Связка с пользователем (если известен)
     tg_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
 
+    # Идентификаторы партнёрки как пришли в постбэке — для фильтров в админке
+    trader_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    click_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+
     # Внешний идентификатор (если постбэк шлёт не tg_id)
     external_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
 
@@ -33,7 +38,24 @@ class Postback(Base):
     hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, unique=True)
 
 
-# Индексы для быстрого поиска
-Index("ix_postbacks_event", Postback.event)
+# Индексы для быстрого поиска. Составные (колонка, id) отдают ленту
+# админки по фильтру уже в порядке id — keyset без сортировки
+Index("ix_postbacks_event_id", Postback.event, Postback.id)
 Index("ix_postbacks_tg_id", Postback.tg_id)
+Index("ix_postbacks_trader_id_id", Postback.trader_id, Postback.id)
+Index("ix_postbacks_click_id_id", Postback.click_id, Postback.id)
 Index("ix_postbacks_ts", Postback.ts)
+
+
+class PostbackDaily(Base):
+    """
+    Дневной срез постбэков: (день UTC, событие) -> количество и сумма.
+    Пополняется при вставке постбэка; статистика за любой период читает
+    отсюда не больше (дней × событий) строк.
+    """
+    __tablename__ = "postback_daily"
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    event: Mapped[str] = mapped_column(String(32), primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, default=0)
+    amount_sum: Mapped[float] = mapped_column(Float, default=0.0)
@@ -0,0 +1,19 @@
+from sqlalchemy import BigInteger, String, Text
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class UiState(Base):
+    """
+    Состояние экранов админки (фильтры, курсоры, ожидание ввода), чтобы оно
+    переживало перезапуск. Основная копия — в памяти (app/services/ui_state.py),
+    здесь — запись «насквозь» и загрузка на старте.
+    """
+    __tablename__ = "ui_state"
+
+    namespace: Mapped[str] = mapped_column(String(32), primary_key=True)
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    value: Mapped[str] = mapped_column(Text)
+    # unix; просроченные строки не загружаются и удаляются при чистке
+    expires_at: Mapped[int] = mapped_column(BigInteger, index=True)
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from datetime import datetime
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import String, Integer, Float, Boolean, DateTime
+from sqlalchemy import BigInteger, String, Integer, Float, Boolean, DateTime, Index, func
 
 from .base import Base
 
@@ -10,7 +10,9 @@ from .base import Base
 class User(Base):
     __tablename__ = "users"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Telegram id не влезает в 32 бита. В SQLite оставляем INTEGER PRIMARY KEY
+    # (он и так 64-битный и служит rowid), в PostgreSQL — BIGINT
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
 
     # Профиль/настройки
     lang: Mapped[str | None] = mapped_column(String(8), nullable=True)
@@ -26,6 +28,11 @@ class User(Base):
     shown_regular_access_once: Mapped[bool] = mapped_column(Boolean, default=False)
     shown_vip_access_once: Mapped[bool] = mapped_column(Boolean, default=False)
 
+    # Профиль из апдейтов (services/profiles.py, пишется пачками)
+    username: Mapped[str | None] = mapped_column(String(32), nullable=True)
+    first_name: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    last_seen_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
     # UI
     last_bot_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
@@ -33,6 +40,10 @@ class User(Base):
     click_id: Mapped[str | None] = mapped_column(String(64), unique=True, index=True, nullable=True)
     partner_trader_id: Mapped[str | None] = mapped_column(String(64), unique=True, index=True, nullable=True)
 
+    # Доставка: None — чат жив; 'blocked' | 'deactivated' | 'not_found' | 'forbidden' — не слать
+    delivery_status: Mapped[str | None] = mapped_column(String(16), nullable=True)
+    blocked_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
     # Служебное
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -41,3 +52,11 @@ class User(Base):
         return (f"<User id={self.id} reg={self.is_registered} dep={self.deposit_total_usd} vip={self.has_vip} "
                 f"click={self.click_id} trader={self.partner_trader_id} "
                 f"shown_ok={self.shown_regular_access_once} shown_vip={self.shown_vip_access_once}>")
+
+
+# Сегменты по умолчанию отсекают мёртвые чаты (delivery_status IS NULL)
+Index("ix_users_delivery_status", User.delivery_status)
+# Keyset-пагинация списка в админке: ORDER BY created_at DESC, id DESC
+Index("ix_users_created_at_id", User.created_at, User.id)
+# Поиск по @username в админке без учёта регистра: WHERE lower(username) = ...
+Index("ix_users_username_lower", func.lower(User.username))
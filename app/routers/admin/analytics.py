@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from aiogram import Router, F
+from aiogram.types import (
+    CallbackQuery,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+)
+
+from app.config import settings
+from app.services.analytics import FUNNEL_STEPS, Cohorts, Funnel, build_report
+from app.services.stats import stats_cache
+from app.routers.admin.window import render_one as _render_one
+
+router = Router(name=__name__)
+
+WEEK_CHOICES = (4, 8, 12)
+
+FUNNEL_LABELS = {
+    "start": "Старт",
+    "lang": "Выбрали язык",
+    "registration": "Регистрация",
+    "access": "Доступ (ACCESS)",
+    "vip": "VIP",
+}
+
+
+# ===== keyboards =====
+
+def kb_analytics(weeks: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=("• " if w == weeks else "") + f"{w} нед.", callback_data=f"aan:weeks:{w}")
+            for w in WEEK_CHOICES
+        ],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")],
+    ])
+
+
+# ===== rendering =====
+
+def _fmt_funnel(f: Funnel) -> str:
+    lines = ["<b>Воронка</b>"]
+    start = f.counts[0]
+    for i, step in enumerate(FUNNEL_STEPS):
+        n = f.counts[i]
+        share = f" • {n / start:.0%} от старта" if i and start else ""
+        step_conv = f" • {f.conversion(i):.0%} шага" if i else ""
+        lines.append(f"{FUNNEL_LABELS[step]}: <b>{n}</b>{step_conv}{share}")
+    return "\n".join(lines)
+
+
+def _fmt_cohorts(c: Cohorts) -> str:
+    if not c.weeks:
+        return "<b>Когорты</b>\nНет данных."
+    weeks = len(c.weeks)
+    head = "Неделя  Кол-во " + " ".join(f"W{k:<3}" for k in range(weeks))
+    rows = [head]
+    for week, size, ret in zip(c.weeks, c.sizes, c.retention):
+        cells = " ".join("    " if v is None else f"{v * 100:>3.0f}%" for v in ret)
+        rows.append(f"{week:%d.%m}   {size:>6} {cells}")
+    return (
+        "<b>Когорты по неделям прихода</b>\n"
+        "Доля когорты с постбэком на k-й неделе после прихода\n"
+        f"<pre>{chr(10).join(rows)}</pre>"
+    )
+
+
+async def _analytics_text(weeks: int) -> str:
+    funnel, cohorts = await build_report(weeks)
+    return (
+        "<b>📈 Аналитика</b>\n\n"
+        f"{_fmt_funnel(funnel)}\n\n"
+        f"{_fmt_cohorts(cohorts)}"
+    )
+
+
+async def _cached_text(weeks: int) -> str:
+    text, built_at = await stats_cache.get(("analytics", weeks), lambda: _analytics_text(weeks))
+    at = datetime.fromtimestamp(built_at, tz=timezone.utc).strftime("%H:%M:%S")
+    return text + f"\n<i>Обновлено: {at} UTC</i>"
+
+
+# ===== callbacks =====
+
+@router.callback_query(F.data == "admin:analytics")
+async def open_analytics(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    await call.answer()
+    await _render_one(call, await _cached_text(8), kb_analytics(8))
+
+
+@router.callback_query(F.data.startswith("aan:weeks:"))
+async def analytics_weeks(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    try:
+        weeks = int(call.data.split(":")[2])
+    except Exception:
+        weeks = 8
+    if weeks not in WEEK_CHOICES:
+        weeks = 8
+    await call.answer()
+    await _render_one(call, await _cached_text(weeks), kb_analytics(weeks))
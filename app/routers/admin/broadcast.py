@@ -1,7 +1,7 @@
 from __future__ import annotations
 
-import asyncio
-from dataclasses import dataclass, field
+import re
+from datetime import datetime
 from typing import Optional, List
 
 from aiogram import Router, F
@@ -14,39 +14,17 @@ from aiogram.types import (
     Message,
 )
 
-from sqlalchemy import select, and_, or_, func
-
 from app.config import settings
-from app.db.session import async_session
-from app.models.user import User
+from app.services import broadcast as bc_service
+from app.services.broadcast import user_button_markup
+from app.services.segments import Segment, count_audience
+from app.routers.admin.window import render_one as _render_one
 
 router = Router(name=__name__)
 
 SUPPORTED_LANGS = ("ru", "en", "es", "uk")
 
 
-# ========= Модель сегмента =========
-
-@dataclass
-class Segment:
-    langs: set[str] = field(default_factory=set)          # пусто = все языки
-    registered: Optional[bool] = None                    # None=все
-    access_ok: Optional[bool] = None                     # None=все; True — >=ACCESS (или депозит выключен)
-    vip: Optional[bool] = None                           # None=все
-    subscribed: Optional[bool] = None                    # None=все
-
-    def pretty(self) -> str:
-        def s3(v, yes="да", no="нет"):
-            return "любой" if v is None else (yes if v else no)
-        parts: List[str] = []
-        parts.append(f"языки: {','.join(sorted(self.langs)) if self.langs else 'все'}")
-        parts.append(f"регистрация: {s3(self.registered)}")
-        parts.append(f"доступ: {s3(self.access_ok)}")
-        parts.append(f"VIP: {s3(self.vip)}")
-        parts.append(f"подписка: {s3(self.subscribed)}")
-        return "; ".join(parts)
-
-
 # ========= Состояния =========
 
 class BC(StatesGroup):
@@ -55,50 +33,12 @@ class BC(StatesGroup):
     waiting_media = State()
     waiting_button = State()
     confirming = State()
+    waiting_schedule = State()
     broadcasting = State()
 
 
 # ========= Общее: один экран без спама =========
 
-async def _set_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        u = await session.get(User, tg_id)
-        if not u:
-            u = User(id=tg_id)
-            session.add(u)
-            await session.flush()
-        u.last_bot_message_id = message_id
-        await session.commit()
-
-
-async def _render_one(ctx, text: str, kb: InlineKeyboardMarkup, disable_preview: bool = True):
-    if isinstance(ctx, Message):
-        chat_id = ctx.chat.id
-        user_id = ctx.from_user.id
-        bot = ctx.bot
-        send = ctx.answer
-    else:
-        chat_id = ctx.message.chat.id
-        user_id = ctx.from_user.id
-        bot = ctx.message.bot
-        send = ctx.message.answer
-
-    # удалить прошлый экран
-    last_id = None
-    async with async_session() as session:
-        u = await session.get(User, user_id)
-        if u:
-            last_id = u.last_bot_message_id
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
-
-    sent = await send(text, reply_markup=kb, disable_web_page_preview=disable_preview)
-    await _set_last_bot_message_id(user_id, sent.message_id)
-
-
 # ========= Клавиатуры =========
 
 def _chip(active: bool, label: str, cb: str) -> InlineKeyboardButton:
@@ -117,7 +57,9 @@ def kb_segment(seg: Segment) -> InlineKeyboardMarkup:
     [ES][UK]
     [📝 Рег: ?][🔓 Доступ: ?]
     [👑 VIP: ?][📫 Подписка: ?]
+    [🚫 Заблокировавшие: пропускать/включены]
     [➡️ Дальше → Текст]
+    [📋 Рассылки]
     [⬅️ Назад]
     """
     rows: List[List[InlineKeyboardButton]] = []
@@ -137,8 +79,13 @@ def kb_segment(seg: Segment) -> InlineKeyboardMarkup:
         InlineKeyboardButton(text=f"👑 VIP: {_tri(seg.vip)}", callback_data="bc:cycle:vip"),
         InlineKeyboardButton(text=f"📫 Подписка: {_tri(seg.subscribed)}", callback_data="bc:cycle:subs"),
     ])
+    rows.append([InlineKeyboardButton(
+        text=f"🚫 Заблокировавшие: {'включены' if seg.include_dead else 'пропускать'}",
+        callback_data="bc:toggle:dead",
+    )])
 
     rows.append([InlineKeyboardButton(text="➡️ Дальше → Текст", callback_data="bc:next:text")])
+    rows.append([InlineKeyboardButton(text="📋 Рассылки", callback_data="bc:jobs")])
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -169,6 +116,7 @@ def kb_button_stage() -> InlineKeyboardMarkup:
 def kb_preview() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Отправить", callback_data="bc:send")],
+        [InlineKeyboardButton(text="🕒 Запланировать", callback_data="bc:schedule")],
         [InlineKeyboardButton(text="✏️ Текст", callback_data="bc:edit:text")],
         [InlineKeyboardButton(text="🖼 Картинка", callback_data="bc:add:media")],
         [InlineKeyboardButton(text="🔘 Кнопка", callback_data="bc:add:button")],
@@ -176,15 +124,9 @@ def kb_preview() -> InlineKeyboardMarkup:
     ])
 
 
-def _kb_user_button(text: Optional[str], url: Optional[str]) -> Optional[InlineKeyboardMarkup]:
-    if not (text and url):
-        return None
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=text, url=url)]])
-
-
 # ========= Утилиты сегмента =========
 
-def _fmt_segment(seg: Segment) -> str:
+def _fmt_segment(seg: Segment, n: int) -> str:
     def label(v):
         return "любой" if v is None else ("✅ да" if v else "❌ нет")
     langs = (",".join(sorted(seg.langs)) if seg.langs else "все")
@@ -194,94 +136,17 @@ def _fmt_segment(seg: Segment) -> str:
         f"📝 Регистрация: <b>{label(seg.registered)}</b>\n"
         f"🔓 Доступ: <b>{label(seg.access_ok)}</b>\n"
         f"👑 VIP: <b>{label(seg.vip)}</b>\n"
-        f"📫 Подписка: <b>{label(seg.subscribed)}</b>\n\n"
+        f"📫 Подписка: <b>{label(seg.subscribed)}</b>\n"
+        f"🚫 Заблокировавшие бота: <b>{'включены' if seg.include_dead else 'пропускаем'}</b>\n\n"
+        f"👥 Аудитория: <b>{n}</b>\n\n"
         "Выбери фильтры и нажми «Дальше → Текст»."
     )
 
 
-async def _count_audience(seg: Segment) -> int:
-    async with async_session() as session:
-        q = select(func.count()).select_from(User)
-        exprs = []
-
-        if seg.langs:
-            exprs.append(User.lang.in_(list(seg.langs)))
-
-        if seg.registered is True:
-            exprs.append(User.is_registered.is_(True))
-        elif seg.registered is False:
-            exprs.append(or_(User.is_registered.is_(False), User.is_registered.is_(None)))
-
-        if seg.access_ok is True:
-            if settings.REQUIRE_DEPOSIT:
-                exprs.append(User.deposit_total_usd >= settings.ACCESS_THRESHOLD_USD)
-        elif seg.access_ok is False:
-            if settings.REQUIRE_DEPOSIT:
-                exprs.append(or_(User.deposit_total_usd < settings.ACCESS_THRESHOLD_USD,
-                                 User.deposit_total_usd.is_(None)))
-            else:
-                exprs.append(func.false())
-
-        if seg.vip is True:
-            exprs.append(or_(User.deposit_total_usd >= settings.VIP_THRESHOLD_USD, User.has_vip.is_(True)))
-        elif seg.vip is False:
-            exprs.append(and_(
-                or_(User.deposit_total_usd < settings.VIP_THRESHOLD_USD, User.deposit_total_usd.is_(None)),
-                or_(User.has_vip.is_(False), User.has_vip.is_(None)),
-            ))
-
-        if seg.subscribed is True:
-            exprs.append(User.is_subscribed.is_(True))
-        elif seg.subscribed is False:
-            exprs.append(or_(User.is_subscribed.is_(False), User.is_subscribed.is_(None)))
-
-        if exprs:
-            q = q.where(and_(*exprs))
-
-        return (await session.execute(q)).scalar_one()
-
-
-async def _list_audience(seg: Segment) -> List[int]:
-    async with async_session() as session:
-        q = select(User.id)
-        exprs = []
-
-        if seg.langs:
-            exprs.append(User.lang.in_(list(seg.langs)))
-
-        if seg.registered is True:
-            exprs.append(User.is_registered.is_(True))
-        elif seg.registered is False:
-            exprs.append(or_(User.is_registered.is_(False), User.is_registered.is_(None)))
-
-        if seg.access_ok is True:
-            if settings.REQUIRE_DEPOSIT:
-                exprs.append(User.deposit_total_usd >= settings.ACCESS_THRESHOLD_USD)
-        elif seg.access_ok is False:
-            if settings.REQUIRE_DEPOSIT:
-                exprs.append(or_(User.deposit_total_usd < settings.ACCESS_THRESHOLD_USD,
-                                 User.deposit_total_usd.is_(None)))
-            else:
-                exprs.append(func.false())
-
-        if seg.vip is True:
-            exprs.append(or_(User.deposit_total_usd >= settings.VIP_THRESHOLD_USD, User.has_vip.is_(True)))
-        elif seg.vip is False:
-            exprs.append(and_(
-                or_(User.deposit_total_usd < settings.VIP_THRESHOLD_USD, User.deposit_total_usd.is_(None)),
-                or_(User.has_vip.is_(False), User.has_vip.is_(None)),
-            ))
-
-        if seg.subscribed is True:
-            exprs.append(User.is_subscribed.is_(True))
-        elif seg.subscribed is False:
-            exprs.append(or_(User.is_subscribed.is_(False), User.is_subscribed.is_(None)))
-
-        if exprs:
-            q = q.where(and_(*exprs))
-
-        ids = [x[0] for x in (await session.execute(q)).all()]
-        return ids
+async def _render_segment(ctx, seg: Segment):
+    # счётчик берётся из кеша count_audience, переключение фильтров не гоняет COUNT заново
+    n = await count_audience(seg)
+    await _render_one(ctx, _fmt_segment(seg, n), kb_segment(seg))
 
 
 # ========= Вход и выбор сегмента =========
@@ -296,7 +161,7 @@ async def enter_broadcast(call: CallbackQuery, state: FSMContext):
     await state.update_data(seg=seg, text=None, media=None, btn_text=None, btn_url=None)
     await state.set_state(BC.picking_segment)
     await call.answer()
-    await _render_one(call, _fmt_segment(seg), kb_segment(seg))
+    await _render_segment(call, seg)
 
 
 @router.callback_query(F.data.startswith("bc:lang:"))
@@ -310,7 +175,7 @@ async def toggle_lang(call: CallbackQuery, state: FSMContext):
         seg.langs.add(code)
     await state.update_data(seg=seg)
     await call.answer()
-    await _render_one(call, _fmt_segment(seg), kb_segment(seg))
+    await _render_segment(call, seg)
 
 
 @router.callback_query(F.data.startswith("bc:cycle:"))
@@ -336,14 +201,24 @@ async def cycle_filter(call: CallbackQuery, state: FSMContext):
 
     await state.update_data(seg=seg)
     await call.answer()
-    await _render_one(call, _fmt_segment(seg), kb_segment(seg))
+    await _render_segment(call, seg)
+
+
+@router.callback_query(F.data == "bc:toggle:dead")
+async def toggle_dead(call: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    seg: Segment = data.get("seg") or Segment()
+    seg.include_dead = not seg.include_dead
+    await state.update_data(seg=seg)
+    await call.answer()
+    await _render_segment(call, seg)
 
 
 @router.callback_query(F.data == "bc:next:text")
 async def proceed_to_text(call: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     seg: Segment = data.get("seg") or Segment()
-    n = await _count_audience(seg)
+    n = await count_audience(seg)
     await state.set_state(BC.waiting_text)
     await call.answer()
     await _render_one(
@@ -447,7 +322,7 @@ async def back_to_segment(call: CallbackQuery, state: FSMContext):
     seg: Segment = data.get("seg") or Segment()
     await state.set_state(BC.picking_segment)
     await call.answer()
-    await _render_one(call, _fmt_segment(seg), kb_segment(seg))
+    await _render_segment(call, seg)
 
 
 @router.callback_query(F.data == "bc:next:preview")
@@ -463,7 +338,7 @@ async def do_preview(call: CallbackQuery, state: FSMContext):
         await call.answer("Сначала введи текст.", show_alert=True)
         return
 
-    n = await _count_audience(seg)
+    n = await count_audience(seg)
     await state.set_state(BC.confirming)
 
     info = (
@@ -475,7 +350,7 @@ async def do_preview(call: CallbackQuery, state: FSMContext):
     )
     await _render_one(call, info, kb_preview())
 
-    markup = _kb_user_button(btxt, burl)
+    markup = user_button_markup(btxt, burl)
     if media:
         await call.message.answer_photo(media, caption=txt, reply_markup=markup)
     else:
@@ -484,22 +359,6 @@ async def do_preview(call: CallbackQuery, state: FSMContext):
 
 # ========= Отправка =========
 
-async def _send_to_user(bot, uid: int, txt: str, media: Optional[str], btn_text: Optional[str], btn_url: Optional[str]) -> bool:
-    try:
-        markup = _kb_user_button(btn_text, btn_url)
-        if media:
-            await bot.send_photo(uid, media, caption=txt, reply_markup=markup)
-        else:
-            await bot.send_message(uid, txt, reply_markup=markup)
-        return True
-    except Exception:
-        return False
-
-
-async def _list_ids(seg: Segment) -> List[int]:
-    return await _list_audience(seg)
-
-
 @router.callback_query(F.data == "bc:send")
 async def start_broadcast(call: CallbackQuery, state: FSMContext):
     if call.from_user.id != settings.ADMIN_ID:
@@ -517,42 +376,182 @@ async def start_broadcast(call: CallbackQuery, state: FSMContext):
         await call.answer("Нет текста.", show_alert=True)
         return
 
-    ids = await _list_ids(seg)
-    total = len(ids)
-    if total == 0:
+    n = await count_audience(seg)
+    if n == 0:
         await call.answer("Аудитория пуста.", show_alert=True)
         return
 
+    # Задача и доставки пишутся в БД — дальше работает фоновый раннер
+    job_id = await bc_service.create_job(
+        admin_id=call.from_user.id,
+        admin_chat_id=call.message.chat.id,
+        seg=seg,
+        text=txt,
+        media=media,
+        btn_text=btn_text,
+        btn_url=btn_url,
+        total=n,
+    )
+    await state.clear()
     await call.answer("Старт.", show_alert=False)
-    await _render_one(call, f"Отправляем {total} пользователям…", InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏳ Идёт отправка…", callback_data="admin:back")]
-    ]))
-
-    sent = 0
-    ok = 0
-    batch = 25
-    pause = 1.0
-
-    for i in range(0, total, batch):
-        chunk = ids[i:i + batch]
-        results = await asyncio.gather(*[
-            _send_to_user(call.message.bot, uid, txt, media, btn_text, btn_url) for uid in chunk
-        ], return_exceptions=True)
-        ok += sum(1 for r in results if r is True)
-        sent += len(chunk)
-        try:
-            await call.message.edit_text(
-                f"Рассылка… {sent}/{total}\nУспешно: {ok}\nНе доставлено: {sent - ok}",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⏳ Идёт отправка…", callback_data="admin:back")]
-                ]),
-                disable_web_page_preview=True
-            )
-        except Exception:
-            pass
-        await asyncio.sleep(pause)
 
+    # Исходник для copy_message: служебный чат или чат админа
+    staging_chat_id = settings.BROADCAST_STAGING_CHAT_ID or call.message.chat.id
+    await bc_service.stage_job(call.message.bot, job_id, staging_chat_id)
+
+    job = await bc_service.get_job(job_id)
+    sent = await _render_one(call, bc_service.format_job(job), bc_service.kb_job(job))
+    await bc_service.set_progress_message(job_id, sent.message_id)
+    bc_service.start_job(call.message.bot, job_id)
+
+
+# ========= Отложенный запуск =========
+
+_SCHEDULE_RE = re.compile(
+    r"^(\d{4}-\d{2}-\d{2})[ T](\d{1,2}:\d{2})"
+    r"(?:\s+(?:каждые|every)\s+(\d+)\s*(мин|m|ч|h|д|d))?\s*$",
+    re.IGNORECASE,
+)
+_PERIOD_SEC = {"мин": 60, "m": 60, "ч": 3600, "h": 3600, "д": 86400, "d": 86400}
+
+
+def _parse_schedule(raw: str) -> Optional[tuple[datetime, Optional[int]]]:
+    m = _SCHEDULE_RE.match(raw.strip())
+    if not m:
+        return None
+    try:
+        at = datetime.strptime(f"{m.group(1)} {m.group(2)}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+    every = None
+    if m.group(3):
+        every = int(m.group(3)) * _PERIOD_SEC[m.group(4).lower()]
+        if every <= 0:
+            return None
+    return at, every
+
+
+@router.callback_query(F.data == "bc:schedule")
+async def ask_schedule(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    data = await state.get_data()
+    if not data.get("text"):
+        await call.answer("Сначала введи текст.", show_alert=True)
+        return
+    await state.set_state(BC.waiting_schedule)
+    await call.answer()
+    await _render_one(
+        call,
+        "Пришли время запуска в <b>UTC</b>:\n<code>2026-01-31 18:00</code>\n\n"
+        "Повтор (опционально):\n<code>2026-01-31 18:00 каждые 24ч</code> • <code>… каждые 7д</code>",
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад к предпросмотру", callback_data="bc:next:preview")],
+        ]),
+    )
+
+
+@router.message(BC.waiting_schedule)
+async def input_schedule(m: Message, state: FSMContext):
+    if m.from_user.id != settings.ADMIN_ID:
+        return
+    parsed = _parse_schedule(m.text or "")
+    if not parsed:
+        await m.answer("Не понял время. Формат: <code>2026-01-31 18:00</code> или <code>… каждые 24ч</code>")
+        return
+    at, every = parsed
+    if at <= datetime.utcnow():
+        await m.answer("Время уже прошло (UTC). Пришли время в будущем.")
+        return
+
+    data = await state.get_data()
+    seg: Segment = data.get("seg") or Segment()
+    job_id = await bc_service.create_job(
+        admin_id=m.from_user.id,
+        admin_chat_id=m.chat.id,
+        seg=seg,
+        text=data.get("text") or "",
+        media=data.get("media"),
+        btn_text=data.get("btn_text"),
+        btn_url=data.get("btn_url"),
+        total=await count_audience(seg),
+        scheduled_at=at,
+        repeat_every_sec=every,
+    )
     await state.clear()
-    await _render_one(call, f"Готово ✅\nУспешно: {ok}\nНе доставлено: {total - ok}", InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")]
-    ]))
+
+    job = await bc_service.get_job(job_id)
+    bc_service.schedule_job(m.bot, job)
+    sent = await _render_one(m, bc_service.format_job(job), bc_service.kb_job(job))
+    await bc_service.set_progress_message(job_id, sent.message_id)
+
+
+# ========= Управление задачами =========
+
+def _kb_jobs(jobs) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    for j in jobs:
+        processed = (j.sent_ok or 0) + (j.sent_fail or 0)
+        label = f"#{j.id} • {bc_service.STATUS_LABELS.get(j.status, j.status)} • {processed}/{j.total}"
+        rows.append([InlineKeyboardButton(text=label, callback_data=f"bc:job:open:{j.id}")])
+    rows.append([InlineKeyboardButton(text="📣 Новая рассылка", callback_data="admin:broadcast")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@router.callback_query(F.data == "bc:jobs")
+async def list_jobs(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    jobs = await bc_service.list_jobs()
+    upcoming = await bc_service.list_upcoming()
+    text = "<b>📋 Рассылки</b>\n\n"
+    if upcoming:
+        text += "<b>🕒 Ближайшие запуски (UTC)</b>\n"
+        for j in upcoming:
+            repeat = f" • каждые {bc_service.fmt_period(j.repeat_every_sec)}" if j.repeat_every_sec else ""
+            text += f"• #{j.id} — {j.scheduled_at:%Y-%m-%d %H:%M}{repeat}\n"
+        text += "\n"
+    text += "Выбери рассылку." if jobs else "Рассылок пока не было."
+    await call.answer()
+    await _render_one(call, text, _kb_jobs(jobs))
+
+
+@router.callback_query(F.data.startswith("bc:job:"))
+async def job_action(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    _, _, action, raw_id = call.data.split(":", 3)
+    try:
+        job_id = int(raw_id)
+    except ValueError:
+        await call.answer()
+        return
+
+    if action == "pause":
+        job = await bc_service.pause_job(job_id)
+    elif action == "resume":
+        job = await bc_service.resume_job(call.message.bot, job_id)
+    elif action == "cancel":
+        job = await bc_service.cancel_job(job_id)
+    else:
+        job = await bc_service.get_job(job_id)
+
+    if not job:
+        await call.answer("Рассылка не найдена.", show_alert=True)
+        return
+    await call.answer()
+
+    if action == "open":
+        sent = await _render_one(call, bc_service.format_job(job), bc_service.kb_job(job))
+        await bc_service.set_progress_message(job_id, sent.message_id)
+        return
+    try:
+        await call.message.edit_text(
+            bc_service.format_job(job), reply_markup=bc_service.kb_job(job), disable_web_page_preview=True
+        )
+    except Exception:
+        pass
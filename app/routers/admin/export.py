@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import html
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Literal, Optional
+
+from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    CallbackQuery,
+    FSInputFile,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+)
+
+from app.config import settings
+from app.services.export import export_table, parquet_available
+from app.services.segments import Segment
+from app.services.ui_state import StateStore
+
+router = Router(name=__name__)
+log = logging.getLogger(__name__)
+
+# Лимит Bot API на отправку документа ботом
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+SegPreset = Literal["all", "reg", "access", "vip", "sub"]
+
+SEG_LABELS = {
+    "all": "Все",
+    "reg": "Рег",
+    "access": "Доступ",
+    "vip": "VIP",
+    "sub": "Подписка",
+}
+
+
+# ===== состояние экрана выгрузки на админа =====
+@dataclass
+class ExportState:
+    table: Literal["users", "postbacks"] = "users"
+    fmt: Literal["csv", "parquet"] = "csv"
+    days: int = 0            # 0 — за всё время
+    seg: SegPreset = "all"
+
+_state: StateStore[ExportState] = StateStore("admin:export", ExportState)
+
+
+def _segment(preset: SegPreset) -> Optional[Segment]:
+    # выгрузка — это отчёт, а не рассылка: недоступные чаты не отсекаем
+    if preset == "reg":
+        return Segment(registered=True, include_dead=True)
+    if preset == "access":
+        return Segment(access_ok=True, include_dead=True)
+    if preset == "vip":
+        return Segment(vip=True, include_dead=True)
+    if preset == "sub":
+        return Segment(subscribed=True, include_dead=True)
+    return None
+
+
+# ===== helpers =====
+
+def _mark(active: bool, text: str) -> str:
+    return f"• {text}" if active else text
+
+
+def _kb(s: ExportState) -> InlineKeyboardMarkup:
+    rows = [
+        [
+            InlineKeyboardButton(text=_mark(s.table == "users", "Пользователи"), callback_data="aex:tbl:users"),
+            InlineKeyboardButton(text=_mark(s.table == "postbacks", "Постбэки"), callback_data="aex:tbl:postbacks"),
+        ],
+        [
+            InlineKeyboardButton(text=_mark(s.fmt == "csv", "CSV.gz"), callback_data="aex:fmt:csv"),
+            InlineKeyboardButton(text=_mark(s.fmt == "parquet", "Parquet"), callback_data="aex:fmt:parquet"),
+        ],
+        [
+            InlineKeyboardButton(text=_mark(s.days == d, label), callback_data=f"aex:days:{d}")
+            for d, label in ((7, "7 дн."), (30, "30 дн."), (90, "90 дн."), (0, "Всё время"))
+        ],
+        [
+            InlineKeyboardButton(text=_mark(s.seg == key, label), callback_data=f"aex:seg:{key}")
+            for key, label in SEG_LABELS.items()
+        ],
+        [InlineKeyboardButton(text="⬇️ Выгрузить", callback_data="aex:run")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def _text(s: ExportState) -> str:
+    period = f"последние {s.days} дн." if s.days else "всё время"
+    by = "дата регистрации" if s.table == "users" else "время события"
+    seg_note = "" if s.table == "users" else " (по пользователю постбэка)"
+    return (
+        "📤 <b>Выгрузка</b>\n\n"
+        f"Таблица: <b>{'пользователи' if s.table == 'users' else 'постбэки'}</b>\n"
+        f"Формат: <b>{'CSV.gz' if s.fmt == 'csv' else 'Parquet'}</b>\n"
+        f"Период: <b>{period}</b> ({by})\n"
+        f"Сегмент: <b>{SEG_LABELS[s.seg]}</b>{seg_note}\n\n"
+        "<i>Файл собирается пачками и приходит документом.</i>"
+    )
+
+
+async def _render(call: CallbackQuery, s: ExportState):
+    try:
+        await call.message.edit_text(_text(s), reply_markup=_kb(s), disable_web_page_preview=True)
+    except TelegramBadRequest:
+        await call.message.answer(_text(s), reply_markup=_kb(s), disable_web_page_preview=True)
+
+
+# ===== callbacks =====
+
+@router.callback_query(F.data == "admin:export")
+async def open_export(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    s = await _state.get_or_create(call.from_user.id)
+    await _render(call, s)
+    await call.answer()
+
+
+@router.callback_query(F.data.startswith("aex:"))
+async def export_option(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    s = await _state.get_or_create(call.from_user.id)
+    parts = call.data.split(":")
+    action, value = parts[1], (parts[2] if len(parts) > 2 else "")
+
+    if action == "run":
+        await _run(call, s)
+        return
+
+    if action == "tbl" and value in ("users", "postbacks"):
+        s.table = value
+    elif action == "fmt" and value in ("csv", "parquet"):
+        if value == "parquet" and not parquet_available():
+            await call.answer("Parquet недоступен: не установлен pyarrow", show_alert=True)
+            return
+        s.fmt = value
+    elif action == "days":
+        try:
+            s.days = max(0, int(value))
+        except ValueError:
+            s.days = 0
+    elif action == "seg" and value in SEG_LABELS:
+        s.seg = value
+    await _state.set(call.from_user.id, s)
+    await _render(call, s)
+    await call.answer()
+
+
+async def _run(call: CallbackQuery, s: ExportState):
+    await call.answer("Готовлю файл…")
+    since = datetime.utcnow() - timedelta(days=s.days) if s.days else None
+    try:
+        res = await export_table(s.table, s.fmt, since=since, seg=_segment(s.seg))
+    except Exception as e:
+        log.exception("Export failed")
+        await call.message.answer(f"❌ Выгрузка не удалась: {html.escape(str(e))}")
+        return
+
+    try:
+        if res.size > MAX_DOCUMENT_BYTES:
+            await call.message.answer(
+                f"❌ Файл {res.size / 1024 / 1024:.1f} МБ — больше лимита Telegram (50 МБ). "
+                "Сузьте период или сегмент."
+            )
+            return
+        await call.message.answer_document(
+            FSInputFile(res.path, filename=res.filename),
+            caption=f"📤 {res.filename}\nСтрок: <b>{res.rows}</b>",
+        )
+    finally:
+        os.remove(res.path)
@@ -18,15 +18,20 @@ from app.models.user import User
 # Подроутеры админки
 from app.routers.admin import settings as settings_router
 from app.routers.admin import stats as stats_router
+from app.routers.admin import analytics as analytics_router
+from app.routers.admin import export as export_router
 from app.routers.admin import broadcast as broadcast_router
 from app.routers.admin import postbacks as postbacks_router
 from app.routers.admin import users as users_router  # <— НОВОЕ
+from app.routers.admin.window import render_one as _render_one_window
 
 router = Router(name=__name__)
 
 # Подключаем дочерние роутеры админки
 router.include_router(settings_router.router)
 router.include_router(stats_router.router)
+router.include_router(analytics_router.router)
+router.include_router(export_router.router)
 router.include_router(broadcast_router.router)
 router.include_router(postbacks_router.router)
 router.include_router(users_router.router)  # <— НОВОЕ
@@ -38,46 +43,6 @@ async def _get_user(tg_id: int) -> Optional[User]:
         return await session.get(User, tg_id)
 
 
-async def _set_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        user = await session.get(User, tg_id)
-        if not user:
-            user = User(id=tg_id)
-            session.add(user)
-            await session.commit()
-            await session.refresh(user)
-        user.last_bot_message_id = message_id
-        await session.commit()
-
-
-async def _render_one_window(ctx, text: str, kb: InlineKeyboardMarkup):
-    if isinstance(ctx, Message):
-        chat_id = ctx.chat.id
-        user_id = ctx.from_user.id
-        bot = ctx.bot
-        send = ctx.answer
-    else:
-        chat_id = ctx.message.chat.id
-        user_id = ctx.from_user.id
-        bot = ctx.message.bot
-        send = ctx.message.answer
-
-    # удалить прошлое окно
-    last_id = None
-    async with async_session() as session:
-        u = await session.get(User, user_id)
-        if u:
-            last_id = u.last_bot_message_id
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
-
-    sent = await send(text, reply_markup=kb, disable_web_page_preview=True)
-    await _set_last_bot_message_id(user_id, sent.message_id)
-
-
 # === keyboards ===
 def _kb_admin_root() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -92,6 +57,10 @@ def _kb_admin_root() -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="📊 Статистика", callback_data="admin:stats"),
             InlineKeyboardButton(text="📮 Постбэки",   callback_data="admin:postbacks"),
         ],
+        [
+            InlineKeyboardButton(text="📈 Аналитика", callback_data="admin:analytics"),
+            InlineKeyboardButton(text="📤 Выгрузка",  callback_data="admin:export"),
+        ],
     ])
 
 
@@ -115,6 +84,8 @@ async def cmd_admin(m: Message):
         "• 📣 Рассылка — отправка сообщений по сегментам\n"
         "• 📊 Статистика — воронка и суммы депозитов\n"
         "• 📮 Постбэки — последние события и синхронизация\n"
+        "• 📈 Аналитика — воронка по шагам и недельные когорты\n"
+        "• 📤 Выгрузка — пользователи и постбэки в CSV.gz / Parquet\n"
         "• 👥 Пользователи — список, поиск, карточки"
     )
     await _render_one_window(m, text, _kb_admin_root())
@@ -133,6 +104,8 @@ async def cb_admin_back(call: CallbackQuery):
         "• 📣 Рассылка — отправка сообщений по сегментам\n"
         "• 📊 Статистика — воронка и суммы депозитов\n"
         "• 📮 Постбэки — последние события и синхронизация\n"
+        "• 📈 Аналитика — воронка по шагам и недельные когорты\n"
+        "• 📤 Выгрузка — пользователи и постбэки в CSV.gz / Parquet\n"
         "• 👥 Пользователи — список, поиск, карточки"
     )
     await _render_one_window(call, text, _kb_admin_root())
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import html
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Literal, Optional, List
 
@@ -9,26 +10,49 @@ from aiogram.types import (
     CallbackQuery,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    Message,
 )
 from aiogram.exceptions import TelegramBadRequest
 
 from sqlalchemy import select, desc
 
 from app.config import settings
-from app.db.session import async_session
+from app.db.session import async_read_session
 from app.models.postback import Postback
+from app.services.ui_state import StateStore
 
 router = Router(name=__name__)
 
-# ===== in-memory состояние: фильтр + оффсет на пользователя =====
+# ===== состояние экрана: фильтры + keyset-курсор на админа =====
 @dataclass
 class PBState:
     flt: Literal["all", "reg", "dep"] = "all"
-    offset: int = 0
-
-_state: dict[int, PBState] = {}
+    tg_id: Optional[int] = None
+    trader_id: Optional[str] = None
+    click_id: Optional[str] = None
+    amount_min: Optional[float] = None
+    amount_max: Optional[float] = None
+    # показываем события с id < cursor (None — самые свежие)
+    cursor: Optional[int] = None
+    # курсоры предыдущих страниц для «« Пред» (не больше BACK_DEPTH последних)
+    back: List[Optional[int]] = field(default_factory=list)
+    has_next: bool = False
+    # курсор следующей страницы: id последнего события на текущей
+    next_cursor: Optional[int] = None
+    page: int = 1
+
+    def reset_page(self) -> None:
+        self.cursor = None
+        self.next_cursor = None
+        self.page = 1
+        self.back.clear()
+
+_state: StateStore[PBState] = StateStore("admin:pb", PBState)
+# кто из админов сейчас вводит фильтр
+_pending_filter: StateStore[bool] = StateStore("admin:pb:find", ttl=600)
 
 PAGE = 7  # сколько событий показывать
+BACK_DEPTH = 20  # сколько курсоров «назад» хранить в состоянии экрана
 
 
 # ===== helpers =====
@@ -39,15 +63,19 @@ def _kb_list(s: PBState) -> InlineKeyboardMarkup:
         InlineKeyboardButton(text=("• Регистрации" if s.flt == "reg" else "Регистрации"), callback_data="admin:pb:flt:reg"),
         InlineKeyboardButton(text=("• Депозиты" if s.flt == "dep" else "Депозиты"), callback_data="admin:pb:flt:dep"),
     ]
-    row_nav = [
-        InlineKeyboardButton(text="« Пред",    callback_data="admin:pb:nav:prev"),
-        InlineKeyboardButton(text="Обновить",  callback_data="admin:pb:refresh"),
-        InlineKeyboardButton(text="След »",    callback_data="admin:pb:nav:next"),
-    ]
+    row_find = [InlineKeyboardButton(text="🔎 Фильтр", callback_data="admin:pb:find")]
+    if _has_filters(s):
+        row_find.append(InlineKeyboardButton(text="✖️ Сбросить", callback_data="admin:pb:find:clear"))
+    row_nav = []
+    if s.page > 1:
+        row_nav.append(InlineKeyboardButton(text="« Пред", callback_data="admin:pb:nav:prev"))
+    row_nav.append(InlineKeyboardButton(text="Обновить", callback_data="admin:pb:refresh"))
+    if s.has_next:
+        row_nav.append(InlineKeyboardButton(text="След »", callback_data="admin:pb:nav:next"))
     row_back = [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")]
     row_cfg  = [InlineKeyboardButton(text="⚙️ Настройка URL постбэка", callback_data="admin:pb:cfg")]
 
-    return InlineKeyboardMarkup(inline_keyboard=[row_filters, row_nav, row_back, row_cfg])
+    return InlineKeyboardMarkup(inline_keyboard=[row_filters, row_find, row_nav, row_back, row_cfg])
 
 
 def _safe_ts(pb: Postback) -> str:
@@ -75,38 +103,119 @@ def _safe_uid(pb: Postback) -> str:
 
 
 def _fmt_item(pb: Postback) -> str:
-    return f"#{pb.id} • {getattr(pb, 'event', '?')} • uid={_safe_uid(pb)} • amount={_safe_amount(pb)} • ts={_safe_ts(pb)}"
-
-
-def _legend(count: int, offset: int) -> str:
+    ids = ""
+    if pb.trader_id:
+        ids += f" • trader={html.escape(pb.trader_id)}"
+    if pb.click_id:
+        ids += f" • click={html.escape(pb.click_id)}"
+    return f"#{pb.id} • {getattr(pb, 'event', '?')} • uid={_safe_uid(pb)}{ids} • amount={_safe_amount(pb)} • ts={_safe_ts(pb)}"
+
+
+def _has_filters(s: PBState) -> bool:
+    return any(v is not None for v in (s.tg_id, s.trader_id, s.click_id, s.amount_min, s.amount_max))
+
+
+def _fmt_filters(s: PBState) -> str:
+    parts = []
+    if s.tg_id is not None:
+        parts.append(f"tg={s.tg_id}")
+    if s.trader_id is not None:
+        parts.append(f"trader={html.escape(s.trader_id)}")
+    if s.click_id is not None:
+        parts.append(f"click={html.escape(s.click_id)}")
+    if s.amount_min is not None or s.amount_max is not None:
+        lo = "" if s.amount_min is None else f"{s.amount_min:g}"
+        hi = "" if s.amount_max is None else f"{s.amount_max:g}"
+        parts.append(f"amount={lo}-{hi}")
+    return " • ".join(parts)
+
+
+def _legend(count: int, s: PBState) -> str:
+    flt = f"Фильтр: <code>{_fmt_filters(s)}</code>\n" if _has_filters(s) else ""
     return (
         "📬 <b>Постбэки — все события</b>\n"
-        f"Показано {count} (offset={offset})\n\n"
+        f"{flt}"
+        f"Показано {count} • стр. {s.page}\n\n"
         "<i>Легенда: id • event • uid • amount • ts</i>\n"
     )
 
 
+def _parse_filters(raw: str) -> dict:
+    """
+    «tg=123 trader=abc click=xyz amount=10-500» (ключи в любом порядке,
+    можно через «:»). amount: «10-500», «100-» или «-50».
+    """
+    out: dict = {}
+    for token in raw.split():
+        key, sep, value = token.replace(":", "=", 1).partition("=")
+        key, value = key.lower(), value.strip()
+        if not sep or not value:
+            raise ValueError(f"ожидается ключ=значение: {token}")
+        if key in ("tg", "tg_id", "uid"):
+            out["tg_id"] = int(value)
+        elif key in ("trader", "trader_id"):
+            out["trader_id"] = value
+        elif key in ("click", "click_id"):
+            out["click_id"] = value
+        elif key in ("amount", "sum"):
+            lo, dash, hi = value.partition("-")
+            if not dash:
+                lo = hi = value
+            out["amount_min"] = float(lo.replace(",", ".")) if lo else None
+            out["amount_max"] = float(hi.replace(",", ".")) if hi else None
+        else:
+            raise ValueError(f"неизвестный ключ: {key}")
+    return out
+
+
 async def _load_items(s: PBState) -> List[Postback]:
-    async with async_session() as session:
-        q = select(Postback).order_by(desc(Postback.id))
-        if s.flt == "reg":
-            q = q.where(Postback.event == "registration")
-        elif s.flt == "dep":
-            q = q.where(Postback.event.in_(("deposit_first", "deposit_repeat", "deposit")))
-        q = q.offset(max(s.offset, 0)).limit(PAGE)
-        return [row[0] for row in (await session.execute(q)).all()]
+    """
+    Keyset по id: WHERE id < cursor ORDER BY id DESC. С фильтром по событию,
+    tg_id, trader_id или click_id идёт по составному индексу (колонка, id),
+    так что страница истории одного трейдера не зависит от размера таблицы.
+    """
+    q = select(Postback).order_by(desc(Postback.id))
+    if s.flt == "reg":
+        q = q.where(Postback.event == "registration")
+    elif s.flt == "dep":
+        q = q.where(Postback.event.in_(("deposit_first", "deposit_repeat", "deposit")))
+    if s.tg_id is not None:
+        q = q.where(Postback.tg_id == s.tg_id)
+    if s.trader_id is not None:
+        q = q.where(Postback.trader_id == s.trader_id)
+    if s.click_id is not None:
+        q = q.where(Postback.click_id == s.click_id)
+    if s.amount_min is not None:
+        q = q.where(Postback.amount_usd >= s.amount_min)
+    if s.amount_max is not None:
+        q = q.where(Postback.amount_usd <= s.amount_max)
+    if s.cursor is not None:
+        q = q.where(Postback.id < s.cursor)
+    q = q.limit(PAGE + 1)
+    async with async_read_session() as session:
+        items = list((await session.execute(q)).scalars().all())
+    s.has_next = len(items) > PAGE
+    items = items[:PAGE]
+    s.next_cursor = items[-1].id if s.has_next else None
+    return items
+
+
+def _list_view(s: PBState, items: List[Postback]) -> str:
+    lines = [_legend(len(items), s)]
+    for pb in items:
+        lines.append(_fmt_item(pb))
+    if not items:
+        lines.append("Событий нет.")
+    return "\n".join(lines)
 
 
 async def _render_list(call: CallbackQuery):
     user_id = call.from_user.id
-    s = _state.setdefault(user_id, PBState())
+    s = await _state.get_or_create(user_id)
 
     items = await _load_items(s)
-
-    lines = [_legend(len(items), s.offset)]
-    for pb in items:
-        lines.append(_fmt_item(pb))
-    text = "\n".join(lines)
+    await _state.set(user_id, s)
+    text = _list_view(s, items)
 
     try:
         await call.message.edit_text(text, reply_markup=_kb_list(s), disable_web_page_preview=True)
@@ -119,30 +228,40 @@ async def _render_list(call: CallbackQuery):
 
 @router.callback_query(F.data == "admin:postbacks")
 async def open_list(call: CallbackQuery):
-    _state[call.from_user.id] = PBState()
+    await _state.set(call.from_user.id, PBState())
     await _render_list(call)
 
 
 @router.callback_query(F.data.startswith("admin:pb:flt:"))
 async def set_filter(call: CallbackQuery):
     kind = call.data.split(":", 3)[3]
-    s = _state.setdefault(call.from_user.id, PBState())
+    s = await _state.get_or_create(call.from_user.id)
     s.flt = kind if kind in ("all", "reg", "dep") else "all"
-    s.offset = 0
+    s.reset_page()
     await _render_list(call)
 
 
 @router.callback_query(F.data == "admin:pb:nav:prev")
 async def nav_prev(call: CallbackQuery):
-    s = _state.setdefault(call.from_user.id, PBState())
-    s.offset = max(s.offset - PAGE, 0)
+    s = await _state.get_or_create(call.from_user.id)
+    if s.back:
+        s.cursor = s.back.pop()
+        s.page = max(1, s.page - 1)
+    else:
+        # старые курсоры отброшены — возвращаемся к началу
+        s.reset_page()
     await _render_list(call)
 
 
 @router.callback_query(F.data == "admin:pb:nav:next")
 async def nav_next(call: CallbackQuery):
-    s = _state.setdefault(call.from_user.id, PBState())
-    s.offset += PAGE
+    s = await _state.get_or_create(call.from_user.id)
+    # курсор следующей страницы запомнен при показе текущей — второй запрос не нужен
+    if s.has_next and s.next_cursor is not None:
+        s.back.append(s.cursor)
+        del s.back[:-BACK_DEPTH]
+        s.cursor = s.next_cursor
+        s.page += 1
     await _render_list(call)
 
 
@@ -151,6 +270,56 @@ async def refresh(call: CallbackQuery):
     await _render_list(call)
 
 
+# ===== фильтры по идентификаторам и сумме =====
+
+@router.callback_query(F.data == "admin:pb:find")
+async def find_prompt(call: CallbackQuery):
+    if call.from_user.id != settings.ADMIN_ID:
+        await call.answer("Нет доступа", show_alert=True)
+        return
+    await _pending_filter.set(call.from_user.id, True)
+    await call.message.answer(
+        "🔎 Отправьте фильтр, например:\n"
+        "<code>trader=12345</code>\n"
+        "<code>tg=111222333 amount=50-</code>\n"
+        "<code>click=abc amount=10-500</code>\n\n"
+        "Ключи: tg, trader, click, amount (от-до).",
+        disable_web_page_preview=True,
+    )
+    await call.answer()
+
+
+@router.callback_query(F.data == "admin:pb:find:clear")
+async def find_clear(call: CallbackQuery):
+    s = await _state.get_or_create(call.from_user.id)
+    s.tg_id = s.trader_id = s.click_id = None
+    s.amount_min = s.amount_max = None
+    s.reset_page()
+    await _render_list(call)
+
+
+@router.message(F.text, F.from_user.id.func(lambda uid: uid in _pending_filter))
+async def find_catcher(m: Message):
+    await _pending_filter.pop(m.from_user.id)
+    try:
+        parsed = _parse_filters(m.text or "")
+    except ValueError as e:
+        await m.answer(f"❌ {html.escape(str(e))}")
+        return
+
+    s = await _state.get_or_create(m.from_user.id)
+    s.tg_id = parsed.get("tg_id")
+    s.trader_id = parsed.get("trader_id")
+    s.click_id = parsed.get("click_id")
+    s.amount_min = parsed.get("amount_min")
+    s.amount_max = parsed.get("amount_max")
+    s.reset_page()
+
+    items = await _load_items(s)
+    await _state.set(m.from_user.id, s)
+    await m.answer(_list_view(s, items), reply_markup=_kb_list(s), disable_web_page_preview=True)
+
+
 # ===== экран настройки URL постбэка =====
 
 def _kb_cfg() -> InlineKeyboardMarkup:
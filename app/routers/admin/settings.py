@@ -11,11 +11,13 @@ from aiogram.types import (
 from aiogram.exceptions import TelegramBadRequest
 
 from app.config import settings
+from app.services.stats import reconcile_counters, stats_cache
+from app.services.ui_state import StateStore
 
 router = Router(name=__name__)
 
-# Простое ожидание ввода (in-memory)
-_pending: dict[int, str] = {}
+# Ожидание ввода: админ -> ключ настройки
+_pending: StateStore[str] = StateStore("admin:settings", ttl=600)
 
 
 def _onoff(v: bool) -> str:
@@ -91,7 +93,7 @@ async def toggle_dep(call: CallbackQuery):
 
 # === HELPERS FOR INPUT ===
 async def _ask(call: CallbackQuery, key: str, prompt: str):
-    _pending[call.from_user.id] = key
+    await _pending.set(call.from_user.id, key)
     await call.message.answer(f"✍️ {prompt}\n\nОтправьте одним сообщением.", reply_markup=ReplyKeyboardRemove())
     await call.answer()
 
@@ -123,9 +125,9 @@ async def ask_suburl(call: CallbackQuery):
 
 
 # === TEXT INPUT SAVE ===
-@router.message(F.text)
+@router.message(F.text, F.from_user.id.func(lambda uid: uid in _pending))
 async def save_value(message: Message):
-    key = _pending.pop(message.from_user.id, None)
+    key = await _pending.pop(message.from_user.id)
     if not key:
         return
 
@@ -133,6 +135,9 @@ async def save_value(message: Message):
     try:
         if key in {"ACCESS_THRESHOLD_USD", "VIP_THRESHOLD_USD"}:
             setattr(settings, key, float(raw.replace(",", ".")))
+            # счётчики доступа/VIP и снимки экранов посчитаны по старому порогу
+            await reconcile_counters()
+            stats_cache.invalidate()
         elif key == "SUB_CHANNEL_ID":
             setattr(settings, key, int(raw))
         else:
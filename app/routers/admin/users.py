@@ -1,6 +1,8 @@
 # app/routers/admin/users.py
 from __future__ import annotations
 
+import html
+from datetime import datetime, timedelta
 from typing import Optional, List, Tuple
 
 from aiogram import Router, F
@@ -10,90 +12,50 @@ from aiogram.types import (
     InlineKeyboardButton,
     Message,
 )
-from sqlalchemy import select, func, desc, or_, and_
+from sqlalchemy import select, func, desc, or_, and_, tuple_, literal, union_all
 
 from app.config import settings
-from app.db.session import async_session
+from app.db.session import async_read_session
 from app.models.user import User
+from app.services.stats import user_metrics
+from app.services.ui_state import StateStore
+from app.routers.admin.window import render_one as _render_one
 
 router = Router(name=__name__)
 
-# --- helpers: one-screen rendering (без спама) ---
-async def _set_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        u = await session.get(User, tg_id)
-        if not u:
-            u = User(id=tg_id)
-            session.add(u)
-            await session.flush()
-        u.last_bot_message_id = message_id
-        await session.commit()
-
-async def _render_one(ctx, text: str, kb: InlineKeyboardMarkup, disable_preview: bool = True):
-    if isinstance(ctx, Message):
-        chat_id = ctx.chat.id
-        user_id = ctx.from_user.id
-        bot = ctx.bot
-        send = ctx.answer
-    else:
-        chat_id = ctx.message.chat.id
-        user_id = ctx.from_user.id
-        bot = ctx.message.bot
-        send = ctx.message.answer
-
-    last_id = None
-    async with async_session() as session:
-        u = await session.get(User, user_id)
-        if u:
-            last_id = u.last_bot_message_id
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
-
-    sent = await send(text, reply_markup=kb, disable_web_page_preview=disable_preview)
-    await _set_last_bot_message_id(user_id, sent.message_id)
-
 # --- counters ---
 async def _get_counters() -> Tuple[int, int, int, int, int, float]:
-    async with async_session() as session:
-        total = (await session.execute(select(func.count()).select_from(User))).scalar_one()
-
-        registered = (await session.execute(
-            select(func.count()).select_from(User).where(User.is_registered.is_(True))
-        )).scalar_one()
+    m = await user_metrics()
+    return m.total, m.registered, m.access, m.vip, m.subscribed, m.deposit_sum
 
-        if settings.REQUIRE_DEPOSIT:
-            access_ok = (await session.execute(
-                select(func.count()).select_from(User).where(User.deposit_total_usd >= settings.ACCESS_THRESHOLD_USD)
-            )).scalar_one()
-        else:
-            access_ok = total
+def _fmt_header() -> str:
+    return "👥 <b>Пользователи</b>\n\n"
 
-        vip = (await session.execute(
-            select(func.count()).select_from(User).where(
-                or_(User.has_vip.is_(True), User.deposit_total_usd >= settings.VIP_THRESHOLD_USD)
-            )
-        )).scalar_one()
+# --- keyset cursor ---
+# Курсор страницы — ключ сортировки (created_at, id) крайней строки.
+# В callback_data: users:page:<стр>:<op>:<created_at в мкс>:<id>
+#   n — строки после ключа (следующая страница)
+#   p — строки до ключа (предыдущая страница)
+#   s — начиная с ключа включительно (возврат к странице из карточки)
+# users:page:<стр> без курсора — первая страница.
+_EPOCH = datetime(1970, 1, 1)
 
-        subscribed = (await session.execute(
-            select(func.count()).select_from(User).where(User.is_subscribed.is_(True))
-        )).scalar_one()
+def _key_of(u: User) -> str:
+    us = (u.created_at - _EPOCH) // timedelta(microseconds=1) if u.created_at else 0
+    return f"{us}:{u.id}"
 
-        dep_sum = float((await session.execute(
-            select(func.coalesce(func.sum(User.deposit_total_usd), 0.0))
-        )).scalar_one() or 0.0)
+def _parse_key(raw: str) -> Tuple[datetime, int]:
+    us, uid = raw.split(":")
+    return _EPOCH + timedelta(microseconds=int(us)), int(uid)
 
-        return total, registered, access_ok, vip, subscribed, dep_sum
-
-def _fmt_header() -> str:
-    return "👥 <b>Пользователи</b>\n\n"
+def _page_cb(page: int, op: str, u: User) -> str:
+    return f"users:page:{page}:{op}:{_key_of(u)}"
 
 # --- keyboards ---
-def _kb_users_list(users: List[User], page: int) -> InlineKeyboardMarkup:
+def _kb_users_list(users: List[User], page: int, has_next: bool) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     rows.append([InlineKeyboardButton(text="🔍 Поиск", callback_data="users:search")])
+    start = _key_of(users[0]) if users else ""
     buf: List[InlineKeyboardButton] = []
     for u in users:
         short = f"{u.id} • {(u.lang or '-').upper() if u.lang else '-'}"
@@ -101,66 +63,170 @@ def _kb_users_list(users: List[User], page: int) -> InlineKeyboardMarkup:
             short += f" • ${int(u.deposit_total_usd)}"
         if u.has_vip or (u.deposit_total_usd or 0) >= settings.VIP_THRESHOLD_USD:
             short += " 👑"
-        buf.append(InlineKeyboardButton(text=short, callback_data=f"users:open:{u.id}:{page}"))
+        buf.append(InlineKeyboardButton(text=short, callback_data=f"users:open:{u.id}:{page}:{start}"))
         if len(buf) == 2:
             rows.append(buf); buf = []
     if buf:
         rows.append(buf)
 
     nav: List[InlineKeyboardButton] = []
-    if page > 1:
-        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"users:page:{page-1}"))
+    if page > 1 and users:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=_page_cb(page - 1, "p", users[0])))
     nav.append(InlineKeyboardButton(text=f"Стр. {page}", callback_data="users:noop"))
-    nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"users:page:{page+1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=_page_cb(page + 1, "n", users[-1])))
     rows.append(nav)
 
     rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="admin:back")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def _kb_back_to_list(page: int) -> InlineKeyboardMarkup:
+def _kb_back_to_list(back_cb: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ К списку", callback_data=f"users:page:{page}")],
+        [InlineKeyboardButton(text="⬅️ К списку", callback_data=back_cb)],
         [InlineKeyboardButton(text="🏠 В меню", callback_data="admin:back")],
     ])
 
 # --- data access ---
-async def _get_users_page(page: int, per_page: int = 10) -> List[User]:
-    offset = max(0, (page - 1) * per_page)
-    async with async_session() as session:
-        q = select(User).order_by(desc(User.created_at)).offset(offset).limit(per_page)
-        rows = (await session.execute(q)).scalars().all()
-        return list(rows)
+async def _get_users_page(
+    op: Optional[str] = None,
+    key: Optional[Tuple[datetime, int]] = None,
+    per_page: int = 10,
+) -> Tuple[List[User], bool]:
+    """
+    Страница по индексу (created_at, id), новые сверху. Стоимость любой
+    страницы — как у первой: поиск по ключу + per_page строк, без OFFSET.
+    Возвращает (пользователи, есть ли следующая страница).
+    """
+    order_key = tuple_(User.created_at, User.id)
+    q = select(User)
+    if op == "p" and key:
+        # назад: ближайшие строки «выше» ключа, затем разворачиваем
+        q = q.where(order_key > tuple_(*key)).order_by(User.created_at, User.id).limit(per_page)
+        async with async_read_session() as session:
+            rows = list((await session.execute(q)).scalars().all())
+        rows.reverse()
+        return rows, True
+
+    if op == "n" and key:
+        q = q.where(order_key < tuple_(*key))
+    elif op == "s" and key:
+        q = q.where(order_key <= tuple_(*key))
+    q = q.order_by(desc(User.created_at), desc(User.id)).limit(per_page + 1)
+    async with async_read_session() as session:
+        rows = list((await session.execute(q)).scalars().all())
+    return rows[:per_page], len(rows) > per_page
 
 # --- search helpers ---
-async def _find_user_by_query(query: str, bot) -> Optional[User]:
-    q = query.strip()
-    async with async_session() as session:
-        if q.lstrip("-").isdigit():
-            user = await session.get(User, int(q))
-            if user:
-                return user
-        row = (await session.execute(select(User).where(User.click_id == q))).scalars().first()
-        if row:
-            return row
-        row = (await session.execute(select(User).where(User.partner_trader_id == q))).scalars().first()
-        if row:
-            return row
+SEARCH_LIMIT = 10
+# Префиксный поиск по click_id / trader_id — с этой длины запроса
+PREFIX_MIN_LEN = 3
+
+# Ранг совпадения: чем меньше, тем выше в выдаче
+(RANK_ID, RANK_USERNAME, RANK_CLICK, RANK_TRADER,
+ RANK_USERNAME_PREFIX, RANK_CLICK_PREFIX, RANK_TRADER_PREFIX) = range(7)
+
+RANK_LABELS = {
+    RANK_ID: "tg_id",
+    RANK_USERNAME: "@",
+    RANK_USERNAME_PREFIX: "@…",
+    RANK_CLICK: "click_id",
+    RANK_TRADER: "trader_id",
+    RANK_CLICK_PREFIX: "click_id…",
+    RANK_TRADER_PREFIX: "trader_id…",
+}
+
+def _prefix_range(col, prefix: str):
+    # col >= 'abc' AND col < 'abd' — идёт по обычному индексу, в отличие от LIKE.
+    # LIKE поверх диапазона — точность при не-C collation в PostgreSQL
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(col >= prefix, col < upper, col.startswith(prefix, autoescape=True))
+
+def _as_user_id(q: str) -> Optional[int]:
+    """
+    Запрос как id пользователя. Длинные trader/click id тоже из цифр, но
+    за пределами BIGINT: SQLite не свяжет такое число (OverflowError).
+    """
+    if not q.lstrip("-").isdigit():
+        return None
     try:
-        if q.startswith("@"):
-            chat = await bot.get_chat(q)
-            if chat and chat.id:
-                async with async_session() as session:
-                    return await session.get(User, int(chat.id))
-    except Exception:
-        pass
-    return None
+        n = int(q)
+    except ValueError:  # isdigit() пропускает и «²»
+        return None
+    return n if -2**63 <= n < 2**63 else None
+
+
+def _search_stmt(q: str, limit: int = SEARCH_LIMIT):
+    """
+    Один запрос: UNION ALL индексных веток (id, username, click_id,
+    trader_id, префиксы), каждая со своим рангом и лимитом; пользователь
+    берётся по лучшему рангу. «@name» ищется только по username.
+    """
+    branches = []
+
+    def branch(where, rank: int):
+        sub = select(User.id.label("uid"), literal(rank).label("rank")).where(where).limit(limit).subquery()
+        branches.append(select(sub.c.uid, sub.c.rank))
+
+    # username — через индекс по lower(username)
+    name = q[1:] if q.startswith("@") else q
+    uname = func.lower(User.username)
+    if name:
+        branch(uname == name.lower(), RANK_USERNAME)
+        if len(name) >= PREFIX_MIN_LEN:
+            branch(_prefix_range(uname, name.lower()), RANK_USERNAME_PREFIX)
+    if q.startswith("@"):
+        return _union_ranked(branches, limit)
+
+    uid = _as_user_id(q)
+    if uid is not None:
+        branch(User.id == uid, RANK_ID)
+    branch(User.click_id == q, RANK_CLICK)
+    branch(User.partner_trader_id == q, RANK_TRADER)
+    if len(q) >= PREFIX_MIN_LEN:
+        branch(_prefix_range(User.click_id, q), RANK_CLICK_PREFIX)
+        branch(_prefix_range(User.partner_trader_id, q), RANK_TRADER_PREFIX)
+    return _union_ranked(branches, limit)
+
+def _union_ranked(branches: list, limit: int):
+    hits = union_all(*branches).subquery()
+    best = func.min(hits.c.rank).label("rank")
+    return (
+        select(User, best)
+        .join(hits, hits.c.uid == User.id)
+        .group_by(User.id)
+        .order_by(best, User.id)
+        .limit(limit)
+    )
+
+async def _search_users(query: str) -> List[Tuple[User, int]]:
+    """Ранжированный список (пользователь, ранг) по tg_id / @username / click_id / trader_id."""
+    q = query.strip()
+    if not q or q == "@":
+        return []
+    async with async_read_session() as session:
+        rows = (await session.execute(_search_stmt(q))).all()
+    return [(u, rank) for u, rank in rows]
+
+def _kb_search_results(hits: List[Tuple[User, int]]) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    for u, rank in hits:
+        value = {
+            RANK_USERNAME: u.username, RANK_USERNAME_PREFIX: u.username,
+            RANK_CLICK: u.click_id, RANK_CLICK_PREFIX: u.click_id,
+            RANK_TRADER: u.partner_trader_id, RANK_TRADER_PREFIX: u.partner_trader_id,
+        }.get(rank)
+        label = f"{u.id} • {RANK_LABELS[rank]}" + (f" {value}" if value else "")
+        rows.append([InlineKeyboardButton(text=label[:60], callback_data=f"users:open:{u.id}:1")])
+    rows.append([InlineKeyboardButton(text="🔍 Поиск", callback_data="users:search")])
+    rows.append([InlineKeyboardButton(text="⬅️ К списку", callback_data="users:page:1")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 # --- open entrypoint ---
 @router.callback_query(F.data == "admin:users")
 async def open_users(call: CallbackQuery):
     total, reg, access_ok, vip, sub, dep_sum = await _get_counters()
     page = 1
-    users = await _get_users_page(page)
+    users, has_next = await _get_users_page()
     text = (
         _fmt_header() +
         f"Всего: <b>{total}</b>\n"
@@ -171,53 +237,71 @@ async def open_users(call: CallbackQuery):
         f"Сумма депозитов: <b>${int(dep_sum)}</b>\n\n"
         "Выберите пользователя или воспользуйтесь поиском."
     )
-    await _render_one(call, text, _kb_users_list(users, page))
+    await _render_one(call, text, _kb_users_list(users, page, has_next))
     await call.answer()
 
 @router.callback_query(F.data.startswith("users:page:"))
 async def paginate(call: CallbackQuery):
-    page = int(call.data.split(":")[2])
+    parts = call.data.split(":", 4)
+    page = int(parts[2])
+    op = parts[3] if len(parts) > 3 else None
+    key = _parse_key(parts[4]) if len(parts) > 4 else None
     total, reg, access_ok, vip, sub, dep_sum = await _get_counters()
-    users = await _get_users_page(page)
-    if not users and page > 1:
-        page -= 1
-        users = await _get_users_page(page)
+    users, has_next = await _get_users_page(op, key)
+    if not users or (op == "p" and len(users) < 10):
+        # курсор устарел (строки удалены) или упёрлись в начало — к первой странице
+        page = 1
+        users, has_next = await _get_users_page()
     text = (
         _fmt_header() +
         f"Всего: <b>{total}</b> • Рег: <b>{reg}</b> • Доступ: <b>{access_ok}</b> • VIP: <b>{vip}</b> • Подписка: <b>{sub}</b>\n"
         f"Сумма депозитов: <b>${int(dep_sum)}</b>\n\n"
         "Выберите пользователя или воспользуйтесь поиском."
     )
-    await _render_one(call, text, _kb_users_list(users, page))
+    await _render_one(call, text, _kb_users_list(users, page, has_next))
     await call.answer()
 
 # --- search flow ---
-_pending_search: set[int] = set()
+_pending_search: StateStore[bool] = StateStore("admin:users:search", ttl=600)
 
 @router.callback_query(F.data == "users:search")
 async def search_prompt(call: CallbackQuery):
-    _pending_search.add(call.from_user.id)
+    await _pending_search.set(call.from_user.id, True)
     await call.message.answer(
-        "🔎 Отправьте <b>trader_id</b> или <b>click_id</b> или <b>tg_id</b> или <b>@username</b>.",
+        "🔎 Отправьте <b>tg_id</b>, <b>@username</b>, <b>click_id</b> или <b>trader_id</b> (можно начало, от 3 символов).",
         disable_web_page_preview=True
     )
     await call.answer()
 
-@router.message(F.text)
+@router.message(F.text, F.from_user.id.func(lambda uid: uid in _pending_search))
 async def search_catcher(m: Message):
-    if m.from_user.id not in _pending_search:
-        return
-    _pending_search.discard(m.from_user.id)
+    await _pending_search.pop(m.from_user.id)
 
     q = (m.text or "").strip()
-    user = await _find_user_by_query(q, m.bot)
-    if not user:
+    hits = await _search_users(q)
+    if not hits:
         await m.answer("Ничего не найдено. Попробуйте другой идентификатор.")
         return
 
-    await _show_user_card(m, user, page=1)
+    if len(hits) == 1:
+        await _show_user_card(m, hits[0][0], back_cb="users:page:1")
+        return
+
+    more = " (показаны первые)" if len(hits) >= SEARCH_LIMIT else ""
+    await _render_one(
+        m,
+        _fmt_header() + f"🔎 «{html.escape(q)}»: найдено <b>{len(hits)}</b>{more}",
+        _kb_search_results(hits),
+    )
 
 # --- user card ---
+def _fmt_delivery(u: User) -> str:
+    status = getattr(u, "delivery_status", None)
+    if not status:
+        return "ок"
+    blocked_at = getattr(u, "blocked_at", None)
+    return f"{status} с {blocked_at:%Y-%m-%d %H:%M}" if blocked_at else status
+
 def _fmt_user_card(u: User) -> str:
     dep = float(u.deposit_total_usd or 0)
     vip = bool(u.has_vip) or dep >= settings.VIP_THRESHOLD_USD
@@ -225,9 +309,12 @@ def _fmt_user_card(u: User) -> str:
     shown_vip = bool(getattr(u, "shown_vip_access_once", False))
     created = getattr(u, "created_at", None)
     updated = getattr(u, "updated_at", None)
+    seen = f"{u.last_seen_at:%Y-%m-%d %H:%M}" if u.last_seen_at else "—"
     return (
         "🧾 <b>Пользователь</b>\n\n"
         f"• TG ID: <code>{u.id}</code>\n"
+        f"• Username: <b>{'@' + u.username if u.username else '—'}</b>\n"
+        f"• Имя: <b>{html.escape(u.first_name) if u.first_name else '—'}</b>\n"
         f"• Язык: <b>{(u.lang or '-').upper()}</b>\n"
         f"• Реф-код: <code>{u.ref_code or '—'}</code>\n"
         f"• click_id: <code>{u.click_id or '—'}</code>\n"
@@ -238,23 +325,28 @@ def _fmt_user_card(u: User) -> str:
         f"• VIP: <b>{'да' if vip else 'нет'}</b>\n"
         f"• Показан «Доступ открыт»: <b>{'да' if shown_access else 'нет'}</b>\n"
         f"• Показан «VIP доступ»: <b>{'да' if shown_vip else 'нет'}</b>\n"
+        f"• Доставка: <b>{_fmt_delivery(u)}</b>\n"
         f"• Создан: <code>{str(created) if created else '—'}</code>\n"
         f"• Обновлён: <code>{str(updated) if updated else '—'}</code>\n"
+        f"• Был активен: <code>{seen}</code>\n"
     )
 
-async def _show_user_card(ctx, u: User, page: int):
-    kb = _kb_back_to_list(page)
+async def _show_user_card(ctx, u: User, back_cb: str):
+    kb = _kb_back_to_list(back_cb)
     await _render_one(ctx, _fmt_user_card(u), kb)
 
 @router.callback_query(F.data.startswith("users:open:"))
 async def open_user_card(call: CallbackQuery):
-    _, _, uid, page = call.data.split(":")
-    async with async_session() as session:
+    # users:open:<id>:<стр>:<ключ первой строки страницы>
+    parts = call.data.split(":", 4)
+    uid, page = parts[2], parts[3]
+    back_cb = f"users:page:{page}:s:{parts[4]}" if len(parts) > 4 and parts[4] else f"users:page:{page}"
+    async with async_read_session() as session:
         u = await session.get(User, int(uid))
     if not u:
         await call.answer("Пользователь не найден.", show_alert=True)
         return
-    await _show_user_card(call, u, page=int(page))
+    await _show_user_card(call, u, back_cb=back_cb)
     await call.answer()
 
 @router.callback_query(F.data == "users:noop")
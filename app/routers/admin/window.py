@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from typing import Union
+
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, Message
+
+from app.db.session import async_session
+from app.models.user import User
+from app.services.users import set_last_bot_message_id
+
+
+# «Одно окно» админки: прошлый экран бота удаляется, новый запоминается
+# в users.last_bot_message_id (через единый писатель)
+async def render_one(
+    ctx: Union[Message, CallbackQuery],
+    text: str,
+    kb: InlineKeyboardMarkup,
+    disable_preview: bool = True,
+) -> Message:
+    if isinstance(ctx, Message):
+        chat_id = ctx.chat.id
+        user_id = ctx.from_user.id
+        bot = ctx.bot
+        send = ctx.answer
+    else:
+        chat_id = ctx.message.chat.id
+        user_id = ctx.from_user.id
+        bot = ctx.message.bot
+        send = ctx.message.answer
+
+    last_id = None
+    async with async_session() as session:
+        u = await session.get(User, user_id)
+        if u:
+            last_id = u.last_bot_message_id
+    if last_id:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=last_id)
+        except Exception:
+            pass
+
+    sent = await send(text, reply_markup=kb, disable_web_page_preview=disable_preview)
+    await set_last_bot_message_id(user_id, sent.message_id, create=True)
+    return sent
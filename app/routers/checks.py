@@ -10,6 +10,7 @@ from aiogram.types import (
     FSInputFile,
 )
 
+
 from app.config import settings
 from app.db.session import async_session
 from app.models.user import User
@@ -17,6 +18,7 @@ from app.services.i18n import load_lang
 from app.services.tracking import ensure_click_id, build_ref_link_with_click
 from . import menu as menu_router  # для render_main_menu
 from app.services.subscriptions import verify_and_cache
+from app.services.users import set_last_bot_message_id as _save_last_bot_message_id
 
 router = Router(name=__name__)
 
@@ -131,12 +133,7 @@ async def get_user(tg_id: int) -> Optional[User]:
 
 
 async def set_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        user = await session.get(User, tg_id)
-        if not user:
-            return
-        user.last_bot_message_id = message_id
-        await session.commit()
+    await _save_last_bot_message_id(tg_id, message_id)
 
 
 # === One-window (image + caption + buttons) ===
@@ -263,7 +260,7 @@ async def show_instruction(ctx):
     await _send_window_with_image(ctx, text, kb_instruction(lang), image_name="instruction.jpg")
 
 # === DIRECT PUSH API (для web/postbacks) ===
-from app.services.users import decide_next_step, mark_regular_once_shown, mark_vip_once_shown
+from app.services.users import decide_next_step, mark_once, mark_regular_once_shown, mark_vip_once_shown
 
 async def _send_window_direct(bot, tg_id: int, caption_html: str, kb: InlineKeyboardMarkup, image_name: str):
     # удалить предыдущий экран
@@ -290,11 +287,7 @@ async def _send_window_direct(bot, tg_id: int, caption_html: str, kb: InlineKeyb
     if sent is None:
         sent = await bot.send_message(chat_id=tg_id, text=caption_html, reply_markup=kb)
 
-    async with async_session() as session:
-        u = await session.get(User, tg_id)
-        if u:
-            u.last_bot_message_id = sent.message_id
-            await session.commit()
+    await _save_last_bot_message_id(tg_id, sent.message_id)
 
 async def push_next_screen(bot, tg_id: int):
     """
@@ -331,19 +324,13 @@ async def push_next_screen(bot, tg_id: int):
         return
 
     if decision.step == "vip_once":
-        async with async_session() as session:
-            u3 = await session.get(User, tg_id)
-            mark_vip_once_shown(u3)
-            await session.commit()
+        await mark_once(tg_id, mark_vip_once_shown)
         text = f"<b>{t(lang, 'screen.vip.title')}</b>\n\n{t(lang, 'screen.vip.desc')}"
         await _send_window_direct(bot, tg_id, text, kb_vip(lang), "vip.jpg")
         return
 
     if decision.step == "access_ok_once":
-        async with async_session() as session:
-            u4 = await session.get(User, tg_id)
-            mark_regular_once_shown(u4)
-            await session.commit()
+        await mark_once(tg_id, mark_regular_once_shown)
         text = f"<b>{t(lang, 'screen.access_ok.title')}</b>\n\n{t(lang, 'screen.access_ok.desc')}"
         await _send_window_direct(bot, tg_id, text, kb_access_ok(lang), "access_ok.jpg")
         return
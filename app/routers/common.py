@@ -6,6 +6,7 @@ from aiogram.filters import Command
 from aiogram.types import (
     Message,
     CallbackQuery,
+    ChatMemberUpdated,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
@@ -13,6 +14,8 @@ from aiogram.types import (
 from app.db.session import async_session
 from app.models.user import User
 from app.services.i18n import load_lang
+from app.services.delivery import mark_alive, mark_dead
+from app.services.users import get_or_create_user, set_last_bot_message_id
 
 router = Router(name=__name__)
 
@@ -98,34 +101,13 @@ def t(lang: str, key: str) -> str:
     return val
 
 # ==== БАЗОВЫЕ УТИЛИТЫ ====
-async def get_or_create_user(tg_id: int, lang: Optional[str] = None) -> User:
-    async with async_session() as session:
-        user = await session.get(User, tg_id)
-        if not user:
-            user = User(id=tg_id)
-            if lang:
-                user.lang = lang
-            session.add(user)
-            await session.commit()
-            await session.refresh(user)
-        else:
-            if lang and user.lang != lang:
-                user.lang = lang
-                await session.commit()
-        return user
-
 async def get_user_lang(tg_id: int) -> str:
     async with async_session() as session:
         user = await session.get(User, tg_id)
         return user.lang if user and user.lang in SUPPORTED_LANGS else "en"
 
 async def update_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        user = await session.get(User, tg_id)
-        if not user:
-            return
-        user.last_bot_message_id = message_id
-        await session.commit()
+    await set_last_bot_message_id(tg_id, message_id)
 
 # ==== КЛАВИАТУРЫ ====
 def kb_language() -> InlineKeyboardMarkup:
@@ -213,3 +195,14 @@ async def cmd_menu(m: Message):
     text = f"<b>{t(lang, 'screen.menu.title')}</b>\n\n{t(lang, 'screen.menu.desc')}"
     sent = await m.answer(text, reply_markup=kb_main(lang, vip=False))
     await update_last_bot_message_id(m.from_user.id, sent.message_id)
+
+
+# ==== БЛОКИРОВКА / РАЗБЛОКИРОВКА БОТА ====
+@router.my_chat_member(F.chat.type == "private")
+async def on_my_chat_member(event: ChatMemberUpdated):
+    # Telegram сам сообщает, когда пользователь блокирует/разблокирует бота
+    status = event.new_chat_member.status
+    if status == "kicked":
+        await mark_dead([event.from_user.id], "blocked")
+    elif status == "member":
+        await mark_alive(event.from_user.id)
@@ -17,6 +17,7 @@ from aiogram.types import (
 from app.config import settings
 from app.db.session import async_session
 from app.models.user import User
+from app.services.users import set_last_bot_message_id
 
 router = Router(name=__name__)
 IMG_DIR = Path(__file__).resolve().parents[1] / "assets" / "images"
@@ -29,12 +30,7 @@ async def _get_user(tg_id: int) -> Optional[User]:
 
 
 async def _set_last_bot_message_id(tg_id: int, message_id: Optional[int]):
-    async with async_session() as session:
-        u = await session.get(User, tg_id)
-        if not u:
-            return
-        u.last_bot_message_id = message_id
-        await session.commit()
+    await set_last_bot_message_id(tg_id, message_id)
 
 
 # ===== MAIN MENU RENDER =====
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import List
+
+import numpy as np
+from sqlalchemy import select, tuple_
+
+from app.config import settings
+from app.db.session import async_read_session
+from app.models.postback import Postback
+from app.models.user import User
+
+# Колонки читаем пачками (keyset по id) через читающий движок — без ORM-объектов в памяти
+CHUNK = 20_000
+
+WEEK = 7 * 86400
+# 1970-01-01 — четверг; сдвиг на 4 дня выравнивает недели по понедельникам
+_MONDAY_SHIFT = 4 * 86400
+
+FUNNEL_STEPS = ("start", "lang", "registration", "access", "vip")
+
+
+@dataclass
+class UserColumns:
+    ids: np.ndarray          # int64, по возрастанию
+    created: np.ndarray      # int64, unix
+    has_lang: np.ndarray     # bool
+    registered: np.ndarray   # bool
+    deposit: np.ndarray      # float64
+    vip: np.ndarray          # bool
+
+
+@dataclass
+class Funnel:
+    counts: List[int]        # по FUNNEL_STEPS
+
+    def conversion(self, i: int) -> float:
+        prev = self.counts[i - 1] if i else self.counts[0]
+        return self.counts[i] / prev if prev else 0.0
+
+
+@dataclass
+class Cohorts:
+    weeks: List[datetime] = field(default_factory=list)   # понедельник недели когорты (UTC)
+    sizes: List[int] = field(default_factory=list)
+    # retention[c][k] — доля когорты c с активностью на неделе c+k (None — неделя ещё не наступила)
+    retention: List[List[float | None]] = field(default_factory=list)
+
+
+def _week_of(ts: np.ndarray) -> np.ndarray:
+    return (ts - _MONDAY_SHIFT) // WEEK
+
+
+def _first_week(weeks: int, now_ts: int) -> int:
+    """Номер недели самой ранней когорты окна из `weeks` недель, включая текущую."""
+    return int(_week_of(np.asarray([now_ts]))[0]) - weeks + 1
+
+
+def _to_ts(dt: datetime | None) -> int:
+    # created_at — naive UTC
+    return int(dt.replace(tzinfo=timezone.utc).timestamp()) if dt else 0
+
+
+# ========= Загрузка колонок =========
+#
+# Каждая пачка сразу превращается в numpy-массивы, в конце — один
+# np.concatenate: в памяти нет миллиона Python-объектов на колонку.
+
+def _concat(parts: List[np.ndarray], dtype) -> np.ndarray:
+    return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+
+async def load_user_columns() -> UserColumns:
+    ids: List[np.ndarray] = []
+    created: List[np.ndarray] = []
+    has_lang: List[np.ndarray] = []
+    registered: List[np.ndarray] = []
+    deposit: List[np.ndarray] = []
+    vip: List[np.ndarray] = []
+
+    last = None
+    while True:
+        q = select(
+            User.id, User.created_at, User.lang, User.is_registered, User.deposit_total_usd, User.has_vip,
+        ).order_by(User.id).limit(CHUNK)
+        if last is not None:
+            q = q.where(User.id > last)
+        async with async_read_session() as session:
+            rows = (await session.execute(q)).all()
+        if not rows:
+            break
+        last = rows[-1][0]
+        n = len(rows)
+        uid, c_at, lang, reg, dep, has_vip = zip(*rows)
+        ids.append(np.fromiter(uid, dtype=np.int64, count=n))
+        created.append(np.fromiter((_to_ts(c) for c in c_at), dtype=np.int64, count=n))
+        has_lang.append(np.fromiter((v is not None for v in lang), dtype=bool, count=n))
+        registered.append(np.fromiter((bool(v) for v in reg), dtype=bool, count=n))
+        deposit.append(np.fromiter((float(v or 0.0) for v in dep), dtype=np.float64, count=n))
+        vip.append(np.fromiter((bool(v) for v in has_vip), dtype=bool, count=n))
+        if n < CHUNK:
+            break
+
+    return UserColumns(
+        ids=_concat(ids, np.int64),
+        created=_concat(created, np.int64),
+        has_lang=_concat(has_lang, bool),
+        registered=_concat(registered, bool),
+        deposit=_concat(deposit, np.float64),
+        vip=_concat(vip, bool),
+    )
+
+
+async def load_activity(since_ts: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (tg_id, ts) постбэков с известным пользователем и временем не раньше
+    since_ts. Keyset по (ts, id) — идёт по ix_postbacks_ts, старые
+    постбэки не читаются вовсе.
+    """
+    tg: List[np.ndarray] = []
+    ts: List[np.ndarray] = []
+    order_key = tuple_(Postback.ts, Postback.id)
+    cond = Postback.ts >= since_ts
+    while True:
+        async with async_read_session() as session:
+            rows = (await session.execute(
+                select(Postback.ts, Postback.id, Postback.tg_id)
+                .where(cond, Postback.tg_id.isnot(None))
+                .order_by(Postback.ts, Postback.id)
+                .limit(CHUNK)
+            )).all()
+        if not rows:
+            break
+        cond = order_key > tuple_(rows[-1][0], rows[-1][1])
+        n = len(rows)
+        chunk_ts, _, chunk_tg = zip(*rows)
+        tg.append(np.fromiter(chunk_tg, dtype=np.int64, count=n))
+        ts.append(np.fromiter(chunk_ts, dtype=np.int64, count=n))
+        if n < CHUNK:
+            break
+    return _concat(tg, np.int64), _concat(ts, np.int64)
+
+
+# ========= Расчёты =========
+
+def compute_funnel(u: UserColumns) -> Funnel:
+    """Воронка строгая: каждый шаг включает только прошедших предыдущий."""
+    access = u.deposit >= settings.ACCESS_THRESHOLD_USD if settings.REQUIRE_DEPOSIT else np.ones_like(u.registered)
+    vip = u.vip | (u.deposit >= settings.VIP_THRESHOLD_USD)
+
+    lang_m = u.has_lang
+    reg_m = lang_m & u.registered
+    access_m = reg_m & access
+    vip_m = access_m & vip
+    return Funnel(counts=[int(u.ids.size), int(lang_m.sum()), int(reg_m.sum()), int(access_m.sum()), int(vip_m.sum())])
+
+
+def compute_cohorts(u: UserColumns, act_tg: np.ndarray, act_ts: np.ndarray, weeks: int, now_ts: int) -> Cohorts:
+    """
+    Недельные когорты по created_at и удержание: доля когорты, у которой
+    на k-й неделе после прихода был хотя бы один постбэк.
+    """
+    if not u.ids.size:
+        return Cohorts()
+
+    first_week = _first_week(weeks, now_ts)
+    user_week = _week_of(u.created)
+    cohort = user_week - first_week                       # 0..weeks-1 для попавших в окно
+    in_window = (cohort >= 0) & (cohort < weeks)
+    sizes = np.bincount(cohort[in_window], minlength=weeks)
+
+    # постбэк -> индекс пользователя (ids отсортированы)
+    pos = np.searchsorted(u.ids, act_tg)
+    pos = np.clip(pos, 0, u.ids.size - 1)
+    known = (u.ids[pos] == act_tg) & in_window[pos]
+    pos = pos[known]
+    offset = _week_of(act_ts[known]) - user_week[pos]     # неделя активности относительно прихода
+    ok = (offset >= 0) & (offset < weeks)
+    pos, offset = pos[ok], offset[ok]
+
+    # одна отметка на (пользователь, неделя), затем счёт по (когорта, неделя)
+    pairs = np.unique(pos * weeks + offset)
+    p_user, p_off = pairs // weeks, pairs % weeks
+    active = np.bincount(cohort[p_user] * weeks + p_off, minlength=weeks * weeks).reshape(weeks, weeks)
+
+    out = Cohorts()
+    for c in range(weeks):
+        week_ts = (first_week + c) * WEEK + _MONDAY_SHIFT
+        out.weeks.append(datetime.fromtimestamp(week_ts, tz=timezone.utc))
+        out.sizes.append(int(sizes[c]))
+        row: List[float | None] = []
+        for k in range(weeks):
+            if c + k > weeks - 1:
+                row.append(None)
+            else:
+                row.append(float(active[c, k]) / sizes[c] if sizes[c] else 0.0)
+        out.retention.append(row)
+    return out
+
+
+async def build_report(weeks: int = 8) -> tuple[Funnel, Cohorts]:
+    now_ts = int(datetime.now(tz=timezone.utc).timestamp())
+    users = await load_user_columns()
+    # активность раньше первой недели окна ни в одну когорту не попадёт
+    act_tg, act_ts = await load_activity(since_ts=_first_week(weeks, now_ts) * WEEK + _MONDAY_SHIFT)
+    # расчёт — в отдельном потоке, чтобы не держать цикл событий
+    funnel, cohorts = await asyncio.to_thread(
+        lambda: (compute_funnel(users), compute_cohorts(users, act_tg, act_ts, weeks, now_ts))
+    )
+    return funnel, cohorts
@@ -0,0 +1,936 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select, update, insert, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.db.session import async_session
+from app.db.writer import write
+from app.models.broadcast import BroadcastJob, BroadcastDelivery
+from app.models.user import User
+from app.services.delivery import DEAD_KINDS, classify_send_error, mark_dead
+from app.services.ratelimit import SendAborted, abort_when, bulk_traffic
+from app.services.scheduler import scheduler, to_ts
+from app.services.segments import Segment, compile_segment
+
+log = logging.getLogger(__name__)
+
+# Размер пачки (= параллельных отправок у одного воркера) и число воркеров.
+# Темп задаёт общий лимитер (app/services/ratelimit.py), не пауза.
+BATCH = 25
+WORKERS = 2
+
+# Как часто раннер перечитывает статус задачи во время отправки пачек, сек:
+# пауза/отмена снимает ещё не ушедшие отправки, не дожидаясь конца пачки
+STATUS_POLL = 1.0
+
+# Живые раннеры в этом процессе: job_id -> task / репортёр прогресса
+_tasks: dict[int, asyncio.Task] = {}
+_reporters: dict[int, "ProgressReporter"] = {}
+
+
+# ========= Отправка одному получателю =========
+
+def user_button_markup(text: Optional[str], url: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    if not (text and url):
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=text, url=url)]])
+
+
+@dataclass
+class Payload:
+    """
+    Всё, что нужно для отправки одному получателю. Собирается один раз
+    на запуск раннера — разметка и текст не пересобираются на каждую отправку.
+    """
+    mode: str
+    text: str
+    media: Optional[str]
+    markup: Optional[InlineKeyboardMarkup]
+    source_chat_id: Optional[int]
+    source_message_id: Optional[int]
+
+    @classmethod
+    def from_job(cls, job: BroadcastJob) -> "Payload":
+        mode = job.mode if job.mode == "copy" and job.source_message_id else "direct"
+        return cls(
+            mode=mode,
+            text=job.text,
+            media=job.media,
+            markup=user_button_markup(job.btn_text, job.btn_url),
+            source_chat_id=job.source_chat_id,
+            source_message_id=job.source_message_id,
+        )
+
+
+async def _send_direct(bot: Bot, uid: int, p: Payload) -> None:
+    if p.media:
+        # media — file_id уже загруженного фото, файл повторно не передаётся
+        await bot.send_photo(uid, p.media, caption=p.text, reply_markup=p.markup)
+    else:
+        await bot.send_message(uid, p.text, reply_markup=p.markup)
+
+
+# Отправку сняли до запроса (пауза/отмена): строку возвращаем в pending
+ABORTED = ("aborted", "job stopped before send")
+
+
+async def _send_to_user(bot: Bot, uid: int, p: Payload) -> Optional[Tuple[str, str]]:
+    """
+    Возвращает None при успехе, ABORTED — если отправку сняли до запроса,
+    иначе (вид ошибки, короткий текст).
+    """
+    try:
+        if p.mode == "copy":
+            try:
+                await bot.copy_message(uid, p.source_chat_id, p.source_message_id, reply_markup=p.markup)
+                return None
+            except TelegramBadRequest as e:
+                if "message to copy not found" not in str(e).lower():
+                    raise
+                # исходник удалили — дальше этот запуск шлёт напрямую
+                log.warning("Broadcast source message is gone, falling back to direct sends")
+                p.mode = "direct"
+        await _send_direct(bot, uid, p)
+        return None
+    except SendAborted:
+        return ABORTED
+    except Exception as e:
+        return classify_send_error(e), f"{type(e).__name__}: {e}"
+
+
+async def stage_job(bot: Bot, job_id: int, staging_chat_id: int) -> None:
+    """
+    Режим 'copy': публикует сообщение один раз в служебный чат и запоминает
+    его как исходник для copy_message. Если опубликовать не вышло — 'direct'.
+    """
+    job = await get_job(job_id)
+    if not job:
+        return
+    mode, src_id = "direct", None
+    if settings.BROADCAST_MODE == "copy":
+        try:
+            p = Payload.from_job(job)
+            if p.media:
+                sent = await bot.send_photo(staging_chat_id, p.media, caption=p.text, reply_markup=p.markup)
+            else:
+                sent = await bot.send_message(staging_chat_id, p.text, reply_markup=p.markup)
+            mode, src_id = "copy", sent.message_id
+        except Exception:
+            log.exception("Failed to stage broadcast #%s, using direct sends", job_id)
+
+    async def _save(session: AsyncSession) -> None:
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id)
+            .values(mode=mode, source_chat_id=staging_chat_id if src_id else None, source_message_id=src_id)
+        )
+
+    await write(_save)
+
+
+# ========= Экран прогресса =========
+
+STATUS_LABELS = {
+    "scheduled": "🕒 запланирована",
+    "running": "⏳ идёт",
+    "paused": "⏸ на паузе",
+    "cancelled": "✖️ отменена",
+    "done": "✅ завершена",
+}
+
+
+def _fmt_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    h, rest = divmod(seconds, 3600)
+    m, sec = divmod(rest, 60)
+    return f"{h}:{m:02d}:{sec:02d}" if h else f"{m}:{sec:02d}"
+
+
+def fmt_period(seconds: int) -> str:
+    if seconds % 86400 == 0:
+        return f"{seconds // 86400} д"
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600} ч"
+    return f"{seconds // 60} мин"
+
+
+def live_rate(job: BroadcastJob) -> float:
+    """
+    Скорость отправки, сообщений/сек: по окну раннера, если он работает
+    в этом процессе, иначе — средняя с момента старта.
+    """
+    rep = _reporters.get(job.id)
+    if rep:
+        return rep.rate()
+    processed = (job.sent_ok or 0) + (job.sent_fail or 0)
+    if job.status != "running" or not job.started_at or not processed:
+        return 0.0
+    elapsed = (datetime.utcnow() - job.started_at).total_seconds()
+    return processed / elapsed if elapsed > 0 else 0.0
+
+
+def format_job(job: BroadcastJob, rate: Optional[float] = None) -> str:
+    processed = (job.sent_ok or 0) + (job.sent_fail or 0)
+    lines = [
+        f"<b>📣 Рассылка #{job.id}</b> — {STATUS_LABELS.get(job.status, job.status)}\n",
+        f"Обработано: <b>{processed}/{job.total}</b>",
+        f"Успешно: <b>{job.sent_ok}</b>",
+        f"Не доставлено: <b>{job.sent_fail}</b>",
+        f"Режим: <b>{'copy_message' if job.mode == 'copy' else 'прямая отправка'}</b>",
+    ]
+    if job.status == "scheduled" and job.scheduled_at:
+        lines.append(f"Запуск: <b>{job.scheduled_at:%Y-%m-%d %H:%M} UTC</b>")
+    if job.repeat_every_sec:
+        lines.append(f"Повтор: каждые <b>{fmt_period(job.repeat_every_sec)}</b>")
+    if job.status == "running":
+        rate = live_rate(job) if rate is None else rate
+        if rate > 0:
+            remaining = max((job.total or 0) - processed, 0)
+            lines.append(f"Скорость: <b>{rate:.1f}</b> сообщ./с")
+            lines.append(f"Осталось: <b>~{_fmt_eta(remaining / rate)}</b>")
+    return "\n".join(lines)
+
+
+def kb_job(job: BroadcastJob) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    if job.status == "running":
+        rows.append([
+            InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bc:job:pause:{job.id}"),
+            InlineKeyboardButton(text="✖️ Отменить", callback_data=f"bc:job:cancel:{job.id}"),
+        ])
+    elif job.status == "scheduled":
+        rows.append([InlineKeyboardButton(text="✖️ Отменить", callback_data=f"bc:job:cancel:{job.id}")])
+    elif job.status == "paused":
+        rows.append([
+            InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bc:job:resume:{job.id}"),
+            InlineKeyboardButton(text="✖️ Отменить", callback_data=f"bc:job:cancel:{job.id}"),
+        ])
+    if job.status in ("running", "paused"):
+        rows.append([InlineKeyboardButton(text="🔄 Обновить", callback_data=f"bc:job:refresh:{job.id}")])
+    rows.append([InlineKeyboardButton(text="📋 Рассылки", callback_data="bc:jobs")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="admin:back")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+class ProgressReporter:
+    """
+    Обновляет экран прогресса не чаще раза в `interval` секунд и только
+    если текст изменился — правки экрана тратят тот же лимит Bot API.
+    Скорость считается по скользящему окну последних замеров.
+    """
+
+    def __init__(self, bot: Bot, interval: float, window: float = 30.0):
+        self.bot = bot
+        self.interval = interval
+        self.window = window
+        self._samples: deque[tuple[float, int]] = deque()
+        self._last_at = 0.0
+        self._last_text: Optional[str] = None
+
+    def observe(self, job: BroadcastJob) -> None:
+        now = time.monotonic()
+        self._samples.append((now, (job.sent_ok or 0) + (job.sent_fail or 0)))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    def rate(self) -> float:
+        if len(self._samples) < 2:
+            return 0.0
+        (t0, n0), (t1, n1) = self._samples[0], self._samples[-1]
+        return (n1 - n0) / (t1 - t0) if t1 > t0 else 0.0
+
+    async def report(self, job: BroadcastJob, force: bool = False) -> None:
+        self.observe(job)
+        if not job.progress_message_id:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_at < self.interval:
+            return
+        text = format_job(job, self.rate())
+        self._last_at = now
+        if text == self._last_text:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=job.admin_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=kb_job(job),
+                disable_web_page_preview=True,
+            )
+            self._last_text = text
+        except Exception:
+            pass
+
+
+# ========= Аудитория =========
+
+async def _audience_page(seg: Segment, after_id: int, limit: int) -> List[int]:
+    async with async_session() as session:
+        q = select(User.id).where(User.id > after_id, *compile_segment(seg)).order_by(User.id).limit(limit)
+        return list((await session.execute(q)).scalars().all())
+
+
+# ========= CRUD задач =========
+
+async def create_job(
+    *,
+    admin_id: int,
+    admin_chat_id: int,
+    seg: Segment,
+    text: str,
+    media: Optional[str],
+    btn_text: Optional[str],
+    btn_url: Optional[str],
+    total: int,
+    scheduled_at: Optional[datetime] = None,
+    repeat_every_sec: Optional[int] = None,
+) -> int:
+    """
+    Создаёт задачу. Доставки раннер добавляет сам, по мере обхода сегмента;
+    total — оценка аудитории на момент запуска (уточняется в конце обхода).
+    С scheduled_at задача создаётся в статусе 'scheduled' (см. schedule_job).
+    """
+    async def _save(session: AsyncSession) -> int:
+        job = BroadcastJob(
+            status="scheduled" if scheduled_at else "running",
+            created_by=admin_id,
+            admin_chat_id=admin_chat_id,
+            segment=seg.to_json(),
+            text=text,
+            media=media,
+            btn_text=btn_text,
+            btn_url=btn_url,
+            total=total,
+            sent_ok=0,
+            sent_fail=0,
+            scheduled_at=scheduled_at,
+            repeat_every_sec=repeat_every_sec,
+            started_at=None if scheduled_at else datetime.utcnow(),
+        )
+        session.add(job)
+        # id нужен до коммита
+        await session.flush()
+        return job.id
+
+    return await write(_save)
+
+
+async def get_job(job_id: int) -> Optional[BroadcastJob]:
+    async with async_session() as session:
+        return await session.get(BroadcastJob, job_id)
+
+
+async def list_jobs(limit: int = 10) -> List[BroadcastJob]:
+    async with async_session() as session:
+        q = select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit)
+        return list((await session.execute(q)).scalars().all())
+
+
+async def set_progress_message(job_id: int, message_id: Optional[int]) -> None:
+    async def _save(session: AsyncSession) -> None:
+        await session.execute(
+            update(BroadcastJob).where(BroadcastJob.id == job_id).values(progress_message_id=message_id)
+        )
+
+    await write(_save)
+
+
+async def _set_status(job_id: int, new: str, allowed_from: tuple[str, ...]) -> Optional[BroadcastJob]:
+    async def _save(session: AsyncSession) -> Optional[BroadcastJob]:
+        job = await session.get(BroadcastJob, job_id)
+        if not job or job.status not in allowed_from:
+            return job
+        job.status = new
+        if new in ("cancelled", "done"):
+            job.finished_at = datetime.utcnow()
+        return job
+
+    return await write(_save)
+
+
+async def pause_job(job_id: int) -> Optional[BroadcastJob]:
+    # раннер увидит новый статус за STATUS_POLL: неотправленное вернётся в pending
+    return await _set_status(job_id, "paused", ("running",))
+
+
+async def cancel_job(job_id: int) -> Optional[BroadcastJob]:
+    scheduler.cancel(_schedule_key(job_id))
+    return await _set_status(job_id, "cancelled", ("scheduled", "running", "paused"))
+
+
+async def resume_job(bot: Bot, job_id: int) -> Optional[BroadcastJob]:
+    job = await _set_status(job_id, "running", ("paused",))
+    if job and job.status == "running":
+        start_job(bot, job_id)
+    return job
+
+
+# ========= Расписание =========
+
+def _schedule_key(job_id: int) -> str:
+    return f"broadcast:{job_id}"
+
+
+def schedule_job(bot: Bot, job: BroadcastJob) -> None:
+    if job.status == "scheduled" and job.scheduled_at:
+        scheduler.add(_schedule_key(job.id), to_ts(job.scheduled_at), lambda: _launch_scheduled(bot, job.id))
+
+
+def _next_occurrence(at: datetime, every_sec: int, now: datetime) -> datetime:
+    # пропущенные за время простоя повторы не копим — берём ближайший будущий
+    step = timedelta(seconds=every_sec)
+    if at > now:
+        return at + step
+    missed = int((now - at) / step) + 1
+    return at + step * missed
+
+
+async def _launch_scheduled(bot: Bot, job_id: int) -> None:
+    async def _start(session: AsyncSession) -> Optional[BroadcastJob]:
+        job = await session.get(BroadcastJob, job_id)
+        if not job or job.status != "scheduled":
+            return None
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        return job
+
+    job = await write(_start)
+    if job is None:
+        return
+
+    # Следующий повтор — отдельная задача со своими доставками
+    if job.repeat_every_sec and job.scheduled_at:
+        next_id = await create_job(
+            admin_id=job.created_by,
+            admin_chat_id=job.admin_chat_id,
+            seg=Segment.from_json(job.segment),
+            text=job.text,
+            media=job.media,
+            btn_text=job.btn_text,
+            btn_url=job.btn_url,
+            total=0,
+            scheduled_at=_next_occurrence(job.scheduled_at, job.repeat_every_sec, datetime.utcnow()),
+            repeat_every_sec=job.repeat_every_sec,
+        )
+        nxt = await get_job(next_id)
+        if nxt:
+            schedule_job(bot, nxt)
+
+    seg = Segment.from_json(job.segment)
+    async with async_session() as session:
+        total = (await session.execute(
+            select(func.count()).select_from(User).where(*compile_segment(seg))
+        )).scalar_one()
+
+    async def _save(session: AsyncSession) -> None:
+        await session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(total=total))
+
+    await write(_save)
+
+    await stage_job(bot, job_id, settings.BROADCAST_STAGING_CHAT_ID or job.admin_chat_id)
+    start_job(bot, job_id)
+
+
+async def load_schedule(bot: Bot) -> None:
+    """
+    На старте регистрирует в планировщике все задачи 'scheduled'.
+    Просроченные планировщик запустит сам, с интервалом catch-up.
+    """
+    async with async_session() as session:
+        jobs = (await session.execute(
+            select(BroadcastJob)
+            .where(BroadcastJob.status == "scheduled")
+            .order_by(BroadcastJob.scheduled_at)
+        )).scalars().all()
+    for job in jobs:
+        schedule_job(bot, job)
+
+
+async def list_upcoming(limit: int = 10) -> List[BroadcastJob]:
+    async with async_session() as session:
+        q = (
+            select(BroadcastJob)
+            .where(BroadcastJob.status == "scheduled")
+            .order_by(BroadcastJob.scheduled_at)
+            .limit(limit)
+        )
+        return list((await session.execute(q)).scalars().all())
+
+
+# ========= Раннер =========
+#
+# Один и тот же цикл работает либо в процессе бота, либо в нескольких
+# процессах-воркерах (app/broadcast_worker.py). Координация — только через БД:
+#   - диапазон аудитории забирается сдвигом audience_cursor с проверкой
+#     старого значения (compare-and-swap), поэтому два процесса не возьмут
+#     одних и тех же получателей;
+#   - готовые строки доставок захватываются pending -> 'sending' с меткой
+#     claim = "<процесс>:<пачка>"; по префиксу метки супервизор возвращает
+#     в failed строки упавшего воркера.
+
+_claim_prefix = f"main-{os.getpid()}"
+# Процесс бота рисует прогресс сам, пока рассылку не ведут воркеры
+_report_progress = True
+_is_worker = False
+
+
+def configure_worker(name: str, report_progress: bool) -> None:
+    """Вызывается процессом-воркером до запуска раннеров."""
+    global _claim_prefix, _report_progress, _is_worker
+    _claim_prefix = name
+    _report_progress = report_progress
+    _is_worker = True
+
+
+def start_job(bot: Bot, job_id: int) -> None:
+    """
+    Запускает раннер задачи в фоне (если он ещё не работает в этом процессе).
+    Если рассылку ведут процессы-воркеры, процесс бота ничего не запускает —
+    воркеры сами подхватят задачу в статусе 'running'.
+    """
+    if settings.BROADCAST_WORKER_PROCESSES > 0 and not _is_worker:
+        return
+    task = _tasks.get(job_id)
+    if task and not task.done():
+        return
+    task = asyncio.create_task(_run_job(bot, job_id))
+    _tasks[job_id] = task
+    task.add_done_callback(lambda _t, jid=job_id: _tasks.pop(jid, None))
+
+
+Batch = Tuple[str, List[Tuple[int, int]]]  # (claim, [(delivery_id, user_id)])
+
+
+def _new_claim() -> str:
+    return f"{_claim_prefix}:{uuid.uuid4().hex[:12]}"
+
+
+async def _claimed_rows(session, claim: str) -> List[Tuple[int, int]]:
+    rows = (await session.execute(
+        select(BroadcastDelivery.id, BroadcastDelivery.user_id)
+        .where(BroadcastDelivery.claim == claim)
+        .order_by(BroadcastDelivery.id)
+    )).all()
+    return [(r[0], r[1]) for r in rows]
+
+
+async def _claim_pending(job_id: int, limit: int) -> Optional[Batch]:
+    """
+    Захватывает до `limit` строк pending (остались после паузы/рестарта).
+    UPDATE с повторной проверкой статуса — строку получит только один процесс;
+    у остановленной задачи (не 'running') ничего не захватывается.
+    """
+    claim = _new_claim()
+    running = (
+        select(BroadcastJob.id)
+        .where(BroadcastJob.id == job_id, BroadcastJob.status == "running")
+        .exists()
+    )
+    ids = (
+        select(BroadcastDelivery.id)
+        .where(BroadcastDelivery.job_id == job_id, BroadcastDelivery.status == "pending")
+        .order_by(BroadcastDelivery.id)
+        .limit(limit)
+        .scalar_subquery()
+    )
+
+    async def _take(session: AsyncSession) -> Optional[Batch]:
+        res = await session.execute(
+            update(BroadcastDelivery)
+            .where(BroadcastDelivery.id.in_(ids), BroadcastDelivery.status == "pending", running)
+            .values(status="sending", claim=claim)
+            .execution_options(synchronize_session=False)
+        )
+        if not res.rowcount:
+            return None
+        return claim, await _claimed_rows(session, claim)
+
+    return await write(_take)
+
+
+async def _claim_range(job_id: int, seg: Segment, limit: int) -> Optional[Batch]:
+    """
+    Забирает следующий диапазон аудитории после audience_cursor.
+    None — задача остановлена или сегмент пройден до конца.
+    """
+    while True:
+        job = await get_job(job_id)
+        if not job or job.status != "running" or job.audience_done:
+            return None
+        cursor = job.audience_cursor
+        ids = await _audience_page(seg, cursor, limit)
+        moved = BroadcastJob.id == job_id, BroadcastJob.audience_cursor == cursor
+
+        if not ids:
+            async def _close(session: AsyncSession) -> bool:
+                res = await session.execute(update(BroadcastJob).where(*moved).values(audience_done=True))
+                return res.rowcount == 1
+
+            if await write(_close):
+                return None
+            continue
+
+        claim = _new_claim()
+
+        async def _take(session: AsyncSession) -> Optional[Batch]:
+            res = await session.execute(update(BroadcastJob).where(*moved).values(audience_cursor=ids[-1]))
+            if res.rowcount != 1:
+                # курсор не сдвинулся — ничего не записано, откатывать нечего
+                return None
+            rows = (await session.execute(
+                insert(BroadcastDelivery).returning(BroadcastDelivery.id, BroadcastDelivery.user_id),
+                [{"job_id": job_id, "user_id": uid, "status": "sending", "claim": claim} for uid in ids],
+            )).all()
+            return claim, [(r[0], r[1]) for r in rows]
+
+        batch = await write(_take)
+        if batch is None:
+            # диапазон уже забрал другой процесс — читаем курсор заново
+            continue
+        return batch
+
+
+async def _release(claim: str, delivery_ids: Optional[List[int]] = None) -> None:
+    # пауза/отмена до отправки: пачка (или её неотправленные строки) снова
+    # pending, её подхватит следующий запуск
+    cond = [BroadcastDelivery.claim == claim, BroadcastDelivery.status == "sending"]
+    if delivery_ids is not None:
+        cond.append(BroadcastDelivery.id.in_(delivery_ids))
+
+    async def _save(session: AsyncSession) -> None:
+        await session.execute(update(BroadcastDelivery).where(*cond).values(status="pending", claim=None))
+
+    await write(_save)
+
+
+async def _record_results(job_id: int, results: List[Tuple[int, int, Optional[Tuple[str, str]]]]) -> BroadcastJob:
+    """
+    results: (delivery_id, user_id, None | (kind, text)). Мёртвые чаты помечаем
+    на User — следующие рассылки их пропустят.
+    """
+    ok = sum(1 for _, _, err in results if err is None)
+    fail = len(results) - ok
+    now = datetime.utcnow()
+
+    dead: dict[str, List[int]] = {}
+    for _, uid, err in results:
+        if err and err[0] in DEAD_KINDS:
+            dead.setdefault(err[0], []).append(uid)
+    for kind, uids in dead.items():
+        await mark_dead(uids, kind)
+
+    async def _save(session: AsyncSession) -> BroadcastJob:
+        await session.execute(
+            update(BroadcastDelivery),
+            [
+                {
+                    "id": did,
+                    "status": "sent" if err is None else "failed",
+                    "error": None if err is None else f"{err[0]}: {err[1]}"[:255],
+                    "updated_at": now,
+                }
+                for did, _, err in results
+            ],
+        )
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id)
+            .values(sent_ok=BroadcastJob.sent_ok + ok, sent_fail=BroadcastJob.sent_fail + fail)
+        )
+        # счётчики после UPDATE — из БД, а не из identity map пачки
+        return await session.get(BroadcastJob, job_id, populate_existing=True)
+
+    # статусы пачки и счётчики задачи — одним намерением единого писателя
+    return await write(_save)
+
+
+async def _finish_if_complete(job_id: int) -> Optional[BroadcastJob]:
+    """
+    'done' ставит тот процесс, который увидел пройденный сегмент и ни одной
+    незавершённой строки. Условие целиком в WHERE — гонки между процессами нет.
+    """
+    unfinished = (
+        select(BroadcastDelivery.id)
+        .where(BroadcastDelivery.job_id == job_id, BroadcastDelivery.status.in_(("pending", "sending")))
+        .exists()
+    )
+    total = (
+        select(func.count()).select_from(BroadcastDelivery)
+        .where(BroadcastDelivery.job_id == job_id)
+        .scalar_subquery()
+    )
+    async def _save(session: AsyncSession) -> None:
+        await session.execute(
+            update(BroadcastJob)
+            .where(
+                BroadcastJob.id == job_id,
+                BroadcastJob.status == "running",
+                BroadcastJob.audience_done.is_(True),
+                ~unfinished,
+            )
+            .values(status="done", total=total, finished_at=datetime.utcnow())
+        )
+
+    await write(_save)
+    return await get_job(job_id)
+
+
+async def _run_job(bot: Bot, job_id: int) -> None:
+    with bulk_traffic():
+        try:
+            await _run_job_loop(bot, job_id)
+        except Exception:
+            log.exception("Broadcast job #%s crashed", job_id)
+
+
+async def _produce(job_id: int, seg: Segment, queue: "asyncio.Queue[Batch]") -> None:
+    """
+    Кормит воркеров захваченными пачками: сначала pending, потом новые
+    диапазоны сегмента. Заканчивает, когда задача остановлена или
+    аудитория исчерпана (в том числе другими процессами).
+    """
+    while True:
+        # пауза/отмена: воркеры возвращают пачки в pending (_release) —
+        # без этой проверки они тут же захватывались бы снова
+        job = await get_job(job_id)
+        if not job or job.status != "running":
+            return
+        batch = await _claim_pending(job_id, BATCH)
+        if batch is None:
+            batch = await _claim_range(job_id, seg, BATCH)
+        if batch is None:
+            return
+        try:
+            await queue.put(batch)
+        except asyncio.CancelledError:
+            # раннер остановлен, пока ждали места в очереди: пачку не отправляли
+            await _release(batch[0])
+            raise
+
+
+async def _worker(
+    bot: Bot,
+    job_id: int,
+    payload: Payload,
+    reporter: Optional[ProgressReporter],
+    queue: "asyncio.Queue[Batch]",
+    stopped: asyncio.Event,
+) -> None:
+    while True:
+        claim, batch = await queue.get()
+        try:
+            job = await get_job(job_id)
+            if not job or job.status != "running":
+                await _release(claim)
+                continue
+            with abort_when(stopped.is_set):
+                errors = await asyncio.gather(*[_send_to_user(bot, uid, payload) for _, uid in batch])
+            results = [(did, uid, err) for (did, uid), err in zip(batch, errors) if err is not ABORTED]
+            if len(results) < len(batch):
+                await _release(claim, [did for (did, _), err in zip(batch, errors) if err is ABORTED])
+            job = await _record_results(job_id, results) if results else None
+        except BaseException:
+            # пачка могла частично уйти — как при падении процесса, помечаем failed
+            try:
+                await _fail_claim(claim)
+            except Exception:
+                log.exception("Failed to close claim %s", claim)
+            raise
+        finally:
+            queue.task_done()
+        if reporter and job:
+            await reporter.report(job)
+
+
+async def _watch_status(job_id: int, stopped: asyncio.Event) -> None:
+    # пауза/отмена приходит из админки, возможно, из другого процесса — только через БД
+    while not stopped.is_set():
+        await asyncio.sleep(STATUS_POLL)
+        job = await get_job(job_id)
+        if not job or job.status != "running":
+            stopped.set()
+
+
+async def _drain(producer: asyncio.Task, queue: "asyncio.Queue[Batch]") -> None:
+    # пачек больше не будет — ждём, пока воркеры разберут очередь
+    await producer
+    await queue.join()
+
+
+async def _run_batches(bot: Bot, job: BroadcastJob, reporter: Optional[ProgressReporter]) -> None:
+    """
+    Продюсер и воркеры по задаче — до паузы/отмены или конца аудитории.
+    Ошибку продюсера или воркера пробрасывает.
+    """
+    # Очередь ограничена — в памяти не больше нескольких пачек при любой аудитории
+    job_id = job.id
+    payload = Payload.from_job(job)
+    queue: asyncio.Queue[Batch] = asyncio.Queue(maxsize=WORKERS)
+    stopped = asyncio.Event()
+    workers = [asyncio.create_task(_worker(bot, job_id, payload, reporter, queue, stopped)) for _ in range(WORKERS)]
+    producer = asyncio.create_task(_produce(job_id, Segment.from_json(job.segment), queue))
+    drained = asyncio.create_task(_drain(producer, queue))
+    # в ожидание не входит: сам по себе раннер не завершает
+    watcher = asyncio.create_task(_watch_status(job_id, stopped))
+    try:
+        # воркеры сами не завершаются: если какой-то вернулся раньше _drain —
+        # он упал, и ждать очередь (или место в ней) больше некому
+        await asyncio.wait([drained, *workers], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        tasks = [producer, drained, watcher, *workers]
+        for t in tasks:
+            t.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # захваченные, но не взятые воркерами пачки — снова pending
+        while not queue.empty():
+            await _release(queue.get_nowait()[0])
+
+    for res in results:
+        if isinstance(res, Exception):
+            raise res
+
+
+async def _run_job_loop(bot: Bot, job_id: int) -> None:
+    job = await get_job(job_id)
+    if not job or job.status != "running":
+        return
+    reporter = None
+    if _report_progress:
+        reporter = ProgressReporter(bot, settings.BROADCAST_PROGRESS_INTERVAL)
+        _reporters[job_id] = reporter
+    try:
+        await _run_batches(bot, job, reporter)
+    finally:
+        _reporters.pop(job_id, None)
+
+    job = await _finish_if_complete(job_id)
+    if job and reporter:
+        await reporter.report(job, force=True)
+
+
+async def fail_claims(prefix: Optional[str] = None) -> int:
+    """
+    Строки 'sending' прерванного процесса: неизвестно, ушло ли сообщение,
+    поэтому помечаем их как failed (лучше недоставить, чем отправить дважды).
+    prefix=None — все такие строки (старт бота, воркеров ещё нет).
+    """
+    cond = [BroadcastDelivery.status == "sending"]
+    if prefix is not None:
+        cond.append(BroadcastDelivery.claim.like(f"{prefix}:%"))
+    return await _fail_sending(cond)
+
+
+def _owner_alive(owner: str) -> bool:
+    """
+    Жив ли процесс — владелец метки захвата (main-<pid> / w<i>-<pid>).
+    Свой pid — метка прошлого запуска (pid переиспользован): не жив.
+    На Windows os.kill(pid, 0) завершает процесс — там проверки нет.
+    """
+    try:
+        pid = int(owner.rsplit("-", 1)[1])
+    except (IndexError, ValueError):
+        return False
+    if pid == os.getpid() or os.name == "nt":
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+async def fail_orphaned_claims() -> int:
+    """
+    Старт бота: закрывает строки 'sending' только тех процессов, которых
+    уже нет. Живые воркеры прошлого запуска (бот убит без остановки
+    воркеров) свои пачки дописывают сами и завершаются, заметив смерть
+    родителя (app/broadcast_worker.py).
+    """
+    async with async_session() as session:
+        claims = (await session.execute(
+            select(BroadcastDelivery.claim).where(BroadcastDelivery.status == "sending").distinct()
+        )).scalars().all()
+    failed = 0
+    owners = {c.split(":", 1)[0] for c in claims if c}
+    for owner in sorted(owners):
+        if _owner_alive(owner):
+            log.warning("Claims of %s left as is: process is still running", owner)
+            continue
+        failed += await fail_claims(owner)
+    if None in claims:
+        failed += await _fail_sending([BroadcastDelivery.status == "sending", BroadcastDelivery.claim.is_(None)])
+    return failed
+
+
+async def _fail_claim(claim: str) -> int:
+    return await _fail_sending([BroadcastDelivery.status == "sending", BroadcastDelivery.claim == claim])
+
+
+async def _fail_sending(cond: list) -> int:
+    # подсчёт и UPDATE — в одной транзакции писателя, чтобы sent_fail сошёлся
+    async def _save(session: AsyncSession) -> int:
+        stuck = (await session.execute(
+            select(BroadcastDelivery.job_id, func.count()).where(*cond).group_by(BroadcastDelivery.job_id)
+        )).all()
+        for job_id, cnt in stuck:
+            await session.execute(
+                update(BroadcastDelivery)
+                .where(BroadcastDelivery.job_id == job_id, *cond)
+                .values(status="failed", error="interrupted")
+            )
+            await session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id)
+                .values(sent_fail=BroadcastJob.sent_fail + cnt)
+            )
+        return sum(cnt for _, cnt in stuck)
+
+    return await write(_save)
+
+
+async def stop_runners() -> None:
+    """
+    Останавливает раннеры этого процесса: взятые пачки закрываются как
+    прерванные, невзятые возвращаются в pending (см. _run_batches).
+    """
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def running_job_ids() -> List[int]:
+    async with async_session() as session:
+        return list((await session.execute(
+            select(BroadcastJob.id).where(BroadcastJob.status == "running")
+        )).scalars().all())
+
+
+async def resume_jobs(bot: Bot) -> None:
+    """
+    Вызывается на старте бота: закрывает прерванные пачки и поднимает
+    раннеры 'running' (или оставляет их процессам-воркерам).
+    """
+    await fail_orphaned_claims()
+    for job_id in await running_job_ids():
+        log.info("Resuming broadcast job #%s", job_id)
+        start_job(bot, job_id)
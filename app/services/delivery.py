@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Iterable, Literal
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.writer import write
+from app.models.user import User
+from app.services.segments import invalidate_counts
+
+
+SendErrorKind = Literal[
+    "blocked",       # пользователь заблокировал бота
+    "deactivated",   # аккаунт удалён
+    "not_found",     # чат не существует / бот никогда не писал пользователю
+    "forbidden",     # прочие 403 (например, бот не может начать диалог)
+    "retry",         # RetryAfter пережил все повторы лимитера
+    "transient",     # сеть, 5xx, прочие ошибки — попробовать в следующий раз
+]
+
+# С такими ошибками чат считаем «мёртвым» и больше туда не шлём
+DEAD_KINDS: frozenset[str] = frozenset({"blocked", "deactivated", "not_found", "forbidden"})
+
+
+def classify_send_error(exc: BaseException) -> SendErrorKind:
+    msg = str(getattr(exc, "message", "") or exc).lower()
+    if isinstance(exc, TelegramRetryAfter):
+        return "retry"
+    if isinstance(exc, TelegramForbiddenError):
+        if "blocked" in msg:
+            return "blocked"
+        if "deactivated" in msg:
+            return "deactivated"
+        return "forbidden"
+    if isinstance(exc, (TelegramBadRequest, TelegramNotFound)):
+        if "chat not found" in msg or "user not found" in msg or "peer_id_invalid" in msg:
+            return "not_found"
+    return "transient"
+
+
+async def mark_dead(user_ids: Iterable[int], kind: str) -> None:
+    ids = list(user_ids)
+    if not ids:
+        return
+    async def _mark(session: AsyncSession) -> None:
+        await session.execute(
+            update(User)
+            .where(User.id.in_(ids))
+            .values(delivery_status=kind, blocked_at=datetime.utcnow())
+        )
+
+    await write(_mark)
+    # bulk UPDATE мимо ORM — кеш сегментов сбрасываем сами
+    invalidate_counts()
+
+
+async def mark_alive(tg_id: int) -> None:
+    """
+    Пользователь снова с нами (разблокировал бота / написал). Условие в WHERE
+    делает вызов дешёвым no-op для живых пользователей.
+    """
+    async def _mark(session: AsyncSession) -> int:
+        res = await session.execute(
+            update(User)
+            .where(User.id == tg_id, User.delivery_status.isnot(None))
+            .values(delivery_status=None, blocked_at=None)
+        )
+        return res.rowcount
+
+    if await write(_mark):
+        invalidate_counts()
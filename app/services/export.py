@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import csv
+import gzip
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, List, Literal, Optional
+
+from sqlalchemy import Table, select
+
+from app.db.session import async_read_session
+from app.models.postback import Postback
+from app.models.user import User
+from app.services.segments import Segment, compile_segment
+
+# Строк на пачку: в памяти не больше одной пачки при любом размере таблицы
+CHUNK = 5000
+
+ExportFormat = Literal["csv", "parquet"]
+ExportTable = Literal["users", "postbacks"]
+
+
+@dataclass
+class ExportResult:
+    path: str
+    filename: str
+    rows: int
+    size: int
+
+
+# ========= Писатели =========
+
+class _CsvGzWriter:
+    def __init__(self, path: str, columns: List[str]):
+        self._f = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self._w = csv.writer(self._f)
+        self._w.writerow(columns)
+
+    def write(self, rows: List[tuple]) -> None:
+        self._w.writerows(
+            [[v.isoformat() if isinstance(v, datetime) else v for v in row] for row in rows]
+        )
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class _ParquetWriter:
+    def __init__(self, path: str, table: Table):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._columns = [c.name for c in table.columns]
+        self._schema = pa.schema([(c.name, _arrow_type(pa, c.type)) for c in table.columns])
+        self._w = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def write(self, rows: List[tuple]) -> None:
+        # каждая пачка — отдельная row group, в памяти не копится
+        cols = list(zip(*rows)) if rows else [[] for _ in self._columns]
+        batch = self._pa.record_batch([list(c) for c in cols], schema=self._schema)
+        self._w.write_batch(batch)
+
+    def close(self) -> None:
+        self._w.close()
+
+
+def _arrow_type(pa, sa_type) -> Any:
+    py = getattr(sa_type, "python_type", str)
+    return {
+        int: pa.int64(),
+        float: pa.float64(),
+        bool: pa.bool_(),
+        datetime: pa.timestamp("us"),
+    }.get(py, pa.string())
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# ========= Выгрузка =========
+
+async def _stream(
+    table: Table,
+    filters: list,
+    writer_factory: Callable[[], Any],
+) -> int:
+    """
+    Keyset-обход по первичному ключу: каждая пачка читается в своей
+    короткой транзакции. Долгий курсор держал бы блокировку чтения SQLite
+    и задерживал запись постбэков; так писатели вклиниваются между пачками.
+    Запись в файл — в отдельном потоке.
+    """
+    key = table.c.id
+    key_idx = list(table.columns).index(key)
+    writer = await asyncio.to_thread(writer_factory)
+    rows_total = 0
+    last = None
+    try:
+        while True:
+            q = select(*table.columns).where(*filters).order_by(key).limit(CHUNK)
+            if last is not None:
+                q = q.where(key > last)
+            async with async_read_session() as session:
+                rows = [tuple(r) for r in (await session.execute(q)).all()]
+            if not rows:
+                break
+            last = rows[-1][key_idx]
+            await asyncio.to_thread(writer.write, rows)
+            rows_total += len(rows)
+            if len(rows) < CHUNK:
+                break
+    finally:
+        await asyncio.to_thread(writer.close)
+    return rows_total
+
+
+def _ts(dt: Optional[datetime]) -> Optional[int]:
+    return int(dt.replace(tzinfo=timezone.utc).timestamp()) if dt else None
+
+
+async def export_table(
+    table_name: ExportTable,
+    fmt: ExportFormat = "csv",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    seg: Optional[Segment] = None,
+) -> ExportResult:
+    """
+    Выгружает users или postbacks во временный файл (.csv.gz или .parquet).
+    since/until — naive UTC; для users фильтр по created_at, для postbacks — по ts.
+    Сегмент для postbacks применяется к их пользователям (tg_id).
+    Файл удаляет вызывающий.
+    """
+    if fmt == "parquet" and not parquet_available():
+        raise RuntimeError("pyarrow не установлен — доступен только CSV")
+
+    filters: list = []
+    if table_name == "users":
+        table = User.__table__
+        if since:
+            filters.append(User.created_at >= since)
+        if until:
+            filters.append(User.created_at < until)
+        if seg is not None:
+            filters.extend(compile_segment(seg))
+    else:
+        table = Postback.__table__
+        if since:
+            filters.append(Postback.ts >= _ts(since))
+        if until:
+            filters.append(Postback.ts < _ts(until))
+        if seg is not None:
+            filters.append(Postback.tg_id.in_(select(User.id).where(*compile_segment(seg))))
+
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    ext = "csv.gz" if fmt == "csv" else "parquet"
+    filename = f"{table_name}-{stamp}.{ext}"
+    fd, path = tempfile.mkstemp(prefix="export-", suffix=f".{ext}")
+    os.close(fd)
+
+    if fmt == "csv":
+        factory = lambda: _CsvGzWriter(path, [c.name for c in table.columns])  # noqa: E731
+    else:
+        factory = lambda: _ParquetWriter(path, table)  # noqa: E731
+
+    try:
+        rows = await _stream(table, filters, factory)
+    except Exception:
+        os.remove(path)
+        raise
+    return ExportResult(path=path, filename=filename, rows=rows, size=os.path.getsize(path))
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
+import time
 from dataclasses import dataclass
 from typing import Optional
 
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
 from app.db.session import async_session
+from app.db.writer import write
 from app.models.user import User
 from app.models.postback import Postback
 
@@ -27,6 +30,7 @@ class ApplyResult:
 
 
 async def _find_user_for_postback_ids(
+    session: AsyncSession,
     tg_id: Optional[int],
     trader_id: Optional[str],
     click_id: Optional[str],
@@ -34,25 +38,24 @@ async def _find_user_for_postback_ids(
     """
     Возвращает user_id (tg) если нашли пользователя по tg_id / trader_id / click_id.
     """
-    async with async_session() as session:
-        if tg_id:
-            u = await session.get(User, tg_id)
-            if u:
-                return u.id
+    if tg_id:
+        u = await session.get(User, tg_id)
+        if u:
+            return u.id
 
-        if trader_id:
-            q = select(User.id).where(User.partner_trader_id == str(trader_id))
-            uid = (await session.execute(q)).scalar_one_or_none()
-            if uid:
-                return uid
+    if trader_id:
+        q = select(User.id).where(User.partner_trader_id == str(trader_id))
+        uid = (await session.execute(q)).scalar_one_or_none()
+        if uid:
+            return uid
 
-        if click_id:
-            q = select(User.id).where(User.click_id == str(click_id))
-            uid = (await session.execute(q)).scalar_one_or_none()
-            if uid:
-                return uid
+    if click_id:
+        q = select(User.id).where(User.click_id == str(click_id))
+        uid = (await session.execute(q)).scalar_one_or_none()
+        if uid:
+            return uid
 
-        return None
+    return None
 
 
 async def apply_postback(payload: dict) -> ApplyResult:
@@ -72,35 +75,36 @@ async def apply_postback(payload: dict) -> ApplyResult:
     click_id = payload.get("click_id")
     amount = float(payload.get("amount_usd") or 0.0)
 
-    # 1) Сохраняем сырой постбэк
-    async with async_session() as session:
+    # Постбэк и апдейт пользователя — одно намерение единого писателя
+    # (app/db/writer.py), одна транзакция: если апдейт упал, откатится и сырая
+    # запись — повтор от партнёрки её не задвоит
+    async def _apply(session: AsyncSession) -> ApplyResult:
+        # 1) Сохраняем сырой постбэк
         pb = Postback(
             event=event,
             tg_id=tg_id,
+            trader_id=str(trader_id) if trader_id else None,
+            click_id=str(click_id) if click_id else None,
             external_id=payload.get("external_id"),
             amount_usd=amount,
+            # без ts от партнёрки считаем временем события момент приёма
+            ts=payload.get("ts") or int(time.time()),
             raw_text=payload.get("raw_text") or "",
         )
         session.add(pb)
         await session.flush()
-        pb_id = pb.id
-        await session.commit()
 
-    # 2) Ищем/создаём пользователя — В ЭТОЙ ЖЕ СЕССИИ, где будем апдейтить!
-    async with async_session() as session:
-        # узнаём id пользователя по любому из идентификаторов
-        uid = await _find_user_for_postback_ids(tg_id, trader_id, click_id)
+        # 2) Ищем/создаём пользователя — в этой же сессии
+        uid = await _find_user_for_postback_ids(session, tg_id, trader_id, click_id)
 
         u: Optional[User] = None
         if uid:
             u = await session.get(User, uid)
         elif tg_id:
             # если не нашли, но знаем tg_id — создадим пустого
-            u = await session.get(User, tg_id)
-            if not u:
-                u = User(id=tg_id)
-                session.add(u)
-                await session.flush()
+            u = User(id=tg_id)
+            session.add(u)
+            await session.flush()
 
         became_vip = False
 
@@ -122,11 +126,10 @@ async def apply_postback(payload: dict) -> ApplyResult:
                     u.has_vip = True
                     became_vip = True
 
-            await session.commit()
-            await session.refresh(u)
+            await session.flush()
 
             return ApplyResult(
-                id=pb_id,
+                id=pb.id,
                 event=event,
                 tg_id=u.id,
                 trader_id=u.partner_trader_id,
@@ -139,7 +142,7 @@ async def apply_postback(payload: dict) -> ApplyResult:
 
         # Если пользователя так и нет (например, пришёл только чужой click_id без tg_id)
         return ApplyResult(
-            id=pb_id,
+            id=pb.id,
             event=event,
             tg_id=tg_id,
             trader_id=str(trader_id) if trader_id else None,
@@ -150,18 +153,26 @@ async def apply_postback(payload: dict) -> ApplyResult:
             became_vip=False,
         )
 
+    return await write(_apply)
+
 
 async def recompute_user_from_postbacks(tg_id: int) -> User:
     # Сейчас агрегаты уже пишем напрямую в User в apply_postback.
     async with async_session() as session:
         user = await session.get(User, tg_id)
+    if user:
+        return user
+
+    async def _create(session: AsyncSession) -> User:
+        user = await session.get(User, tg_id)
         if not user:
             user = User(id=tg_id)
             session.add(user)
-            await session.commit()
-            await session.refresh(user)
+            await session.flush()
         return user
 
+    return await write(_create)
+
 
 async def send_postback_card(bot: Bot, res: ApplyResult):
     title = {
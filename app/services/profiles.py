@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from aiogram.types import User as TgUser
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.db.writer import write
+from app.models.user import User
+from app.services.scheduler import scheduler
+
+log = logging.getLogger(__name__)
+
+# (username, first_name, last_seen unix)
+Profile = Tuple[Optional[str], Optional[str], int]
+
+_FLUSH_KEY = "profiles:flush"
+# Сколько последних записанных профилей помнить, чтобы не писать повторно
+_WRITTEN_MAX = 50_000
+# По сколько id проверять, какие строки UPDATE нашёл (лимит параметров SQLite)
+_CHECK_CHUNK = 500
+
+# Накопленные изменения до следующего сброса: tg_id -> профиль
+_pending: Dict[int, Profile] = {}
+# Что уже лежит в БД (LRU): tg_id -> профиль
+_written: "OrderedDict[int, Profile]" = OrderedDict()
+
+
+def note_seen(tg_user: TgUser) -> None:
+    """
+    Запоминает username / имя / время активности. Ничего не пишет сразу:
+    в буфер попадает только новое имя или активность старше
+    PROFILE_SEEN_RESOLUTION с момента последней записи.
+    """
+    now = int(time.time())
+    profile: Profile = (tg_user.username, tg_user.first_name, now)
+    prev = _pending.get(tg_user.id) or _written.get(tg_user.id)
+    if prev is not None:
+        same_names = prev[0] == profile[0] and prev[1] == profile[1]
+        if same_names and now - prev[2] < settings.PROFILE_SEEN_RESOLUTION:
+            return
+    _pending[tg_user.id] = profile
+
+
+async def flush_profiles() -> int:
+    """Пишет буфер одним executemany-UPDATE. Возвращает число обновлённых профилей."""
+    if not _pending:
+        return 0
+    batch = list(_pending.items())
+    _pending.clear()
+
+    users = User.__table__
+    stmt = (
+        update(users)
+        .where(users.c.id == bindparam("b_id"))
+        .values(
+            username=bindparam("b_username"),
+            first_name=bindparam("b_first_name"),
+            last_seen_at=bindparam("b_seen"),
+            # активность — не изменение карточки: updated_at не трогаем
+            updated_at=users.c.updated_at,
+        )
+    )
+    params = [
+        {"b_id": uid, "b_username": un, "b_first_name": fn, "b_seen": datetime.utcfromtimestamp(ts)}
+        for uid, (un, fn, ts) in batch
+    ]
+    ids = [uid for uid, _ in batch]
+
+    async def _update(session: AsyncSession) -> set[int]:
+        await session.execute(stmt, params)
+        # executemany не даёт rowcount по строкам: смотрим, какие id есть в таблице
+        found: set[int] = set()
+        for i in range(0, len(ids), _CHECK_CHUNK):
+            chunk = ids[i:i + _CHECK_CHUNK]
+            found.update((await session.execute(select(users.c.id).where(users.c.id.in_(chunk)))).scalars())
+        return found
+
+    try:
+        found = await write(_update)
+    except Exception:
+        # вернём в буфер то, что за это время не обновилось
+        for uid, profile in batch:
+            _pending.setdefault(uid, profile)
+        raise
+
+    now = int(time.time())
+    for uid, profile in batch:
+        if uid not in found:
+            # строки ещё нет (апдейт пришёл раньше регистрации): повторим на
+            # следующем сбросе, пока активность свежая, иначе забываем
+            if now - profile[2] < settings.PROFILE_SEEN_RESOLUTION:
+                _pending.setdefault(uid, profile)
+            continue
+        _written[uid] = profile
+        _written.move_to_end(uid)
+    while len(_written) > _WRITTEN_MAX:
+        _written.popitem(last=False)
+    return len(found)
+
+
+def schedule_profile_flush() -> None:
+    scheduler.add(_FLUSH_KEY, time.time() + settings.PROFILE_FLUSH_INTERVAL, _flush_and_reschedule)
+
+
+async def _flush_and_reschedule() -> None:
+    try:
+        await flush_profiles()
+    except Exception:
+        log.exception("Profile flush failed")
+    finally:
+        schedule_profile_flush()
+
+
+class ProfileMiddleware(BaseMiddleware):
+    """Outer-middleware апдейтов: отмечает отправителя, не трогая БД."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        tg_user = data.get("event_from_user")
+        if tg_user is not None and not tg_user.is_bot:
+            note_seen(tg_user)
+        return await handler(event, data)
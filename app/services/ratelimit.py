@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+# Помечает исходящие запросы текущей корутины как «массовые» (рассылка)
+_bulk: ContextVar[bool] = ContextVar("tg_bulk_traffic", default=False)
+
+# Проверка «отправка больше не нужна» (рассылку поставили на паузу), см. abort_when
+_abort_check: ContextVar[Optional[Callable[[], bool]]] = ContextVar("tg_abort_check", default=None)
+
+# Лимитируем только методы, которые создают/меняют сообщения
+_LIMITED_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+
+
+@contextmanager
+def bulk_traffic() -> Iterator[None]:
+    """
+    Всё, что отправляется внутри блока, идёт с низким приоритетом:
+    интерактивные экраны пользователей обгоняют рассылку.
+    """
+    token = _bulk.set(True)
+    try:
+        yield
+    finally:
+        _bulk.reset(token)
+
+
+class SendAborted(Exception):
+    """Отправка снята до запроса в Bot API — сообщение точно не уходило."""
+
+
+@contextmanager
+def abort_when(check: Callable[[], bool]) -> Iterator[None]:
+    """
+    Запросы внутри блока, пока ждут очереди в лимитере, проверяют check():
+    True — запрос не отправляется, поднимается SendAborted.
+    Под троттлингом ожидание в лимитере длится долго, а пауза должна
+    срабатывать сразу, а не после всей пачки.
+    """
+    token = _abort_check.set(check)
+    try:
+        yield
+    finally:
+        _abort_check.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, tokens: float | None = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else min(capacity, tokens)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now: float, floor: float = 0.0) -> float:
+        """
+        Берёт один токен, если после этого в ведре останется не меньше floor.
+        Возвращает 0 при успехе, иначе сколько секунд подождать.
+        """
+        self._refill(now)
+        if self.tokens - 1.0 >= floor:
+            self.tokens -= 1.0
+            return 0.0
+        return (floor + 1.0 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Общий лимитер исходящего трафика бота:
+      - глобальное ведро (по умолчанию 30 сообщений/сек на бота);
+      - ведро на чат (1/сек в личку, 20/мин в группы и каналы);
+      - после RetryAfter — глобальная пауза и снижение скорости вдвое (один
+        раз на паузу: пачка одновременных 429 — это один флуд, а не двадцать),
+        затем восстановление по времени: +`recover_per_sec` сообщений/сек
+        за каждую секунду без флуда (по умолчанию десятая часть лимита —
+        до полной скорости примерно за 10 с);
+      - рассылка не опускает глобальное ведро ниже `reserve` токенов
+        и уступает, пока ждут интерактивные запросы.
+    """
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: float,
+        group_rate_per_min: float,
+        reserve: float,
+        recover_per_sec: float | None = None,
+    ):
+        self.max_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_min / 60.0
+        self.reserve = reserve
+        self.recover_per_sec = global_rate / 10 if recover_per_sec is None else recover_per_sec
+
+        # ведро стартует почти пустым: полное дало бы лишнюю секунду
+        # отправок сверх лимита сразу после запуска
+        self._global = TokenBucket(global_rate, global_rate, tokens=reserve + 1.0)
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._flood_until = 0.0
+        self._interactive_waiting = 0
+        # скорость, до которой упали на последнем флуде
+        self._slow_rate = global_rate
+
+    # --- per-chat ---
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10_000:
+                self._gc_chats()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                b = TokenBucket(self.group_rate, max(1.0, self.chat_burst))
+            else:
+                b = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = b
+        return b
+
+    def _gc_chats(self) -> None:
+        # полные вёдра ничего не помнят — их можно выбросить
+        now = time.monotonic()
+        for cid in [cid for cid, b in self._chats.items() if b.is_full(now)]:
+            del self._chats[cid]
+
+    # --- acquire ---
+
+    async def acquire(
+        self, chat_id: int | str | None, bulk: bool, abort: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        """abort() == True во время ожидания — SendAborted, токен не тратится."""
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id)
+            while (wait := bucket.try_take(time.monotonic())) > 0:
+                if abort is not None and abort():
+                    raise SendAborted()
+                await asyncio.sleep(wait)
+
+        if not bulk:
+            self._interactive_waiting += 1
+        try:
+            while True:
+                if abort is not None and abort():
+                    raise SendAborted()
+                now = time.monotonic()
+                self._recover(now)
+                if self._flood_until > now:
+                    await asyncio.sleep(self._flood_until - now)
+                    continue
+                if bulk and self._interactive_waiting:
+                    await asyncio.sleep(1.0 / self._global.rate)
+                    continue
+                wait = self._global.try_take(now, floor=self.reserve if bulk else 0.0)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            if not bulk:
+                self._interactive_waiting -= 1
+
+    # --- adaptive feedback ---
+
+    def on_retry_after(self, retry_after: float) -> None:
+        now = time.monotonic()
+        if now < self._flood_until:
+            # тот же флуд: ответы на запросы, ушедшие до паузы, — только продлеваем её
+            self._flood_until = max(self._flood_until, now + retry_after)
+            return
+        self._recover(now)
+        self._flood_until = now + retry_after
+        self._slow_rate = max(1.0, self._global.rate / 2)
+        self._set_rate(now, self._slow_rate)
+        log.warning("Flood control: pause %.1fs, rate -> %.1f/s", retry_after, self._global.rate)
+
+    def on_success(self) -> None:
+        self._recover(time.monotonic())
+
+    def _recover(self, now: float) -> None:
+        if self._global.rate >= self.max_rate or now <= self._flood_until:
+            return
+        calm = now - self._flood_until
+        self._set_rate(now, min(self.max_rate, self._slow_rate + calm * self.recover_per_sec))
+
+    def _set_rate(self, now: float, rate: float) -> None:
+        # накопленное до смены скорости считается по старой скорости
+        self._global._refill(now)
+        self._global.rate = rate
+
+    @property
+    def current_rate(self) -> float:
+        return self._global.rate
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии Bot: пропускает отправку сообщений через RateLimiter
+    и сам повторяет запрос после TelegramRetryAfter.
+    """
+
+    def __init__(self, limiter: RateLimiter, retries: int = 3):
+        self.limiter = limiter
+        self.retries = retries
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not type(method).__name__.startswith(_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        bulk = _bulk.get()
+        attempt = 0
+        abort = _abort_check.get()
+        while True:
+            await self.limiter.acquire(chat_id, bulk, abort)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.limiter.on_retry_after(e.retry_after)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                continue
+            self.limiter.on_success()
+            return result
+
+
+# Один лимитер на процесс — общий для рассылок, пушей и карточек постбэков
+limiter = RateLimiter(
+    global_rate=settings.TG_GLOBAL_RATE,
+    chat_rate=settings.TG_CHAT_RATE,
+    chat_burst=settings.TG_CHAT_BURST,
+    group_rate_per_min=settings.TG_GROUP_RATE_PER_MIN,
+    reserve=settings.TG_INTERACTIVE_RESERVE,
+)
+
+
+def install(bot: Bot, global_rate: float | None = None, reserve: float | None = None) -> None:
+    """
+    global_rate/reserve — доля общего бюджета для этого процесса, когда
+    рассылки ведут отдельные процессы-воркеры (см. app/broadcast_worker.py).
+    """
+    global limiter
+    if global_rate is not None:
+        limiter = RateLimiter(
+            global_rate=max(1.0, global_rate),
+            chat_rate=settings.TG_CHAT_RATE,
+            chat_burst=settings.TG_CHAT_BURST,
+            group_rate_per_min=settings.TG_GROUP_RATE_PER_MIN,
+            reserve=settings.TG_INTERACTIVE_RESERVE if reserve is None else reserve,
+        )
+    bot.session.middleware(RateLimitMiddleware(limiter, retries=settings.TG_RETRY_ATTEMPTS))
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Tuple
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+JobFn = Callable[[], Awaitable[None]]
+
+
+def to_ts(dt: datetime) -> float:
+    # в БД всё хранится как naive UTC (datetime.utcnow)
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+@dataclass
+class _Entry:
+    when: float
+    fn: JobFn
+    late: bool = False
+
+
+class Scheduler:
+    """
+    Локальный планировщик: куча таймеров и одна корутина, которая спит
+    ровно до ближайшего срока (или до добавления более раннего таймера).
+    Пока ничего не должно сработать — ни опросов, ни тиков.
+
+    Задачи, просроченные больше чем на `late_after` секунд (бот был выключен),
+    запускаются не чаще одной в `catchup_interval` секунд, а не все разом.
+    """
+
+    def __init__(self, catchup_interval: float, late_after: float = 60.0):
+        self.catchup_interval = catchup_interval
+        self.late_after = late_after
+        self._heap: list[tuple[float, int, str]] = []
+        self._entries: dict[str, _Entry] = {}
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._last_late_start = 0.0
+
+    def add(self, key: str, when: float, fn: JobFn, *, late: bool = False) -> None:
+        self._entries[key] = _Entry(when, fn, late)
+        heapq.heappush(self._heap, (when, next(self._seq), key))
+        self._wake.set()
+
+    def cancel(self, key: str) -> None:
+        # из кучи не удаляем — устаревшая запись отбросится при извлечении
+        self._entries.pop(key, None)
+
+    def upcoming(self) -> List[Tuple[str, float]]:
+        return sorted(((k, e.when) for k, e in self._entries.items()), key=lambda x: x[1])
+
+    def _drop_stale(self) -> None:
+        while self._heap:
+            when, _, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry.when == when:
+                return
+            heapq.heappop(self._heap)
+
+    async def run(self) -> None:
+        while True:
+            self._wake.clear()
+            self._drop_stale()
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, _, key = heapq.heappop(self._heap)
+            entry = self._entries.pop(key)
+            now = time.time()
+            if entry.late or now - when > self.late_after:
+                next_slot = self._last_late_start + self.catchup_interval
+                if now < next_slot:
+                    self.add(key, next_slot, entry.fn, late=True)
+                    continue
+                self._last_late_start = now
+                log.info("Running overdue job %s (%.0fs late)", key, now - when)
+
+            asyncio.create_task(self._run_one(key, entry.fn))
+
+    @staticmethod
+    async def _run_one(key: str, fn: JobFn) -> None:
+        try:
+            await fn()
+        except Exception:
+            log.exception("Scheduled job %s failed", key)
+
+
+# Один планировщик на процесс бота
+scheduler = Scheduler(catchup_interval=settings.SCHEDULER_CATCHUP_INTERVAL)
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import json
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import and_, event, false, func, inspect, or_, select
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.db.session import async_read_session
+from app.models.user import User
+
+
+# ========= Модель сегмента =========
+
+@dataclass
+class Segment:
+    langs: set[str] = field(default_factory=set)          # пусто = все языки
+    registered: Optional[bool] = None                    # None=все
+    access_ok: Optional[bool] = None                     # None=все; True — >=ACCESS (или депозит выключен)
+    vip: Optional[bool] = None                           # None=все
+    subscribed: Optional[bool] = None                    # None=все
+    include_dead: bool = False                           # True — слать и тем, кто заблокировал бота
+
+    def pretty(self) -> str:
+        def s3(v, yes="да", no="нет"):
+            return "любой" if v is None else (yes if v else no)
+        parts: List[str] = []
+        parts.append(f"языки: {','.join(sorted(self.langs)) if self.langs else 'все'}")
+        parts.append(f"регистрация: {s3(self.registered)}")
+        parts.append(f"доступ: {s3(self.access_ok)}")
+        parts.append(f"VIP: {s3(self.vip)}")
+        parts.append(f"подписка: {s3(self.subscribed)}")
+        if self.include_dead:
+            parts.append("включая недоступных")
+        return "; ".join(parts)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "langs": sorted(self.langs),
+            "registered": self.registered,
+            "access_ok": self.access_ok,
+            "vip": self.vip,
+            "subscribed": self.subscribed,
+            "include_dead": self.include_dead,
+        })
+
+    @classmethod
+    def from_json(cls, raw: Optional[str]) -> "Segment":
+        try:
+            d = json.loads(raw or "{}")
+        except Exception:
+            d = {}
+        return cls(
+            langs=set(d.get("langs") or []),
+            registered=d.get("registered"),
+            access_ok=d.get("access_ok"),
+            vip=d.get("vip"),
+            subscribed=d.get("subscribed"),
+            include_dead=bool(d.get("include_dead")),
+        )
+
+
+# ========= Компилятор сегмента в SQL =========
+
+def compile_segment(seg: Segment) -> list:
+    """
+    Segment -> список предикатов над User (объединяются через AND).
+    Единственное место, где описан смысл фильтров сегмента.
+    """
+    exprs = []
+
+    if not seg.include_dead:
+        exprs.append(User.delivery_status.is_(None))
+
+    if seg.langs:
+        exprs.append(User.lang.in_(sorted(seg.langs)))
+
+    if seg.registered is True:
+        exprs.append(User.is_registered.is_(True))
+    elif seg.registered is False:
+        exprs.append(or_(User.is_registered.is_(False), User.is_registered.is_(None)))
+
+    if seg.access_ok is True:
+        if settings.REQUIRE_DEPOSIT:
+            exprs.append(User.deposit_total_usd >= settings.ACCESS_THRESHOLD_USD)
+    elif seg.access_ok is False:
+        if settings.REQUIRE_DEPOSIT:
+            exprs.append(or_(User.deposit_total_usd < settings.ACCESS_THRESHOLD_USD,
+                             User.deposit_total_usd.is_(None)))
+        else:
+            exprs.append(false())
+
+    if seg.vip is True:
+        exprs.append(or_(User.deposit_total_usd >= settings.VIP_THRESHOLD_USD, User.has_vip.is_(True)))
+    elif seg.vip is False:
+        exprs.append(and_(
+            or_(User.deposit_total_usd < settings.VIP_THRESHOLD_USD, User.deposit_total_usd.is_(None)),
+            or_(User.has_vip.is_(False), User.has_vip.is_(None)),
+        ))
+
+    if seg.subscribed is True:
+        exprs.append(User.is_subscribed.is_(True))
+    elif seg.subscribed is False:
+        exprs.append(or_(User.is_subscribed.is_(False), User.is_subscribed.is_(None)))
+
+    return exprs
+
+
+# ========= Кеш размеров аудитории =========
+
+# Ключ — нормализованный сегмент + настройки, от которых зависит смысл фильтров
+_count_cache: dict[tuple, tuple[float, int]] = {}
+
+# Колонки User, изменение которых может поменять состав сегментов
+_SEGMENT_COLUMNS = ("lang", "is_registered", "deposit_total_usd", "has_vip", "is_subscribed", "delivery_status")
+
+
+def _cache_key(seg: Segment) -> tuple:
+    return (
+        tuple(sorted(seg.langs)),
+        seg.registered,
+        seg.access_ok,
+        seg.vip,
+        seg.subscribed,
+        seg.include_dead,
+        settings.REQUIRE_DEPOSIT,
+        settings.ACCESS_THRESHOLD_USD,
+        settings.VIP_THRESHOLD_USD,
+    )
+
+
+def invalidate_counts() -> None:
+    _count_cache.clear()
+
+
+async def count_audience(seg: Segment) -> int:
+    key = _cache_key(seg)
+    now = time.monotonic()
+    hit = _count_cache.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+
+    async with async_read_session() as session:
+        q = select(func.count()).select_from(User).where(*compile_segment(seg))
+        n = (await session.execute(q)).scalar_one()
+
+    _count_cache[key] = (now + settings.AUDIENCE_COUNT_TTL, n)
+    return n
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_user_change(session: Session, _ctx) -> None:
+    # служебные апдейты (last_bot_message_id и т.п.) кеш не трогают
+    if not _count_cache:
+        return
+    for obj in session.new:
+        if isinstance(obj, User):
+            invalidate_counts()
+            return
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            invalidate_counts()
+            return
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        attrs = inspect(obj).attrs
+        if any(attrs[name].history.has_changes() for name in _SEGMENT_COLUMNS):
+            invalidate_counts()
+            return
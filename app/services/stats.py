@@ -0,0 +1,429 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import case, delete, event, func, insert, inspect, or_, select, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.db.session import async_read_session, async_session
+from app.models.metrics import MetricCounter
+from app.models.postback import Postback, PostbackDaily
+from app.models.user import User
+from app.services.scheduler import scheduler
+
+log = logging.getLogger(__name__)
+
+# Все варианты события «депозит», которые встречаются в постбэках
+DEPOSIT_EVENTS = ("deposit_first", "deposit_repeat", "deposit")
+
+
+@dataclass
+class UserMetrics:
+    total: int = 0
+    chosen_lang: int = 0
+    registered: int = 0
+    access: int = 0          # >= ACCESS (или все, если депозит не обязателен)
+    vip: int = 0
+    subscribed: int = 0
+    deposit_sum: float = 0.0
+
+
+@dataclass
+class PostbackMetrics:
+    total: int = 0
+    registrations: int = 0
+    deposits: int = 0
+    deposit_sum: float = 0.0
+
+
+def _count_if(cond):
+    # SUM(CASE WHEN cond THEN 1 ELSE 0 END); на пустой таблице SUM даёт NULL
+    return func.coalesce(func.sum(case((cond, 1), else_=0)), 0)
+
+
+# ========= Метрики пользователей: счётчики =========
+#
+# Значения лежат в metrics_counters и меняются инкрементально: при каждом
+# flush ORM считаем вклад изменённых User «до» и «после» и прибавляем
+# разницу в той же транзакции. Экран читает 7 строк, без обхода users.
+# Обходы ORM (bulk insert/update) и смена порогов дают дрейф — его убирает
+# reconcile_counters() на старте, по расписанию и после смены порогов.
+
+COUNTERS = ("total", "chosen_lang", "registered", "access", "vip", "subscribed", "deposit_sum")
+
+# Колонки User, от которых зависят счётчики
+_COUNTED_COLUMNS = ("lang", "is_registered", "deposit_total_usd", "has_vip", "is_subscribed")
+
+
+def _user_aggregates() -> dict:
+    # Смысл счётчиков в SQL; _contribution — то же самое для одной строки
+    return {
+        "total": func.count(),
+        "chosen_lang": _count_if(User.lang.isnot(None)),
+        "registered": _count_if(User.is_registered.is_(True)),
+        "access": _count_if(User.deposit_total_usd >= settings.ACCESS_THRESHOLD_USD),
+        "vip": _count_if(or_(User.deposit_total_usd >= settings.VIP_THRESHOLD_USD, User.has_vip.is_(True))),
+        "subscribed": _count_if(User.is_subscribed.is_(True)),
+        "deposit_sum": func.coalesce(func.sum(User.deposit_total_usd), 0.0),
+    }
+
+
+def _contribution(v: dict) -> dict[str, float]:
+    dep = v.get("deposit_total_usd")
+    return {
+        "total": 1,
+        "chosen_lang": int(v.get("lang") is not None),
+        "registered": int(v.get("is_registered") is True),
+        "access": int(dep is not None and dep >= settings.ACCESS_THRESHOLD_USD),
+        "vip": int((dep is not None and dep >= settings.VIP_THRESHOLD_USD) or v.get("has_vip") is True),
+        "subscribed": int(v.get("is_subscribed") is True),
+        "deposit_sum": float(dep or 0.0),
+    }
+
+
+def _values_before(obj: User) -> dict:
+    out = {}
+    attrs = inspect(obj).attrs
+    for name in _COUNTED_COLUMNS:
+        hist = attrs[name].history
+        if hist.deleted:
+            out[name] = hist.deleted[0]
+        elif hist.unchanged:
+            out[name] = hist.unchanged[0]
+        else:
+            out[name] = None
+    return out
+
+
+def _values_after(obj: User) -> dict:
+    return {name: getattr(obj, name) for name in _COUNTED_COLUMNS}
+
+
+def _add(acc: dict[str, float], contrib: dict[str, float], sign: int) -> None:
+    for k, v in contrib.items():
+        acc[k] = acc.get(k, 0) + sign * v
+
+
+@event.listens_for(Session, "after_flush")
+def _count_user_changes(session: Session, _ctx) -> None:
+    delta: dict[str, float] = {}
+    for obj in session.new:
+        if isinstance(obj, User):
+            _add(delta, _contribution(_values_after(obj)), +1)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            _add(delta, _contribution(_values_before(obj)), -1)
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        attrs = inspect(obj).attrs
+        if not any(attrs[name].history.has_changes() for name in _COUNTED_COLUMNS):
+            continue
+        _add(delta, _contribution(_values_before(obj)), -1)
+        _add(delta, _contribution(_values_after(obj)), +1)
+
+    changed = {k: d for k, d in delta.items() if d}
+    if not changed:
+        return
+    conn = session.connection()
+    now = datetime.utcnow()
+    for name, d in changed.items():
+        conn.execute(
+            update(MetricCounter)
+            .where(MetricCounter.name == name)
+            .values(value=MetricCounter.value + d, updated_at=now)
+        )
+
+
+def _to_metrics(values: dict[str, float]) -> UserMetrics:
+    total = int(values.get("total") or 0)
+    return UserMetrics(
+        total=total,
+        chosen_lang=int(values.get("chosen_lang") or 0),
+        registered=int(values.get("registered") or 0),
+        # когда депозит не нужен — у всех доступ
+        access=int(values.get("access") or 0) if settings.REQUIRE_DEPOSIT else total,
+        vip=int(values.get("vip") or 0),
+        subscribed=int(values.get("subscribed") or 0),
+        deposit_sum=float(values.get("deposit_sum") or 0.0),
+    )
+
+
+async def reconcile_counters() -> UserMetrics:
+    """
+    Пересчитывает счётчики по таблице users. Значение берётся подзапросом
+    прямо в UPDATE — между чтением и записью никто не вклинится.
+    """
+    async with async_session() as session:
+        before = dict((await session.execute(select(MetricCounter.name, MetricCounter.value))).all())
+        missing = [name for name in COUNTERS if name not in before]
+        if missing:
+            session.add_all([MetricCounter(name=name, value=0.0) for name in missing])
+            await session.flush()
+        now = datetime.utcnow()
+        for name, expr in _user_aggregates().items():
+            await session.execute(
+                update(MetricCounter)
+                .where(MetricCounter.name == name)
+                .values(value=select(expr).select_from(User).scalar_subquery(), updated_at=now)
+            )
+        after = dict((await session.execute(select(MetricCounter.name, MetricCounter.value))).all())
+        await session.commit()
+
+    drift = {k: after[k] - before[k] for k in COUNTERS if k in before and abs(after[k] - before[k]) > 1e-6}
+    if drift:
+        log.info("Metrics counters drift corrected: %s", drift)
+    return _to_metrics(after)
+
+
+async def user_metrics() -> UserMetrics:
+    """Метрики пользователей из metrics_counters — O(1) при любом числе users."""
+    async with async_read_session() as session:
+        values = dict((await session.execute(select(MetricCounter.name, MetricCounter.value))).all())
+    if any(name not in values for name in COUNTERS):
+        return await reconcile_counters()
+    return _to_metrics(values)
+
+
+_RECONCILE_KEY = "metrics:reconcile"
+
+
+def schedule_reconcile() -> None:
+    scheduler.add(_RECONCILE_KEY, time.time() + settings.METRICS_RECONCILE_INTERVAL, _reconcile_and_reschedule)
+
+
+async def _reconcile_and_reschedule() -> None:
+    try:
+        await reconcile_counters()
+    finally:
+        schedule_reconcile()
+
+
+# ========= Кеш готовых экранов =========
+
+class SnapshotCache:
+    """
+    Готовые снимки (например, текст экрана статистики) по ключу:
+      - живут `ttl` секунд и периодически пересобираются в фоне (refresh_all),
+        так что админ обычно получает снимок из памяти;
+      - одновременные запросы одного ключа ждут одну и ту же сборку;
+      - после `invalidate_after` новых постбэков снимки устаревают досрочно
+        и сразу пересобираются в фоне.
+    """
+
+    def __init__(self, ttl: float, invalidate_after: int):
+        self.ttl = ttl
+        self.invalidate_after = invalidate_after
+        # key -> (истекает, monotonic; собран, unix; значение)
+        self._items: dict[object, tuple[float, float, str]] = {}
+        self._builders: dict[object, Callable[[], Awaitable[str]]] = {}
+        self._inflight: dict[object, asyncio.Future] = {}
+        self._changes = 0
+
+    async def get(self, key, build: Callable[[], Awaitable[str]], fresh: bool = False) -> tuple[str, float]:
+        """Возвращает (значение, время сборки unix). fresh=True — пересобрать, не глядя в кеш."""
+        self._builders[key] = build
+        hit = self._items.get(key)
+        if not fresh and hit and hit[0] > time.monotonic():
+            return hit[2], hit[1]
+        return await self._build(key)
+
+    async def _build(self, key) -> tuple[str, float]:
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await self._builders[key]()
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # ждущих может не быть — не пишем «never retrieved»
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        built_at = time.time()
+        self._items[key] = (time.monotonic() + self.ttl, built_at, value)
+        fut.set_result((value, built_at))
+        return value, built_at
+
+    async def refresh_all(self) -> None:
+        for key in list(self._builders):
+            try:
+                await self._build(key)
+            except Exception:
+                log.exception("Snapshot %r refresh failed", key)
+
+    def note_change(self, n: int = 1) -> None:
+        self._changes += n
+        if self._changes < self.invalidate_after:
+            return
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Все снимки устарели (новые данные, сменились пороги): пересобрать в фоне."""
+        self._changes = 0
+        self._items.clear()
+        try:
+            asyncio.get_running_loop().create_task(self.refresh_all())
+        except RuntimeError:
+            pass  # нет цикла — пересоберётся при следующем запросе
+
+
+stats_cache = SnapshotCache(ttl=settings.STATS_CACHE_TTL, invalidate_after=settings.STATS_INVALIDATE_AFTER_POSTBACKS)
+
+_STATS_REFRESH_KEY = "stats:refresh"
+
+
+def schedule_stats_refresh() -> None:
+    scheduler.add(_STATS_REFRESH_KEY, time.time() + settings.STATS_REFRESH_INTERVAL, _refresh_and_reschedule)
+
+
+async def _refresh_and_reschedule() -> None:
+    try:
+        await stats_cache.refresh_all()
+    finally:
+        schedule_stats_refresh()
+
+
+# ========= Метрики постбэков: дневной срез =========
+#
+# postback_daily пополняется в том же flush, что и вставка постбэка;
+# экран статистики за любой период суммирует не больше (дней × событий) строк.
+
+def _pg_or_sqlite_insert(dialect_name: str):
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
+
+
+def _utc_day(ts: int) -> date:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).date()
+
+
+_NEW_POSTBACKS = "stats:new_postbacks"
+
+
+@event.listens_for(Session, "after_flush")
+def _rollup_new_postbacks(session: Session, _ctx) -> None:
+    acc: dict[tuple[date, str], list] = {}
+    for obj in session.new:
+        # без ts событие не попадает ни в один день — как и в backfill_postback_daily
+        if isinstance(obj, Postback) and obj.ts is not None:
+            bucket = acc.setdefault((_utc_day(obj.ts), obj.event or ""), [0, 0.0])
+            bucket[0] += 1
+            bucket[1] += float(obj.amount_usd or 0.0)
+    if not acc:
+        return
+
+    # снимки сбрасываем только после COMMIT: иначе фоновая пересборка
+    # может прочитать базу до того, как постбэки в ней появятся
+    session.info[_NEW_POSTBACKS] = session.info.get(_NEW_POSTBACKS, 0) + sum(cnt for cnt, _ in acc.values())
+
+    conn = session.connection()
+    dialect_insert = _pg_or_sqlite_insert(conn.dialect.name)
+    for (day, ev), (cnt, amount) in acc.items():
+        ins = dialect_insert(PostbackDaily).values(day=day, event=ev, count=cnt, amount_sum=amount)
+        conn.execute(ins.on_conflict_do_update(
+            index_elements=[PostbackDaily.day, PostbackDaily.event],
+            set_={
+                "count": PostbackDaily.count + ins.excluded.count,
+                "amount_sum": PostbackDaily.amount_sum + ins.excluded.amount_sum,
+            },
+        ))
+
+
+@event.listens_for(Session, "after_commit")
+def _note_committed_postbacks(session: Session) -> None:
+    n = session.info.pop(_NEW_POSTBACKS, 0)
+    if n:
+        stats_cache.note_change(n)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_postbacks(session: Session) -> None:
+    session.info.pop(_NEW_POSTBACKS, None)
+
+
+async def backfill_postback_daily(chunk: int = 5000) -> int:
+    """
+    Пересобирает postback_daily из postbacks (keyset по id, в памяти —
+    только агрегаты). Постбэки без ts в срез не попадают: дня у них нет.
+    Возвращает число строк среза.
+    """
+    acc: dict[tuple[date, str], list] = {}
+    last = 0
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(Postback.id, Postback.ts, Postback.event, Postback.amount_usd)
+                .where(Postback.id > last, Postback.ts.isnot(None))
+                .order_by(Postback.id)
+                .limit(chunk)
+            )).all()
+        if not rows:
+            break
+        last = rows[-1][0]
+        for _, ts, ev, amount in rows:
+            bucket = acc.setdefault((_utc_day(ts), ev or ""), [0, 0.0])
+            bucket[0] += 1
+            bucket[1] += float(amount or 0.0)
+
+    async with async_session() as session:
+        await session.execute(delete(PostbackDaily))
+        if acc:
+            await session.execute(insert(PostbackDaily), [
+                {"day": day, "event": ev, "count": cnt, "amount_sum": amount}
+                for (day, ev), (cnt, amount) in acc.items()
+            ])
+        await session.commit()
+    log.info("postback_daily rebuilt: %s rows", len(acc))
+    return len(acc)
+
+
+async def ensure_postback_daily() -> None:
+    """Разовый backfill на старте: срез пуст, а датированные постбэки уже есть."""
+    async with async_session() as session:
+        has_daily = (await session.execute(select(PostbackDaily.day).limit(1))).first() is not None
+        has_dated = (await session.execute(
+            select(Postback.id).where(Postback.ts.isnot(None)).limit(1)
+        )).first() is not None
+    if has_dated and not has_daily:
+        await backfill_postback_daily()
+
+
+async def postback_metrics(days: Optional[int] = None) -> PostbackMetrics:
+    """
+    Метрики постбэков за последние `days` календарных дней UTC (включая
+    сегодня) или за всё время (days=None) — из postback_daily.
+    """
+    q = (
+        select(PostbackDaily.event, func.sum(PostbackDaily.count), func.sum(PostbackDaily.amount_sum))
+        .group_by(PostbackDaily.event)
+    )
+    if days:
+        q = q.where(PostbackDaily.day > datetime.utcnow().date() - timedelta(days=days))
+
+    async with async_read_session() as session:
+        rows = (await session.execute(q)).all()
+
+    m = PostbackMetrics()
+    for ev, cnt, amount in rows:
+        cnt = int(cnt or 0)
+        m.total += cnt
+        if ev == "registration":
+            m.registrations += cnt
+        elif ev in DEPOSIT_EVENTS:
+            m.deposits += cnt
+            m.deposit_sum += float(amount or 0.0)
+    return m
+
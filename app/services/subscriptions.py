@@ -3,9 +3,10 @@ from __future__ import annotations
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import ChatMember, ChatMemberAdministrator, ChatMemberOwner
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
-from app.db.session import async_session
+from app.db.writer import write
 from app.models.user import User
 
 
@@ -22,6 +23,17 @@ def _is_member(cm: ChatMember) -> bool:
     return str(status) in {"member", "administrator", "creator"}
 
 
+async def _save_subscribed(tg_id: int, ok: bool) -> None:
+    async def _set(session: AsyncSession) -> None:
+        u = await session.get(User, tg_id)
+        if not u:
+            u = User(id=tg_id)
+            session.add(u)
+        u.is_subscribed = ok
+
+    await write(_set)
+
+
 async def verify_and_cache(bot: Bot, tg_id: int, channel_id: int | None, *, set_if_disabled: bool = True) -> bool:
     """
     Проверяет подписку на ОДИН канал (если он задан) и кеширует результат в users.is_subscribed.
@@ -31,14 +43,7 @@ async def verify_and_cache(bot: Bot, tg_id: int, channel_id: int | None, *, set_
     # Если шаг подписки выключен или канал не задан — считаем подписку пройденной
     if not settings.REQUIRE_SUBSCRIPTION or not channel_id:
         if set_if_disabled:
-            async with async_session() as session:
-                u = await session.get(User, tg_id)
-                if not u:
-                    u = User(id=tg_id)
-                    session.add(u)
-                    await session.flush()
-                u.is_subscribed = True
-                await session.commit()
+            await _save_subscribed(tg_id, True)
         return True
 
     ok = False
@@ -51,13 +56,6 @@ async def verify_and_cache(bot: Bot, tg_id: int, channel_id: int | None, *, set_
     except Exception:
         ok = False
 
-    async with async_session() as session:
-        u = await session.get(User, tg_id)
-        if not u:
-            u = User(id=tg_id)
-            session.add(u)
-            await session.flush()
-        u.is_subscribed = ok
-        await session.commit()
+    await _save_subscribed(tg_id, ok)
 
     return ok
@@ -3,7 +3,10 @@ from __future__ import annotations
 import secrets
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
+from sqlalchemy.ext.asyncio import AsyncSession
+
 from app.db.session import async_session
+from app.db.writer import write
 from app.models.user import User
 from app.config import settings
 
@@ -18,17 +21,21 @@ async def ensure_click_id(tg_id: int) -> str:
     Гарантирует наличие user.click_id. Возвращает актуальный click_id.
     """
     async with async_session() as session:
+        u: User | None = await session.get(User, tg_id)
+        if u and u.click_id:
+            return u.click_id
+
+    async def _ensure(session: AsyncSession) -> str:
         u: User | None = await session.get(User, tg_id)
         if not u:
             u = User(id=tg_id)
             session.add(u)
-            await session.flush()
-
         if not u.click_id:
             u.click_id = _gen_click_id(tg_id)
-            await session.commit()
         return u.click_id
 
+    return await write(_ensure)
+
 
 def build_ref_link_with_click(click_id: str) -> str:
     """
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.db.session import async_session
+from app.db.writer import write
+from app.models.ui_state import UiState
+from app.services.scheduler import scheduler
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_PURGE_KEY = "ui_state:purge"
+
+# Все хранилища по namespace — для загрузки на старте
+_stores: Dict[str, "StateStore[Any]"] = {}
+
+
+class StateStore(Generic[T]):
+    """
+    Небольшое хранилище состояния экранов админки:
+      - записи живут `ttl` секунд с последней записи, не больше `max_entries`
+        (вытесняются самые давние);
+      - чтение синхронное, из памяти — годится и для фильтров хендлеров;
+      - запись асинхронная: при UI_STATE_PERSIST дублируется в таблицу
+        ui_state, и после перезапуска load_ui_state() поднимает живые записи.
+    `factory` — dataclass значения: в БД он хранится как JSON его полей.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        factory: Optional[Callable[..., T]] = None,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ):
+        self.namespace = namespace
+        self._factory = factory
+        self._ttl = ttl
+        self._max = max_entries
+        self._items: "OrderedDict[str, Tuple[float, T]]" = OrderedDict()
+        _stores[namespace] = self
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl if self._ttl is not None else settings.UI_STATE_TTL
+
+    @property
+    def max_entries(self) -> int:
+        return self._max if self._max is not None else settings.UI_STATE_MAX_ENTRIES
+
+    # ----- чтение (синхронно, из памяти) -----
+
+    def get(self, key: Hashable) -> Optional[T]:
+        k = str(key)
+        item = self._items.get(k)
+        if item is None:
+            return None
+        expires, value = item
+        if expires <= time.time():
+            del self._items[k]
+            return None
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    # ----- запись -----
+
+    async def set(self, key: Hashable, value: T) -> None:
+        k = str(key)
+        expires = time.time() + self.ttl
+        self._items[k] = (expires, value)
+        self._items.move_to_end(k)
+        evicted = self._evict()
+        if settings.UI_STATE_PERSIST:
+            await self._write(k, value, expires, evicted)
+
+    async def pop(self, key: Hashable) -> Optional[T]:
+        value = self.get(key)
+        k = str(key)
+        self._items.pop(k, None)
+        if settings.UI_STATE_PERSIST:
+            await self._write(None, None, 0, [k])
+        return value
+
+    async def get_or_create(self, key: Hashable) -> T:
+        """Текущее значение или новое от factory (сохраняется сразу)."""
+        value = self.get(key)
+        if value is None:
+            value = self._factory()
+            await self.set(key, value)
+        return value
+
+    def _evict(self) -> list[str]:
+        now = time.time()
+        evicted = [k for k, (exp, _) in self._items.items() if exp <= now]
+        for k in evicted:
+            del self._items[k]
+        while len(self._items) > self.max_entries:
+            k, _ = self._items.popitem(last=False)
+            evicted.append(k)
+        return evicted
+
+    # ----- БД -----
+
+    def _encode(self, value: T) -> str:
+        if dataclasses.is_dataclass(value):
+            value = dataclasses.asdict(value)
+        return json.dumps(value, ensure_ascii=False)
+
+    def _decode(self, raw: str) -> T:
+        data = json.loads(raw)
+        return self._factory(**data) if self._factory and isinstance(data, dict) else data
+
+    async def _write(self, key: Optional[str], value: Any, expires: float, removed: list[str]) -> None:
+        # состояние экранов не критично: ошибка БД не должна ломать админку
+        async def _save(session: AsyncSession) -> None:
+            if removed:
+                await session.execute(
+                    delete(UiState).where(UiState.namespace == self.namespace, UiState.key.in_(removed))
+                )
+            if key is not None:
+                await session.merge(UiState(
+                    namespace=self.namespace, key=key,
+                    value=self._encode(value), expires_at=int(expires),
+                ))
+
+        try:
+            await write(_save)
+        except Exception:
+            log.exception("ui_state write failed (%s)", self.namespace)
+
+    async def load(self) -> int:
+        now = int(time.time())
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(UiState.key, UiState.value, UiState.expires_at)
+                .where(UiState.namespace == self.namespace, UiState.expires_at > now)
+                .order_by(UiState.expires_at)
+            )).all()
+        for key, raw, expires in rows:
+            try:
+                self._items[key] = (float(expires), self._decode(raw))
+            except Exception:
+                log.warning("ui_state: skip broken %s/%s", self.namespace, key)
+        self._evict()
+        return len(self._items)
+
+
+async def purge_expired() -> None:
+    async def _purge(session: AsyncSession) -> None:
+        await session.execute(delete(UiState).where(UiState.expires_at <= int(time.time())))
+
+    await write(_purge)
+    for store in _stores.values():
+        store._evict()
+
+
+async def load_ui_state() -> None:
+    """На старте: чистим просроченное и поднимаем живые записи всех хранилищ."""
+    if not settings.UI_STATE_PERSIST:
+        return
+    await purge_expired()
+    for store in _stores.values():
+        n = await store.load()
+        if n:
+            log.info("ui_state: restored %d entries for %s", n, store.namespace)
+
+
+def schedule_ui_state_purge() -> None:
+    scheduler.add(_PURGE_KEY, time.time() + settings.UI_STATE_TTL, _purge_and_reschedule)
+
+
+async def _purge_and_reschedule() -> None:
+    try:
+        await purge_expired()
+    except Exception:
+        log.exception("ui_state purge failed")
+    finally:
+        schedule_ui_state_purge()
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Literal, Optional
+from typing import Callable, Literal, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
+from app.db.session import async_session
+from app.db.writer import write
 from app.models.user import User
 
 
@@ -102,3 +106,55 @@ def mark_regular_once_shown(u: User) -> None:
 
 def mark_vip_once_shown(u: User) -> None:
     u.shown_vip_access_once = True
+
+
+async def mark_once(tg_id: int, mark: Callable[[User], None]) -> None:
+    """Ставит одноразовый флаг (mark_*_once_shown) через единый писатель."""
+    async def _set(session: AsyncSession) -> None:
+        u = await session.get(User, tg_id)
+        if u:
+            mark(u)
+
+    await write(_set)
+
+
+async def get_or_create_user(tg_id: int, lang: Optional[str] = None, ref_code: Optional[str] = None) -> User:
+    """
+    Пользователь по tg_id; заводит его, если нет. lang — сменить язык,
+    ref_code — запомнить, если ещё не задан. Обычный случай (пользователь
+    есть, менять нечего) — одно чтение; запись — через единый писатель.
+    """
+    async with async_session() as session:
+        user = await session.get(User, tg_id)
+    if user and not (lang and user.lang != lang) and not (ref_code and not user.ref_code):
+        return user
+
+    async def _upsert(session: AsyncSession) -> User:
+        u = await session.get(User, tg_id)
+        if not u:
+            u = User(id=tg_id)
+            session.add(u)
+        if lang:
+            u.lang = lang
+        if ref_code and not u.ref_code:
+            u.ref_code = ref_code
+        return u
+
+    return await write(_upsert)
+
+
+async def set_last_bot_message_id(tg_id: int, message_id: Optional[int], create: bool = False) -> None:
+    """
+    Запоминает последнее окно бота (для «одного окна»). Пишется на каждый
+    экран — через единый писатель. create=True — завести пользователя, если нет.
+    """
+    async def _set(session: AsyncSession) -> None:
+        user = await session.get(User, tg_id)
+        if not user:
+            if not create:
+                return
+            user = User(id=tg_id)
+            session.add(user)
+        user.last_bot_message_id = message_id
+
+    await write(_set)